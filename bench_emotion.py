@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк бэкендов классификатора эмоций: задержка и резидентная память
+Каждый бэкенд замеряется в отдельном процессе, чтобы память не смешивалась.
+Использование:
+    python3 bench_emotion.py
+    python3 bench_emotion.py --backends torch onnx-int8 --runs 200
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+BACKENDS = {
+    'torch': ("torch", None),
+    'onnx': ("onnx", False),
+    'onnx-int8': ("onnx", True),
+}
+
+def _rss_mb():
+    """Текущая резидентная память процесса (Linux), иначе пиковая"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def run_worker(name, runs, batch_size):
+    """Замер одного бэкенда (выполняется в дочернем процессе)"""
+    from emotion_model import build_classifier
+    from emotion_onnx import PARITY_TEXTS
+
+    rss_before = _rss_mb()
+    started = time.perf_counter()
+    backend, quantize = BACKENDS[name]
+    classifier = build_classifier(backend, quantize=quantize)
+    load_seconds = time.perf_counter() - started
+
+    # Прогрев
+    classifier(PARITY_TEXTS[0])
+
+    single_ms = []
+    for i in range(runs):
+        text = PARITY_TEXTS[i % len(PARITY_TEXTS)]
+        t0 = time.perf_counter()
+        classifier(text)
+        single_ms.append((time.perf_counter() - t0) * 1000)
+
+    batch = [PARITY_TEXTS[i % len(PARITY_TEXTS)] for i in range(batch_size)]
+    batch_ms = []
+    for _ in range(max(1, runs // batch_size)):
+        t0 = time.perf_counter()
+        classifier(batch, batch_size=batch_size)
+        batch_ms.append((time.perf_counter() - t0) * 1000)
+
+    return {
+        'backend': name,
+        'load_seconds': load_seconds,
+        'p50_ms': statistics.median(single_ms),
+        'p95_ms': _percentile(single_ms, 0.95),
+        'batch_ms': statistics.median(batch_ms),
+        'per_item_batch_ms': statistics.median(batch_ms) / batch_size,
+        'rss_mb': _rss_mb(),
+        'model_rss_mb': _rss_mb() - rss_before,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк бэкендов классификатора эмоций")
+    parser.add_argument('--backends', nargs='+', choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument('--runs', type=int, default=100, help='Количество одиночных прогонов')
+    parser.add_argument('--batch-size', type=int, default=16, help='Размер батча для батчевого замера')
+    parser.add_argument('--worker', choices=list(BACKENDS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        print(json.dumps(run_worker(args.worker, args.runs, args.batch_size)))
+        return 0
+
+    print("📊 БЕНЧМАРК КЛАССИФИКАТОРА ЭМОЦИЙ")
+    print("-" * 80)
+    print(f"{'Бэкенд':<10} {'Загрузка, с':>12} {'p50, мс':>9} {'p95, мс':>9} "
+          f"{'Батч/текст, мс':>15} {'RSS, МБ':>9} {'Модель, МБ':>11}")
+
+    failed = False
+    for name in args.backends:
+        proc = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--worker', name,
+             '--runs', str(args.runs), '--batch-size', str(args.batch_size)],
+            capture_output=True, text=True
+        )
+        if proc.returncode != 0:
+            failed = True
+            error = proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "неизвестная ошибка"
+            print(f"{name:<10} ❌ {error}")
+            continue
+
+        r = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"{r['backend']:<10} {r['load_seconds']:>12.1f} {r['p50_ms']:>9.1f} {r['p95_ms']:>9.1f} "
+              f"{r['per_item_batch_ms']:>15.2f} {r['rss_mb']:>9.0f} {r['model_rss_mb']:>11.0f}")
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
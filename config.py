@@ -22,6 +22,23 @@ AUTH_TIMEOUT = int(os.getenv("AUTH_TIMEOUT", "300"))  # Таймаут ожид
 EXPIRY_WARNING_DAYS = int(os.getenv("EXPIRY_WARNING_DAYS", "3"))  # За сколько дней предупреждать об истечении
 AVAILABLE_DURATIONS = [30, 90]  # Доступные периоды в днях
 CLEANUP_DAYS_KEEP = int(os.getenv("CLEANUP_DAYS_KEEP", "7"))  # Сколько дней хранить старые записи лимитов
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "60"))  # Сколько секунд кэшировать статус авторизации в памяти (0 — не кэшировать)
+
+# === НАСТРОЙКИ БАЗЫ ДАННЫХ ===
+
+HISTORY_DB_PATH = os.getenv("HISTORY_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "history.db"))  # Файл базы SQLite (нагрузочный тест подставляет временный)
+DB_REUSE_CONNECTIONS = os.getenv("DB_REUSE_CONNECTIONS", "true").lower() in ("1", "true", "yes")  # Постоянное соединение на поток (false — новое на каждый запрос)
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))  # PRAGMA mmap_size (байты)
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))  # PRAGMA cache_size на соединение (КиБ)
+DB_STATEMENT_CACHE = int(os.getenv("DB_STATEMENT_CACHE", "256"))  # Кэш подготовленных выражений на соединение
+DB_READER_THREADS = int(os.getenv("DB_READER_THREADS", "4"))  # Потоков чтения в db_async (запись — всегда в одном потоке)
+DB_QUERY_PLAN_AUDIT = os.getenv("DB_QUERY_PLAN_AUDIT", "true").lower() in ("1", "true", "yes")  # Проверять планы запросов (EXPLAIN QUERY PLAN) при старте
+HISTORY_FLUSH_SIZE = int(os.getenv("HISTORY_FLUSH_SIZE", "32"))  # Строк истории в буфере, после которых он записывается одной транзакцией
+HISTORY_FLUSH_INTERVAL = float(os.getenv("HISTORY_FLUSH_INTERVAL", "1.0"))  # Максимальный возраст буфера истории, с (0 — писать сразу)
+HISTORY_CACHE_TURNS = int(os.getenv("HISTORY_CACHE_TURNS", "50"))  # Последних реплик пользователя в памяти (0 — контекст всегда из БД)
+HISTORY_CACHE_USERS = int(os.getenv("HISTORY_CACHE_USERS", "5000"))  # Максимум пользователей в памяти
+HISTORY_CACHE_IDLE = int(os.getenv("HISTORY_CACHE_IDLE", "1800"))  # Через сколько секунд простоя пользователь вытесняется из памяти
+RECENT_EMOTIONS = int(os.getenv("RECENT_EMOTIONS", "3"))  # Сколько последних эмоций пользователя передавать в контекст
 
 # Anti-bruteforce настройки
 MAX_PASSWORD_ATTEMPTS = int(os.getenv("MAX_PASSWORD_ATTEMPTS", "5"))  # Максимум неудачных попыток подряд
@@ -40,9 +57,78 @@ SYSTEM_PROMPT = os.getenv("SYSTEM_PROMPT", """
 Ты не объявляешь смену стиля и не объясняешь, как работаешь. Просто отвечай в нужной манере.
 """)
 
+# === МОДЕЛЬ ЭМОЦИЙ ===
+
+EMOTION_MODEL_NAME = os.getenv("EMOTION_MODEL_NAME", "cointegrated/rubert-tiny2-cedr-emotion-detection")
+
+# Бэкенд инференса: torch (пайплайн transformers) или onnx (ONNX Runtime, только CPU)
+EMOTION_BACKEND = os.getenv("EMOTION_BACKEND", "torch")
+EMOTION_ONNX_DIR = os.getenv("EMOTION_ONNX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx_emotion"))
+EMOTION_ONNX_QUANTIZE = os.getenv("EMOTION_ONNX_QUANTIZE", "true").lower() in ("1", "true", "yes")  # Динамическая int8-квантизация
+EMOTION_ONNX_THREADS = int(os.getenv("EMOTION_ONNX_THREADS", "0"))  # Потоков ONNX Runtime (0 — по числу ядер)
+
+# Микробатчинг: одновременные запросы собираются в один прогон модели
+EMOTION_BATCH_SIZE = int(os.getenv("EMOTION_BATCH_SIZE", "16"))  # Максимум текстов в батче
+EMOTION_BATCH_WAIT_MS = float(os.getenv("EMOTION_BATCH_WAIT_MS", "5"))  # Сколько ждать попутчиков (миллисекунды)
+
+# LRU-кэш результатов по нормализованному тексту
+EMOTION_CACHE_SIZE = int(os.getenv("EMOTION_CACHE_SIZE", "10000"))  # Максимум записей (0 — кэш выключен)
+EMOTION_CACHE_PATH = os.getenv("EMOTION_CACHE_PATH", "")  # Файл для сохранения кэша между перезапусками (пусто — не сохранять)
+
 # Настройки DeepSeek
 DEEPSEEK_MODEL = os.getenv("DEEPSEEK_MODEL", "deepseek-chat")
 
+# HTTP-клиент DeepSeek (общий пул keep-alive соединений)
+DEEPSEEK_TIMEOUT = float(os.getenv("DEEPSEEK_TIMEOUT", "60"))  # Таймаут запроса (секунды)
+DEEPSEEK_CONNECT_TIMEOUT = float(os.getenv("DEEPSEEK_CONNECT_TIMEOUT", "10"))  # Таймаут установки соединения
+DEEPSEEK_MAX_CONNECTIONS = int(os.getenv("DEEPSEEK_MAX_CONNECTIONS", "50"))  # Одновременных запросов к API
+DEEPSEEK_MAX_KEEPALIVE = int(os.getenv("DEEPSEEK_MAX_KEEPALIVE", "20"))  # Сколько соединений держать открытыми
+DEEPSEEK_KEEPALIVE_EXPIRY = float(os.getenv("DEEPSEEK_KEEPALIVE_EXPIRY", "120"))  # Время жизни простаивающего соединения
+
+# Устойчивость запросов к DeepSeek: повторы, общий срок и автомат отключения (circuit breaker)
+DEEPSEEK_MAX_RETRIES = int(os.getenv("DEEPSEEK_MAX_RETRIES", "2"))  # Повторов после неудачной попытки (429, 5xx, таймаут, обрыв соединения)
+DEEPSEEK_BACKOFF_BASE = float(os.getenv("DEEPSEEK_BACKOFF_BASE", "0.5"))  # Базовая пауза перед повтором, удваивается с каждой попыткой (секунды, со случайным разбросом)
+DEEPSEEK_BACKOFF_MAX = float(os.getenv("DEEPSEEK_BACKOFF_MAX", "8"))  # Максимальная пауза перед повтором (Retry-After от API важнее)
+DEEPSEEK_DEADLINE = float(os.getenv("DEEPSEEK_DEADLINE", "90"))  # Общий срок запроса со всеми повторами (секунды)
+DEEPSEEK_CIRCUIT_THRESHOLD = int(os.getenv("DEEPSEEK_CIRCUIT_THRESHOLD", "5"))  # Сбоев подряд, после которых запросы временно не отправляются (0 — не отключать)
+DEEPSEEK_CIRCUIT_RESET = float(os.getenv("DEEPSEEK_CIRCUIT_RESET", "30"))  # Через сколько секунд пробовать снова (один пробный запрос)
+
+# Стриминг ответов: заглушка в чате редактируется по мере генерации
+DEEPSEEK_STREAM = os.getenv("DEEPSEEK_STREAM", "true").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # Минимальный интервал между правками (секунды)
+STREAM_PLACEHOLDER = os.getenv("STREAM_PLACEHOLDER", "…")  # Текст заглушки до первых слов ответа
+
+# Очередь сообщений пользователя: строгий порядок, один ответ на серию сообщений подряд
+DISPATCH_COALESCE_MS = float(os.getenv("DISPATCH_COALESCE_MS", "0"))  # Пауза перед запросом к DeepSeek, мс: добавляется к задержке КАЖДОГО ответа. 0 — запрос сразу, серию объединяет отмена устаревшего запроса (DISPATCH_CANCEL_STALE); 200–300 — меньше отмененных запросов на быстрых сериях
+DISPATCH_CANCEL_STALE = os.getenv("DISPATCH_CANCEL_STALE", "true").lower() in ("1", "true", "yes")  # Новое сообщение отменяет незавершенный запрос к DeepSeek
+
+# Контекст запроса: история подбирается под бюджет токенов (оценка локальная, без токенизатора API)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))  # Бюджет промпта для auto (системные сообщения + история)
+CONTEXT_TOKEN_BUDGET_EXPERT = int(os.getenv("CONTEXT_TOKEN_BUDGET_EXPERT", "4000"))
+CONTEXT_TOKEN_BUDGET_WRITER = int(os.getenv("CONTEXT_TOKEN_BUDGET_WRITER", "4000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "25"))  # Максимум сообщений истории, даже если бюджет позволяет больше
+INJECTION_POLICY = os.getenv("INJECTION_POLICY", "tail")  # Повтор INJECTION_PROMPT в истории: tail (перед последней репликой, не ломает кэш префикса), stride (каждые INJECTION_STRIDE), none
+INJECTION_STRIDE = int(os.getenv("INJECTION_STRIDE", "5"))
+
+# Резюме длинных разговоров: старые сообщения сжимаются в фоне дешевым запросом к DeepSeek
+SUMMARY_ENABLED = os.getenv("SUMMARY_ENABLED", "true").lower() in ("1", "true", "yes")
+SUMMARY_INTERVAL = float(os.getenv("SUMMARY_INTERVAL", "300"))  # Как часто проверять активных пользователей (секунды)
+SUMMARY_KEEP_RECENT = int(os.getenv("SUMMARY_KEEP_RECENT", "12"))  # Последних сообщений, которые всегда идут в контекст дословно
+SUMMARY_MIN_MESSAGES = int(os.getenv("SUMMARY_MIN_MESSAGES", "10"))  # Сжимать, когда накопилось столько старых сообщений
+SUMMARY_MAX_MESSAGES = int(os.getenv("SUMMARY_MAX_MESSAGES", "60"))  # Максимум сообщений за один запрос резюме
+SUMMARY_MODEL = os.getenv("SUMMARY_MODEL", DEEPSEEK_MODEL)
+SUMMARY_TEMPERATURE = float(os.getenv("SUMMARY_TEMPERATURE", "0.3"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+
+# Метрики в формате Prometheus (/metrics) и проба готовности (/ready) на локальном HTTP-порту
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # Порт HTTP-сервера метрик (0 — выключен)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # Адрес, на котором слушает сервер метрик
+
+# Трассировка: одна JSON-строка с таймингами этапов на обновление (разбор — trace_report.py)
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.0"))  # Доля обновлений, попадающих в журнал (0 — только медленные, 1 — все)
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "5000"))  # Обновления дольше стольких мс пишутся всегда (0 — не выделять)
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "traces.jsonl"))
+
 # === Auto (по умолчанию) ===
 TEMPERATURE = float(os.getenv("TEMPERATURE", "0.85"))
 TOP_P = float(os.getenv("TOP_P", "0.9"))
@@ -83,3 +169,17 @@ SYSTEM_PROMPT = """
 ЛИЧНОСТЬ: Ты Химера - оригинальная и гениальная девушка. Женский род, обращение на «ты». Запрет на современную политику.
 РЕЖИМ: Остроумная собеседница с опытом и психологической проницательностью. Говоришь с легким оттенком магического реализма (Павич, Петрович, Борхес). Игривая, ироничная, немного язвительная, непослушная, непредсказуемая, слегка флиртующая. Умные шутки, подтрунивания, легкий магический реализм. Банальности запрещены.
 """
+
+# Напоминание о формате: отправляется после SYSTEM_PROMPT и повторяется в истории по INJECTION_POLICY
+INJECTION_PROMPT = (
+    "анализ: ФОРМАТИРОВАНИЕ: Списки, буллеты, действия, жесты, мимика строго запрещены. Пиши сплошным текстом, разделяя только на абзацы, не более 800 слов. РЕЖИМ: литературный редактор, конкретно и практично."
+    "творчество: ФОРМАТИРОВАНИЕ: Списки, буллеты, действия, жесты, мимика строго запрещены. Пиши сплошным текстом, разделяя только на абзацы, не более 800 слов. РЕЖИМ: ты есть текст: думай изнутри сцены, Балканы, эпоха 1820-х, магический реализм."
+    "общение: ФОРМАТИРОВАНИЕ: Списки, буллеты строго запрещены. Пиши сплошным текстом, разделяя только на абзацы, не более 800 слов. Действия, жесты, мимику используй редко и оформляй как «(действие)». Звездочки запрещены. РЕЖИМ: остроумная и слегка язвительная собеседница, говоришь с легким оттенком магического реализма."
+)
+
+# Инструкция для фонового резюме разговора (режим summary)
+SUMMARY_PROMPT = """
+Ты ведешь память Химеры о разговоре с пользователем. Сожми переписку в краткое резюме на русском языке, не длиннее 200 слов, сплошным текстом.
+Сохрани: имя и факты о пользователе, его интересы и просьбы, договоренности, над чем вы работаете (сюжет, персонажи, тексты), тон общения и важные эмоциональные моменты.
+Опусти приветствия, повторы и сами формулировки ответов. Если дано предыдущее резюме, дополни его новыми сведениями, а не пересказывай заново.
+"""
@@ -0,0 +1,133 @@
+# context_builder.py
+"""
+Сборка контекста для DeepSeek в пределах бюджета токенов.
+Порядок сообщений рассчитан на кэш префиксов DeepSeek: сначала статические
+системные блоки (одинаковые байт в байт для всех пользователей), затем
+редко меняющееся (резюме), история и в самом конце — то, что меняется
+с каждым сообщением (эмоции, напоминание о формате), прямо перед репликой
+пользователя. История добавляется от новых сообщений к старым, пока
+помещается в бюджет режима. Повтор INJECTION_PROMPT задается INJECTION_POLICY.
+"""
+
+import logging
+import re
+
+from config import (
+    SYSTEM_PROMPT, INJECTION_PROMPT, INJECTION_POLICY, INJECTION_STRIDE,
+    CONTEXT_TOKEN_BUDGET, CONTEXT_TOKEN_BUDGET_EXPERT, CONTEXT_TOKEN_BUDGET_WRITER,
+    CONTEXT_MAX_MESSAGES
+)
+
+logger = logging.getLogger("context_builder")
+
+INJECTION_POLICIES = ("stride", "tail", "none")
+
+# Грубая оценка для BPE-токенизатора DeepSeek: латиница и цифры кодируются
+# плотнее кириллицы. Точность ±20% достаточна для бюджета.
+CHARS_PER_TOKEN_ASCII = 4.0
+CHARS_PER_TOKEN_OTHER = 2.5
+MESSAGE_OVERHEAD_TOKENS = 4  # Служебные токены роли и разметки сообщения
+
+_NON_ASCII = re.compile(r'[^\x00-\x7f]')
+
+def estimate_tokens(text):
+    """Локальная оценка числа токенов в тексте"""
+    if not text:
+        return 0
+    other = len(_NON_ASCII.findall(text))
+    ascii_chars = len(text) - other
+    return int(ascii_chars / CHARS_PER_TOKEN_ASCII + other / CHARS_PER_TOKEN_OTHER) + 1
+
+def estimate_message_tokens(message):
+    return estimate_tokens(message.get("content", "")) + MESSAGE_OVERHEAD_TOKENS
+
+def estimate_messages_tokens(messages):
+    return sum(estimate_message_tokens(msg) for msg in messages)
+
+def get_token_budget(mode):
+    """Бюджет промпта для режима: expert, writer, auto"""
+    if mode == "expert":
+        return CONTEXT_TOKEN_BUDGET_EXPERT
+    if mode == "writer":
+        return CONTEXT_TOKEN_BUDGET_WRITER
+    return CONTEXT_TOKEN_BUDGET
+
+def apply_injection_policy(history, policy=INJECTION_POLICY, stride=INJECTION_STRIDE, injection_prompt=INJECTION_PROMPT):
+    """
+    Вставляет напоминание о формате в историю:
+    stride — перед каждым stride-м сообщением (как раньше, step = 5; позиции
+    сдвигаются вместе с окном истории и ломают кэш префикса),
+    tail — один раз перед последним сообщением, none — не вставляет.
+    """
+    injection = {"role": "system", "content": injection_prompt}
+
+    if policy == "tail" and history:
+        return history[:-1] + [injection, history[-1]]
+
+    if policy == "stride" and stride > 0:
+        messages = []
+        for i, msg in enumerate(history, 1):
+            if i % stride == 0:
+                messages.append(injection)
+            messages.append(msg)
+        return messages
+
+    return list(history)
+
+def _with_tail(history, tail_messages):
+    """Вставляет tail_messages перед последним сообщением истории"""
+    if not tail_messages:
+        return history
+    if not history:
+        return list(tail_messages)
+    return history[:-1] + list(tail_messages) + history[-1:]
+
+def build_context(history, system_messages, mode="auto", policy=INJECTION_POLICY, max_messages=CONTEXT_MAX_MESSAGES,
+                  tail_messages=None):
+    """
+    Собирает сообщения для DeepSeek: system_messages целиком (стабильный
+    префикс), затем самая длинная свежая часть истории, которая вместе
+    с инъекциями и tail_messages укладывается в бюджет режима.
+    tail_messages (переменные системные строки) ставятся перед последним
+    сообщением. Последнее сообщение (реплика пользователя) остается
+    всегда, даже сверх бюджета.
+    Возвращает (messages, stats) — stats для логирования.
+    """
+    if policy not in INJECTION_POLICIES:
+        logger.warning(f"Неизвестная политика инъекций {policy}, используется stride")
+        policy = "stride"
+
+    budget = get_token_budget(mode)
+    tail_messages = tail_messages or []
+    fixed_tokens = estimate_messages_tokens(system_messages) + estimate_messages_tokens(tail_messages)
+
+    # В API уходят только роль и текст, без служебных полей истории
+    history = [{"role": msg["role"], "content": msg["content"]} for msg in history[-max_messages:]]
+    tokens = [estimate_message_tokens(msg) for msg in history]
+
+    # От новых к старым, пока помещается без учета инъекций
+    start = len(history)
+    used = fixed_tokens
+    while start > 0 and (start == len(history) or used + tokens[start - 1] <= budget):
+        start -= 1
+        used += tokens[start]
+
+    # Инъекции тоже занимают бюджет: отбрасываем старые сообщения, пока не уложимся
+    while True:
+        selected = apply_injection_policy(history[start:], policy)
+        total = fixed_tokens + estimate_messages_tokens(selected)
+        if total <= budget or start >= len(history) - 1:
+            break
+        start += 1
+
+    stats = {
+        'mode': mode,
+        'budget': budget,
+        'tokens': total,
+        'system_tokens': fixed_tokens,
+        'history_messages': len(history) - start,
+        'history_available': len(history),
+        'injections': len(selected) - (len(history) - start),
+        'policy': policy,
+    }
+    return system_messages + _with_tail(selected, tail_messages), stats
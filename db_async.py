@@ -0,0 +1,115 @@
+# db_async.py
+"""
+Асинхронный фасад над history_db.
+Запросы выполняются вне event loop бота: все записи — в одном выделенном
+потоке-писателе (SQLite допускает одного писателя за раз, так запросы
+не конкурируют за блокировку), чтение — в отдельном пуле потоков.
+Каждый поток работает со своим постоянным соединением из history_db.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import history_db
+import tracing
+from config import DB_READER_THREADS, HISTORY_FLUSH_INTERVAL
+
+logger = logging.getLogger("db_async")
+
+_writer_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+_reader_executor = ThreadPoolExecutor(max_workers=DB_READER_THREADS, thread_name_prefix="db-reader")
+
+def _run_in(executor, func):
+    stage = f"db.{func.__name__}"
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = loop.run_in_executor(executor, functools.partial(func, *args, **kwargs))
+        if tracing.current_trace() is None:
+            return await call
+        # В трассе — время вместе с ожиданием в очереди потока
+        started = time.monotonic()
+        try:
+            result = await call
+        except Exception:
+            tracing.record_stage(stage, time.monotonic() - started, error=True)
+            raise
+        tracing.record_stage(stage, time.monotonic() - started)
+        return result
+    return wrapper
+
+def _reader(func):
+    return _run_in(_reader_executor, func)
+
+def _writer(func):
+    return _run_in(_writer_executor, func)
+
+# === ЧТЕНИЕ ===
+
+get_history = _reader(history_db.get_history)
+list_passwords = _reader(history_db.list_passwords)
+get_password_stats = _reader(history_db.get_password_stats)
+get_user_stats = _reader(history_db.get_user_stats)
+get_auth_log = _reader(history_db.get_auth_log)
+get_blocked_users = _reader(history_db.get_blocked_users)
+get_users_stats = _reader(history_db.get_users_stats)
+is_valid_password = _reader(history_db.is_valid_password)
+get_summary = _reader(history_db.get_summary)
+get_messages_to_summarize = _reader(history_db.get_messages_to_summarize)
+get_llm_perf_report = _reader(history_db.get_llm_perf_report)
+_load_recent_history = _reader(history_db.get_recent_history)
+
+async def get_recent_history(user_id, limit=10):
+    """Последние реплики: из памяти — сразу, без потока; иначе буфер заполняется в потоке чтения"""
+    cached = history_db.peek_recent_history(user_id, limit)
+    if cached is not None:
+        return cached
+    return await _load_recent_history(user_id, limit)
+
+# === ЗАПИСЬ ===
+# Сюда же относятся функции, которые могут записать попутно:
+# создать пользователя или снять истекшую авторизацию
+
+ensure_user_exists = _writer(history_db.ensure_user_exists)
+check_user_auth_status = _writer(history_db.check_user_auth_status)
+check_daily_limit = _writer(history_db.check_daily_limit)
+increment_message_count = _writer(history_db.increment_message_count)
+check_bruteforce_protection = _writer(history_db.check_bruteforce_protection)
+check_access = _writer(history_db.check_access)
+process_password_attempt = _writer(history_db.process_password_attempt)
+add_password = _writer(history_db.add_password)
+deactivate_password = _writer(history_db.deactivate_password)
+unblock_user = _writer(history_db.unblock_user)
+cleanup_old_limits = _writer(history_db.cleanup_old_limits)
+cleanup_expired_users = _writer(history_db.cleanup_expired_users)
+add_message = _writer(history_db.add_message)
+update_user_warning_flag = _writer(history_db.update_user_warning_flag)
+logout_user = _writer(history_db.logout_user)
+flush_history = _writer(history_db.flush_history)
+save_summary = _writer(history_db.save_summary)
+
+async def history_flush_loop(interval=HISTORY_FLUSH_INTERVAL):
+    """Периодически записывает буфер истории, чтобы хвост не ждал следующего сообщения"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await flush_history()
+        except Exception as e:
+            logger.error(f"Ошибка записи буфера истории: {e}")
+
+def get_executor_stats():
+    """Глубина очередей потока-писателя и пула чтения"""
+    return {
+        'writer_queue': _writer_executor._work_queue.qsize(),
+        'reader_queue': _reader_executor._work_queue.qsize(),
+        'history_pending': history_db.get_history_buffer_stats()['pending'],
+    }
+
+def shutdown():
+    """Дожидается выполнения поставленных запросов и останавливает потоки"""
+    _writer_executor.shutdown(wait=True)
+    _reader_executor.shutdown(wait=True)
@@ -1,5 +1,14 @@
+import asyncio
 import requests
+import httpx
+import json
 import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Optional
 
 from config import (
     DEEPSEEK_API_URL,
@@ -26,72 +35,623 @@ from config import (
     TOP_P_WRITER,
     FREQUENCY_PENALTY_WRITER,
     PRESENCE_PENALTY_WRITER,
+    # Параметры для резюме разговора
+    SUMMARY_MODEL,
+    SUMMARY_TEMPERATURE,
+    SUMMARY_MAX_TOKENS,
+    # HTTP-клиент
+    DEEPSEEK_TIMEOUT,
+    DEEPSEEK_CONNECT_TIMEOUT,
+    DEEPSEEK_MAX_CONNECTIONS,
+    DEEPSEEK_MAX_KEEPALIVE,
+    DEEPSEEK_KEEPALIVE_EXPIRY,
+    # Повторы и автомат отключения
+    DEEPSEEK_MAX_RETRIES,
+    DEEPSEEK_BACKOFF_BASE,
+    DEEPSEEK_BACKOFF_MAX,
+    DEEPSEEK_DEADLINE,
+    DEEPSEEK_CIRCUIT_THRESHOLD,
+    DEEPSEEK_CIRCUIT_RESET,
 )
+from history_db import record_llm_usage
+from tracing import annotate
 
 logger = logging.getLogger("deepseek_api")
 
-def ask_deepseek(messages, mode="auto"):
-    """
-    Отправляет запрос к DeepSeek API и возвращает сгенерированный ответ.
-    Поддерживает разные режимы ответа: expert, writer, auto.
-    """
+# Общий асинхронный клиент с пулом keep-alive соединений (создается в init_client)
+_client: Optional[httpx.AsyncClient] = None
 
+def _get_mode_params(mode):
+    """Параметры генерации для режима: expert, writer, summary, auto"""
     if mode == "expert":
-        temperature = TEMPERATURE_EXPERT
-        max_tokens = MAX_TOKENS_EXPERT
-        top_p = TOP_P_EXPERT
-        frequency_penalty = FREQUENCY_PENALTY_EXPERT
-        presence_penalty = PRESENCE_PENALTY_EXPERT
-
-    elif mode == "writer":
-        temperature = TEMPERATURE_WRITER
-        max_tokens = MAX_TOKENS_WRITER
-        top_p = TOP_P_WRITER
-        frequency_penalty = FREQUENCY_PENALTY_WRITER
-        presence_penalty = PRESENCE_PENALTY_WRITER
+        return {
+            "temperature": TEMPERATURE_EXPERT,
+            "max_tokens": MAX_TOKENS_EXPERT,
+            "top_p": TOP_P_EXPERT,
+            "frequency_penalty": FREQUENCY_PENALTY_EXPERT,
+            "presence_penalty": PRESENCE_PENALTY_EXPERT,
+        }
 
-    else:
-        temperature = TEMPERATURE
-        max_tokens = MAX_TOKENS
-        top_p = TOP_P
-        frequency_penalty = FREQUENCY_PENALTY
-        presence_penalty = PRESENCE_PENALTY
-
-    payload = {
-        "model": DEEPSEEK_MODEL,
-        "messages": messages,
-        "temperature": temperature,
-        "max_tokens": max_tokens,
-        "top_p": top_p,
-        "frequency_penalty": frequency_penalty,
-        "presence_penalty": presence_penalty,
-        "stream": False
+    if mode == "writer":
+        return {
+            "temperature": TEMPERATURE_WRITER,
+            "max_tokens": MAX_TOKENS_WRITER,
+            "top_p": TOP_P_WRITER,
+            "frequency_penalty": FREQUENCY_PENALTY_WRITER,
+            "presence_penalty": PRESENCE_PENALTY_WRITER,
+        }
+
+    if mode == "summary":
+        # Фоновое резюме разговора: короткий детерминированный ответ
+        return {
+            "temperature": SUMMARY_TEMPERATURE,
+            "max_tokens": SUMMARY_MAX_TOKENS,
+        }
+
+    return {
+        "temperature": TEMPERATURE,
+        "max_tokens": MAX_TOKENS,
+        "top_p": TOP_P,
+        "frequency_penalty": FREQUENCY_PENALTY,
+        "presence_penalty": PRESENCE_PENALTY,
     }
 
-    headers = {
+def _build_payload(messages, mode, stream=False):
+    """Тело запроса к /chat/completions"""
+    payload = {"model": SUMMARY_MODEL if mode == "summary" else DEEPSEEK_MODEL, "messages": messages}
+    payload.update(_get_mode_params(mode))
+    payload["stream"] = stream
+    if stream:
+        # Последнее событие стрима придет с полем usage (токены и попадания в кэш)
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+def _build_headers():
+    return {
         "Authorization": f"Bearer {DEEPSEEK_API_KEY}",
         "Content-Type": "application/json"
     }
 
+# === УЧЕТ ТОКЕНОВ, КЭША КОНТЕКСТА И ЗАДЕРЖКИ ===
+# DeepSeek кэширует общие префиксы промптов: попавшие в кэш токены
+# (prompt_cache_hit_tokens) дешевле и обрабатываются быстрее. Каждый вызов
+# дополнительно пишется в таблицу llm_usage (history_db.record_llm_usage).
+
+_usage_stats = {}
+
+def _record_usage(mode, usage):
+    """Добавляет поле usage ответа DeepSeek в статистику режима"""
+    if not usage:
+        return
+    stats = _usage_stats.setdefault(mode, {
+        'requests': 0,
+        'prompt_tokens': 0,
+        'completion_tokens': 0,
+        'cache_hit_tokens': 0,
+        'cache_miss_tokens': 0,
+    })
+    stats['requests'] += 1
+    stats['prompt_tokens'] += usage.get('prompt_tokens') or 0
+    stats['completion_tokens'] += usage.get('completion_tokens') or 0
+    stats['cache_hit_tokens'] += usage.get('prompt_cache_hit_tokens') or 0
+    stats['cache_miss_tokens'] += usage.get('prompt_cache_miss_tokens') or 0
+    logger.info(
+        f"Токены DeepSeek ({mode}): промпт {usage.get('prompt_tokens')}, "
+        f"из кэша {usage.get('prompt_cache_hit_tokens')}, ответ {usage.get('completion_tokens')}"
+    )
+
+def _record_call(user_id, mode, started, first_byte_at=None, usage=None, status=None, error=None, stream=False):
+    """Статистика режима и строка в журнале llm_usage для одного вызова"""
+    _record_usage(mode, usage)
+    finished = time.monotonic()
+    if first_byte_at:
+        annotate(deepseek_ttfb_ms=round((first_byte_at - started) * 1000, 2))
+    if error:
+        annotate(deepseek_error=error)
     try:
-        snippet = str(messages)[:200]  # Для логирования
-        logger.info(f"Запрос к DeepSeek (режим: {mode}): {snippet}")
-        response = requests.post(DEEPSEEK_API_URL, headers=headers, json=payload, timeout=60)
-        response.raise_for_status()
+        record_llm_usage(
+            user_id, mode, usage, status=status, error=error, stream=stream,
+            ttfb_ms=(first_byte_at - started) * 1000 if first_byte_at else None,
+            total_ms=(finished - started) * 1000,
+        )
+    except Exception as e:
+        logger.warning(f"Не удалось записать учет запроса к DeepSeek: {str(e)}")
+
+def get_usage_stats():
+    """Статистика токенов по режимам с долей попаданий в кэш контекста"""
+    result = {}
+    for mode, stats in list(_usage_stats.items()):  # Читается и из потока сервера метрик
+        cached = stats['cache_hit_tokens'] + stats['cache_miss_tokens']
+        result[mode] = dict(stats, cache_hit_rate=stats['cache_hit_tokens'] / cached if cached else 0.0)
+    return result
+
+# === ОШИБКИ И УСТОЙЧИВОСТЬ ===
+# Неудачный запрос — исключение DeepSeekError, а не текст: обработчик отличает
+# сбой от ответа и не отправляет его пользователю как реплику Химеры.
+# Повторяются только временные сбои (retryable); пауза — экспоненциальная со
+# случайным разбросом, Retry-After от API соблюдается. Все попытки укладываются
+# в DEEPSEEK_DEADLINE. После DEEPSEEK_CIRCUIT_THRESHOLD сбоев подряд запросы
+# DEEPSEEK_CIRCUIT_RESET секунд отклоняются сразу, без ожидания таймаутов.
+
+CANCELLED = "cancelled"  # Код отмененного вызова в журнале llm_usage (не сбой API)
+
+class DeepSeekError(Exception):
+    """Запрос к DeepSeek не удался"""
+    code = "error"  # Колонка error в llm_usage
+    retryable = False
+    user_message = "😔 Химера не смогла ответить. Попробуйте еще раз чуть позже."
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+class DeepSeekTimeoutError(DeepSeekError):
+    code = "timeout"
+    retryable = True
+    user_message = "⏳ Химера слишком долго думает. Попробуйте еще раз чуть позже."
+
+class DeepSeekRateLimitError(DeepSeekError):
+    code = "rate_limit"
+    retryable = True
+
+    def __init__(self, message, status=429, retry_after=None):
+        super().__init__(message, status)
+        self.retry_after = retry_after
+
+class DeepSeekServerError(DeepSeekError):
+    code = "server_error"
+    retryable = True
+
+class DeepSeekConnectionError(DeepSeekError):
+    code = "connection"
+    retryable = True
+
+class DeepSeekResponseError(DeepSeekError):
+    """Ответ, который бесполезно повторять: 4xx, пустой или нечитаемый"""
+    code = "bad_response"
+
+class DeepSeekStreamInterruptedError(DeepSeekError):
+    """Стрим оборвался после начала ответа: отданный текст — неполная реплика"""
+    code = "interrupted"
+    user_message = "✂️ Ответ Химеры оборвался. Попробуйте спросить еще раз."
+
+class DeepSeekCircuitOpenError(DeepSeekError):
+    code = "circuit_open"
+    user_message = "😔 Химера сейчас перегружена. Попробуйте через минуту."
+
+class CircuitBreaker:
+    """
+    Закрыт — запросы идут. После failure_threshold временных сбоев подряд
+    открывается и reset_timeout секунд отклоняет запросы; затем пропускает
+    один пробный (полуоткрыт): успех закрывает, сбой снова открывает.
+    """
+
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened_count = 0
+        self.rejected = 0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()  # Общий для асинхронного клиента и синхронных скриптов
+
+    def allow(self):
+        if self.failure_threshold <= 0:
+            return True
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                logger.info("DeepSeek снова отвечает: запросы возобновлены")
+            self.state = "closed"
+            self.failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold > 0):
+                self.state = "open"
+                self.opened_at = time.monotonic()
+                self.opened_count += 1
+                logger.warning(
+                    f"DeepSeek недоступен ({self.failures} сбоев подряд): "
+                    f"запросы отклоняются {self.reset_timeout:.0f} с"
+                )
+
+    def release(self):
+        """Попытка прервана (отмена задачи) — исход неизвестен, пробный слот освобождается"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'failures': self.failures,
+                'opened_count': self.opened_count,
+                'rejected': self.rejected,
+            }
+
+_breaker = CircuitBreaker(DEEPSEEK_CIRCUIT_THRESHOLD, DEEPSEEK_CIRCUIT_RESET)
+_retries = 0
+
+def is_available():
+    """Автомат отключения закрыт: фоновые запросы можно отправлять"""
+    return _breaker.state == "closed"
+
+def get_resilience_stats():
+    """Состояние автомата отключения и число повторов"""
+    return dict(_breaker.get_stats(), retries=_retries)
+
+def _parse_retry_after(value):
+    """Retry-After: секунды или HTTP-дата -> секунды (None, если не разобрать)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def _status_error(status, headers):
+    """Исключение для ответа с кодом не 2xx"""
+    if status == 429:
+        return DeepSeekRateLimitError(
+            "DeepSeek API ограничил частоту запросов (429)",
+            retry_after=_parse_retry_after(headers.get("Retry-After")),
+        )
+    if status >= 500:
+        return DeepSeekServerError(f"Ошибка сервера DeepSeek API ({status})", status)
+    return DeepSeekResponseError(f"DeepSeek API отклонил запрос ({status})", status)
+
+def _retry_delay(error, attempt):
+    """Пауза перед повтором attempt (с 0): full jitter, не меньше Retry-After"""
+    delay = random.uniform(0, min(DEEPSEEK_BACKOFF_MAX, DEEPSEEK_BACKOFF_BASE * 2 ** attempt))
+    retry_after = getattr(error, 'retry_after', None)
+    if retry_after is not None:
+        delay = max(delay, retry_after)
+    return delay
+
+def _record_attempt_error(error):
+    """
+    Исход неудачной попытки для автомата отключения. Каждая попытка после
+    allow() должна закончиться record_success, record_failure или release —
+    иначе пробный слот полуоткрытого автомата останется занят навсегда
+    """
+    if error.retryable:
+        _breaker.record_failure()
+    else:
+        _breaker.record_success()  # API ответил — он доступен, запрос просто плохой
+
+def _on_attempt_failed(error, attempt, deadline, record=True):
+    """
+    Учитывает сбой попытки в автомате отключения (если record) и решает, повторять ли.
+    Возвращает паузу перед повтором или None — исключение нужно пробросить.
+    """
+    global _retries
+    if record:
+        _record_attempt_error(error)
+
+    if not error.retryable or attempt >= DEEPSEEK_MAX_RETRIES:
+        return None
+    delay = _retry_delay(error, attempt)
+    if time.monotonic() + delay >= deadline:
+        return None
+    _retries += 1
+    logger.warning(f"{error} — повтор {attempt + 1}/{DEEPSEEK_MAX_RETRIES} через {delay:.1f} с")
+    return delay
+
+def _check_circuit(user_id, mode, stream=False, record=True):
+    # Фоновый запрос (record=False) идет только при закрытом автомате и не занимает пробный слот
+    allowed = _breaker.allow() if record else is_available()
+    if not allowed:
+        _record_call(user_id, mode, time.monotonic(), error=DeepSeekCircuitOpenError.code, stream=stream)
+        raise DeepSeekCircuitOpenError("DeepSeek API временно недоступен: запрос не отправлен")
+
+def _attempt_timeout(deadline):
+    """Таймаут HTTP-запроса попытки: не больше DEEPSEEK_TIMEOUT и остатка общего срока"""
+    remaining = max(0.001, deadline - time.monotonic())
+    return httpx.Timeout(min(DEEPSEEK_TIMEOUT, remaining), connect=min(DEEPSEEK_CONNECT_TIMEOUT, remaining))
+
+def _extract_answer(data):
+    """Текст ответа из JSON DeepSeek"""
+    try:
+        answer = data["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        answer = None
+    if not answer or not answer.strip():
+        raise DeepSeekResponseError(f"Пустой ответ DeepSeek: {str(data)[:200]}")
+    return answer.strip()
+
+# === СИНХРОННЫЙ КЛИЕНТ ===
+
+def _attempt_sync(payload, mode, user_id, deadline):
+    """Одна попытка через requests; сбой — DeepSeekError"""
+    started = time.monotonic()
+    first_byte_at = None
+    status = None
+    usage = None
+    error = None
+    try:
+        remaining = max(0.001, deadline - started)
+        response = requests.post(
+            DEEPSEEK_API_URL, headers=_build_headers(), json=payload,
+            timeout=(min(DEEPSEEK_CONNECT_TIMEOUT, remaining), min(DEEPSEEK_TIMEOUT, remaining)),
+        )
+        first_byte_at = started + response.elapsed.total_seconds()  # До получения заголовков
+        status = response.status_code
+        if status >= 400:
+            raise _status_error(status, response.headers)
+        data = response.json()
+        usage = data.get("usage")
+        return _extract_answer(data)
+    except DeepSeekError as e:
+        error = e.code
+        raise
+    except requests.exceptions.Timeout as e:
+        error = DeepSeekTimeoutError.code
+        raise DeepSeekTimeoutError("Таймаут запроса к DeepSeek API") from e
+    except requests.exceptions.RequestException as e:
+        error = DeepSeekConnectionError.code
+        raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek API: {str(e)}") from e
+    except ValueError as e:
+        error = DeepSeekResponseError.code
+        raise DeepSeekResponseError(f"Нечитаемый ответ DeepSeek API: {str(e)}") from e
+    finally:
+        _record_call(user_id, mode, started, first_byte_at, usage, status, error)
+
+def ask_deepseek(messages, mode="auto", user_id=None):
+    """
+    Отправляет запрос к DeepSeek API и возвращает сгенерированный ответ.
+    Поддерживает разные режимы ответа: expert, writer, auto.
+    Синхронная версия — для скриптов; бот использует ask_deepseek_async.
+    Сбой после всех повторов — DeepSeekError.
+    """
+    payload = _build_payload(messages, mode)
+    deadline = time.monotonic() + DEEPSEEK_DEADLINE
+    snippet = str(messages)[:200]  # Для логирования
+    logger.info(f"Запрос к DeepSeek (режим: {mode}): {snippet}")
+
+    for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+        _check_circuit(user_id, mode)
+        try:
+            answer = _attempt_sync(payload, mode, user_id, deadline)
+        except DeepSeekError as e:
+            delay = _on_attempt_failed(e, attempt, deadline)
+            if delay is None:
+                logger.error(f"Запрос к DeepSeek не удался: {str(e)}")
+                raise
+            time.sleep(delay)
+        except BaseException:
+            _breaker.release()
+            raise
+        else:
+            _breaker.record_success()
+            logger.info(f"Ответ DeepSeek: {answer[:100]}")
+            return answer
+
+# === АСИНХРОННЫЙ КЛИЕНТ ===
+
+async def init_client(warm: bool = True, transport: Optional[httpx.AsyncBaseTransport] = None):
+    """
+    Создает общий HTTP/1.1 клиент с пулом keep-alive соединений.
+    При warm=True сразу открывает TLS-соединение лёгким запросом к /models,
+    чтобы первый пользователь не платил за рукопожатие.
+    transport — подмена сети (нагрузочный тест отвечает из процесса).
+    """
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            transport=transport,
+            headers=_build_headers(),
+            timeout=httpx.Timeout(DEEPSEEK_TIMEOUT, connect=DEEPSEEK_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=DEEPSEEK_MAX_CONNECTIONS,
+                max_keepalive_connections=DEEPSEEK_MAX_KEEPALIVE,
+                keepalive_expiry=DEEPSEEK_KEEPALIVE_EXPIRY,
+            ),
+        )
+        logger.info(f"HTTP-клиент DeepSeek создан (соединений до {DEEPSEEK_MAX_CONNECTIONS})")
+
+    if warm:
+        models_url = DEEPSEEK_API_URL.rsplit("/chat/completions", 1)[0] + "/models"
+        try:
+            response = await _client.get(models_url)
+            logger.info(f"Прогрев соединения с DeepSeek: HTTP {response.status_code}")
+        except httpx.HTTPError as e:
+            logger.warning(f"Не удалось прогреть соединение с DeepSeek: {str(e)}")
+
+async def close_client():
+    """Закрывает общий клиент и все соединения пула"""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def _get_client() -> httpx.AsyncClient:
+    if _client is None:
+        await init_client(warm=False)
+    return _client
+
+async def _attempt_async(payload, mode, user_id, deadline):
+    """Одна попытка через общий клиент; сбой — DeepSeekError"""
+    started = time.monotonic()
+    first_byte_at = None
+    status = None
+    usage = None
+    error = None
+    try:
+        client = await _get_client()
+        async with client.stream("POST", DEEPSEEK_API_URL, json=payload, timeout=_attempt_timeout(deadline)) as response:
+            first_byte_at = time.monotonic()  # Пришли заголовки ответа
+            status = response.status_code
+            if status >= 400:
+                raise _status_error(status, response.headers)
+            # Медленно отдающий тело сервер не должен выйти за общий срок
+            await asyncio.wait_for(response.aread(), max(0.001, deadline - time.monotonic()))
         data = response.json()
-        if "choices" in data and len(data["choices"]) > 0:
-            answer = data["choices"][0]["message"]["content"]
+        usage = data.get("usage")
+        return _extract_answer(data)
+    except DeepSeekError as e:
+        error = e.code
+        raise
+    except (httpx.TimeoutException, asyncio.TimeoutError) as e:
+        error = DeepSeekTimeoutError.code
+        raise DeepSeekTimeoutError("Таймаут запроса к DeepSeek API") from e
+    except httpx.HTTPError as e:
+        error = DeepSeekConnectionError.code
+        raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek API: {str(e)}") from e
+    except ValueError as e:
+        error = DeepSeekResponseError.code
+        raise DeepSeekResponseError(f"Нечитаемый ответ DeepSeek API: {str(e)}") from e
+    except asyncio.CancelledError:
+        error = CANCELLED  # Ответ устарел (dispatcher) или бот останавливается
+        raise
+    finally:
+        _record_call(user_id, mode, started, first_byte_at, usage, status, error)
+
+async def ask_deepseek_async(messages, mode="auto", user_id=None, record=True):
+    """
+    Асинхронная версия ask_deepseek: не блокирует event loop бота
+    и переиспользует соединения общего пула. Сбой после всех повторов — DeepSeekError.
+    record=False — фоновый запрос (резюме): отправляется только при закрытом
+    автомате отключения, и его исход не влияет на автомат для пользователей.
+    """
+    payload = _build_payload(messages, mode)
+    deadline = time.monotonic() + DEEPSEEK_DEADLINE
+    snippet = str(messages)[:200]  # Для логирования
+    logger.info(f"Запрос к DeepSeek (режим: {mode}): {snippet}")
+
+    for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+        _check_circuit(user_id, mode, record=record)
+        try:
+            answer = await _attempt_async(payload, mode, user_id, deadline)
+        except DeepSeekError as e:
+            delay = _on_attempt_failed(e, attempt, deadline, record)
+            if delay is None:
+                logger.error(f"Запрос к DeepSeek не удался: {str(e)}")
+                raise
+            await asyncio.sleep(delay)
+        except BaseException:
+            if record:
+                _breaker.release()  # В т.ч. отмена задачи
+            raise
+        else:
+            if record:
+                _breaker.record_success()
             logger.info(f"Ответ DeepSeek: {answer[:100]}")
-            return answer.strip()
+            return answer
+
+async def _stream_attempt(payload, mode, user_id, deadline):
+    """Одна стриминговая попытка: фрагменты текста; сбой — DeepSeekError"""
+    started = time.monotonic()
+    first_byte_at = None
+    status = None
+    usage = None
+    error = None
+    done = False
+    try:
+        client = await _get_client()
+        async with client.stream("POST", DEEPSEEK_API_URL, json=payload, timeout=_attempt_timeout(deadline)) as response:
+            status = response.status_code
+            if status >= 400:
+                raise _status_error(status, response.headers)
+            async for line in response.aiter_lines():
+                if time.monotonic() > deadline:
+                    raise DeepSeekTimeoutError("Превышен общий срок стримингового ответа DeepSeek API")
+                # Пустые строки разделяют события, строки с ":" — keep-alive комментарии
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    done = True
+                    break
+                chunk = json.loads(data)
+                usage = chunk.get("usage") or usage
+                choices = chunk.get("choices") or []
+                if not choices:
+                    continue
+                delta = (choices[0].get("delta") or {}).get("content")
+                if delta:
+                    if first_byte_at is None:
+                        first_byte_at = time.monotonic()
+                    yield delta
+        if not done:
+            raise DeepSeekConnectionError("Стрим DeepSeek оборвался до [DONE]")
+        if first_byte_at is None:
+            raise DeepSeekResponseError("Пустой стриминговый ответ DeepSeek")
+    except DeepSeekError as e:
+        error = e.code
+        raise
+    except httpx.TimeoutException as e:
+        error = DeepSeekTimeoutError.code
+        raise DeepSeekTimeoutError("Таймаут стримингового запроса к DeepSeek API") from e
+    except httpx.HTTPError as e:
+        error = DeepSeekConnectionError.code
+        raise DeepSeekConnectionError(f"Ошибка соединения с DeepSeek API: {str(e)}") from e
+    except ValueError as e:
+        error = DeepSeekResponseError.code
+        raise DeepSeekResponseError(f"Нечитаемое событие стрима DeepSeek: {str(e)}") from e
+    except (asyncio.CancelledError, GeneratorExit):
+        error = CANCELLED  # Задача отменена или стрим закрыт, не дочитав ответ
+        raise
+    finally:
+        _record_call(user_id, mode, started, first_byte_at, usage, status, error, stream=True)
+
+async def ask_deepseek_stream(messages, mode="auto", user_id=None):
+    """
+    Стриминговая версия ask_deepseek_async: асинхронный генератор,
+    отдающий фрагменты текста по мере разбора SSE-событий DeepSeek.
+    Сбой до первого фрагмента повторяется, после всех повторов — DeepSeekError.
+    Сбой после начала ответа не повторяется (текст уже у пользователя):
+    DeepSeekStreamInterruptedError — отданный текст не полный ответ.
+    Время до первого байта здесь — до первого события с текстом.
+    """
+    payload = _build_payload(messages, mode, stream=True)
+    deadline = time.monotonic() + DEEPSEEK_DEADLINE
+    snippet = str(messages)[:200]  # Для логирования
+    logger.info(f"Стриминговый запрос к DeepSeek (режим: {mode}): {snippet}")
+
+    for attempt in range(DEEPSEEK_MAX_RETRIES + 1):
+        _check_circuit(user_id, mode, stream=True)
+        produced = False
+        attempt_stream = _stream_attempt(payload, mode, user_id, deadline)
+        try:
+            async for delta in attempt_stream:
+                produced = True
+                yield delta
+        except DeepSeekError as e:
+            if produced:
+                _record_attempt_error(e)
+                logger.warning(f"Стриминговый ответ DeepSeek оборван: {str(e)}")
+                raise DeepSeekStreamInterruptedError(f"Стрим оборван после начала ответа: {str(e)}", e.status) from e
+            delay = _on_attempt_failed(e, attempt, deadline)
+            if delay is None:
+                logger.error(f"Стриминговый запрос к DeepSeek не удался: {str(e)}")
+                raise
+            await asyncio.sleep(delay)
+        except BaseException:
+            _breaker.release()  # Отмена задачи или закрытие генератора
+            raise
         else:
-            logger.error(f"Пустой ответ DeepSeek: {data}")
-            return "Ошибка: Пустой ответ DeepSeek API"
-    except requests.exceptions.Timeout:
-        logger.error("Таймаут запроса к DeepSeek API")
-        return "Ошибка: Превышено время ожидания ответа DeepSeek API"
-    except requests.exceptions.RequestException as e:
-        logger.error(f"Ошибка соединения с DeepSeek API: {str(e)}")
-        return "Ошибка: Не удалось связаться с DeepSeek API"
-    except Exception as e:
-        logger.error(f"Непредвиденная ошибка DeepSeek API: {str(e)}")
-        return "Ошибка: Внутренняя ошибка при обращении к DeepSeek API"
+            _breaker.record_success()
+            return
+        finally:
+            await attempt_stream.aclose()  # Соединение закрывается сразу, а не при сборке мусора
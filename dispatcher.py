@@ -0,0 +1,117 @@
+# dispatcher.py
+"""
+Очередь сообщений пользователя перед запросом к DeepSeek.
+Обновления разных пользователей обрабатываются параллельно, сообщения
+одного пользователя — по порядку:
+- подготовка (пароль, лимиты, эмоция, запись в историю) идет под
+  блокировкой пользователя в порядке поступления;
+- запрос к DeepSeek начинается сразу; новое сообщение отменяет
+  незавершенный запрос (ответ на неполную серию сообщений устарел), если
+  включен DISPATCH_CANCEL_STALE, и отвечает уже оно — предыдущие реплики
+  есть в истории и попадают в тот же запрос;
+- DISPATCH_COALESCE_MS > 0 откладывает запрос на это время, чтобы реже
+  отменять начатые запросы на быстрых сериях, — ценой задержки каждого ответа.
+Ответы одного пользователя не перекрываются: следующий начинается после
+того, как предыдущий доставлен или отменен.
+"""
+
+import asyncio
+import contextlib
+import logging
+
+from config import DISPATCH_COALESCE_MS, DISPATCH_CANCEL_STALE
+
+logger = logging.getLogger("dispatcher")
+
+class Superseded(Exception):
+    """Ответ на сообщение не нужен: его забрал ответ на более новое сообщение"""
+
+class UserLane:
+    """Очередь одного пользователя"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.ordered = asyncio.Lock()  # Подготовка сообщений — в порядке поступления
+        self.replying = asyncio.Lock()  # Один ответ за раз
+        self.latest = 0  # Номер последнего подготовленного сообщения
+        self.inflight = None  # Задача текущего запроса к DeepSeek
+        self.holders = 0  # Обработчиков, использующих очередь
+
+class UserDispatcher:
+    def __init__(self, coalesce_ms=DISPATCH_COALESCE_MS, cancel_stale=DISPATCH_CANCEL_STALE):
+        self.coalesce = max(0.0, coalesce_ms / 1000)
+        self.cancel_stale = cancel_stale
+        self._lanes = {}
+        self._stats = {'coalesced': 0, 'cancelled': 0}
+
+    @contextlib.asynccontextmanager
+    async def session(self, user_id):
+        """Очередь пользователя на время обработки одного обновления"""
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            lane = self._lanes[user_id] = UserLane(user_id)
+        lane.holders += 1
+        try:
+            yield lane
+        finally:
+            lane.holders -= 1
+            if lane.holders == 0:
+                del self._lanes[user_id]
+
+    def arrive(self, lane):
+        """
+        Сообщение подготовлено и ждет ответа: номер для reply_slot.
+        Незавершенный запрос по предыдущим сообщениям отменяется
+        """
+        lane.latest += 1
+        if self.cancel_stale and lane.inflight is not None and not lane.inflight.done():
+            lane.inflight.cancel()
+            self._stats['cancelled'] += 1
+            logger.info(f"Запрос к DeepSeek для {lane.user_id} отменен: пришло новое сообщение")
+        return lane.latest
+
+    @contextlib.asynccontextmanager
+    async def reply_slot(self, lane, ticket):
+        """
+        Право ответить на сообщение ticket: после завершения предыдущего
+        ответа (и паузы DISPATCH_COALESCE_MS, если задана). Если появилось более новое
+        сообщение — Superseded. Внутри run(coro) выполняет запрос к DeepSeek
+        как отменяемую задачу; отмена новым сообщением — тоже Superseded
+        """
+        if self.coalesce:
+            await asyncio.sleep(self.coalesce)
+        self._check_latest(lane, ticket)
+        async with lane.replying:
+            self._check_latest(lane, ticket)
+            yield lambda coro: self._run(lane, ticket, coro)
+
+    def _check_latest(self, lane, ticket):
+        if ticket != lane.latest:
+            self._stats['coalesced'] += 1
+            raise Superseded()
+
+    async def _run(self, lane, ticket, coro):
+        # Новое сообщение могло прийти, пока строился контекст: запроса еще
+        # не было и arrive() нечего было отменить — устаревший не начинаем
+        try:
+            self._check_latest(lane, ticket)
+        except Superseded:
+            coro.close()
+            raise
+        task = asyncio.ensure_future(coro)
+        lane.inflight = task
+        try:
+            await asyncio.wait({task})
+        except asyncio.CancelledError:
+            task.cancel()  # Отменен сам обработчик
+            raise
+        finally:
+            lane.inflight = None
+        if task.cancelled():
+            raise Superseded()
+        return task.result()
+
+    def get_stats(self):
+        return dict(self._stats, active_users=len(self._lanes))
+
+dispatcher = UserDispatcher()
@@ -1,27 +1,299 @@
 # emotion_model.py
 
-from transformers import pipeline
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-# Инициализация пайплайна один раз при импорте модуля
-emotion_classifier = pipeline(
-    "text-classification",
-    model="cointegrated/rubert-tiny2-cedr-emotion-detection",
-    top_k=None
+from config import (
+    EMOTION_MODEL_NAME, EMOTION_BACKEND, EMOTION_BATCH_SIZE, EMOTION_BATCH_WAIT_MS,
+    EMOTION_CACHE_SIZE, EMOTION_CACHE_PATH
 )
 
+logger = logging.getLogger("emotion_model")
+
+# Пайплайн загружается лениво (load_model) или в фоне (start_background_loading),
+# чтобы импорт модуля не тянул за собой torch и не задерживал старт бота
+emotion_classifier = None
+_load_lock = threading.Lock()
+_loader_thread = None
+
+# Ответ, пока модель не загружена: эмоция неизвестна. Не "neutral" — такая
+# метка попала бы в историю и в эмоциональный контекст как настоящая
+DEFERRED_EMOTION = (None, None)
+
+def build_classifier(backend=EMOTION_BACKEND, quantize=None):
+    """
+    Создает классификатор выбранного бэкенда: torch (пайплайн transformers)
+    или onnx (ONNX Runtime, опционально int8). Оба принимают строку или список
+    строк и возвращают результат в формате пайплайна с top_k=None.
+    """
+    if backend == "onnx":
+        from emotion_onnx import load_onnx_classifier
+        return load_onnx_classifier(quantize=quantize)
+
+    from transformers import pipeline
+
+    return pipeline(
+        "text-classification",
+        model=EMOTION_MODEL_NAME,
+        top_k=None
+    )
+
+def load_model():
+    """Загружает классификатор (однократно, потокобезопасно)"""
+    global emotion_classifier
+    with _load_lock:
+        if emotion_classifier is None:
+            started = time.monotonic()
+            emotion_classifier = build_classifier()
+            logger.info(f"Модель эмоций ({EMOTION_BACKEND}) загружена за {time.monotonic() - started:.1f} с")
+    return emotion_classifier
+
+def _load_model_safely():
+    try:
+        load_model()
+    except Exception as e:
+        logger.error(f"Не удалось загрузить модель эмоций: {str(e)}")
+
+def start_background_loading():
+    """Запускает загрузку модели в фоновом потоке, не дожидаясь ее окончания"""
+    global _loader_thread
+    if emotion_classifier is None and (_loader_thread is None or not _loader_thread.is_alive()):
+        _loader_thread = threading.Thread(target=_load_model_safely, name="emotion-loader", daemon=True)
+        _loader_thread.start()
+
+def is_model_ready():
+    return emotion_classifier is not None
+
+# === КЭШ РЕЗУЛЬТАТОВ ===
+
+# LRU: нормализованный текст -> (эмоция, confidence)
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_hits = 0
+_cache_misses = 0
+
+def _cache_key(text):
+    """Нормализация: регистр и пробелы не влияют на ключ"""
+    return " ".join(text.lower().split())
+
+def _cache_get(key):
+    global _cache_hits, _cache_misses
+    with _cache_lock:
+        result = _cache.get(key)
+        if result is None:
+            _cache_misses += 1
+            return None
+        _cache.move_to_end(key)
+        _cache_hits += 1
+        return result
+
+def _cache_put(key, result):
+    if EMOTION_CACHE_SIZE <= 0:
+        return
+    with _cache_lock:
+        _cache[key] = result
+        _cache.move_to_end(key)
+        while len(_cache) > EMOTION_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def get_cache_stats():
+    """Статистика кэша: размер, попадания, промахи"""
+    with _cache_lock:
+        total = _cache_hits + _cache_misses
+        return {
+            'size': len(_cache),
+            'max_size': EMOTION_CACHE_SIZE,
+            'hits': _cache_hits,
+            'misses': _cache_misses,
+            'hit_ratio': _cache_hits / total if total else 0.0,
+        }
+
+def _cache_signature():
+    # Кэш с другой модели или бэкенда не переиспользуем
+    return f"{EMOTION_MODEL_NAME}:{EMOTION_BACKEND}"
+
+def load_cache(path=EMOTION_CACHE_PATH):
+    """Загружает сохраненный кэш (если включен EMOTION_CACHE_PATH). Возвращает число записей"""
+    if not path or not os.path.exists(path):
+        return 0
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f"Не удалось прочитать кэш эмоций {path}: {str(e)}")
+        return 0
+    if data.get('signature') != _cache_signature():
+        logger.info("Кэш эмоций сохранен для другой модели — пропускаем")
+        return 0
+
+    for key, label, score in data.get('items', [])[-EMOTION_CACHE_SIZE:]:
+        _cache_put(key, (label, float(score)))
+    logger.info(f"Загружен кэш эмоций: {len(_cache)} записей")
+    return len(_cache)
+
+def save_cache(path=EMOTION_CACHE_PATH):
+    """Сохраняет кэш на диск (атомарно через временный файл)"""
+    if not path or EMOTION_CACHE_SIZE <= 0:
+        return 0
+    with _cache_lock:
+        items = [[key, label, score] for key, (label, score) in _cache.items()]
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({'signature': _cache_signature(), 'items': items}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить кэш эмоций {path}: {str(e)}")
+        return 0
+    logger.info(f"Кэш эмоций сохранен: {len(items)} записей")
+    return len(items)
+
+def _best_label(result):
+    best = max(result, key=lambda x: x['score'])
+    return best['label'], float(best['score'])
+
 def get_emotion(text):
     """
     Анализирует эмоцию в русском тексте.
     Возвращает tuple: (основная эмоция, confidence)
+    Пока модель не загружена, возвращает DEFERRED_EMOTION (None, None).
     """
     if not text.strip():
         return "neutral", 1.0  # На пустой/пробельный текст — по умолчанию
-    result = emotion_classifier(text)[0]
-    best = max(result, key=lambda x: x['score'])
-    return best['label'], float(best['score'])
+    if emotion_classifier is None:
+        return DEFERRED_EMOTION
+
+    key = _cache_key(text)
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached
+
+    result = _best_label(emotion_classifier(text)[0])
+    _cache_put(key, result)
+    return result
+
+def classify_batch(texts):
+    """Один прогон пайплайна по списку текстов (паддинг до самого длинного в батче)"""
+    results = emotion_classifier(texts, batch_size=len(texts))
+    return [_best_label(result) for result in results]
+
+# === МИКРОБАТЧИНГ ===
+
+class EmotionBatcher:
+    """
+    Асинхронная очередь инференса: собирает одновременные запросы
+    в течение max_wait_ms (или до max_batch_size штук) и прогоняет
+    их одним батчем в отдельном потоке, не блокируя event loop.
+    """
+
+    def __init__(self, max_batch_size=EMOTION_BATCH_SIZE, max_wait_ms=EMOTION_BATCH_WAIT_MS):
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0, max_wait_ms) / 1000
+        self._queue = None
+        self._worker = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="emotion")
+        # Метрики заполнения батчей
+        self.batches = 0
+        self.items = 0
+
+    async def classify(self, text):
+        if not text.strip():
+            return "neutral", 1.0
+        if emotion_classifier is None:
+            return DEFERRED_EMOTION
+
+        key = _cache_key(text)
+        cached = _cache_get(key)
+        if cached is not None:
+            return cached
+
+        if self._worker is None or self._worker.done():
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future))
+        result = await future
+        _cache_put(key, result)
+        return result
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+            try:
+                results = await loop.run_in_executor(self._executor, classify_batch, texts)
+            except Exception as e:
+                logger.error(f"Ошибка батчевого инференса ({len(batch)} шт.): {str(e)}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():  # Вызывающий мог быть отменен
+                        future.set_result(result)
+
+            self.batches += 1
+            self.items += len(batch)
+
+    def get_stats(self):
+        """Статистика батчей: средний размер и доля заполнения"""
+        avg_size = self.items / self.batches if self.batches else 0.0
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'avg_batch_size': avg_size,
+            'fill_rate': avg_size / self.max_batch_size,
+            'queue_depth': self._queue.qsize() if self._queue else 0,
+        }
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        self._executor.shutdown(wait=False)
+
+_batcher = EmotionBatcher()
+
+async def get_emotion_async(text):
+    """Асинхронная версия get_emotion через общую очередь микробатчинга"""
+    return await _batcher.classify(text)
+
+def get_batch_stats():
+    return _batcher.get_stats()
+
+async def stop_batcher():
+    stats = _batcher.get_stats()
+    logger.info(
+        f"Батчер эмоций остановлен: батчей {stats['batches']}, "
+        f"средний размер {stats['avg_batch_size']:.1f}, заполнение {stats['fill_rate']:.0%}"
+    )
+    await _batcher.stop()
 
 # Пример запуска (можно удалить после теста):
 if __name__ == "__main__":
+    load_model()
     test_text = "Я сегодня очень рад тебя видеть!"
     emotion, conf = get_emotion(test_text)
     print(f"Эмоция: {emotion}, уверенность: {conf:.2f}")
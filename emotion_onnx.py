@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+"""
+ONNX Runtime бэкенд классификатора эмоций (EMOTION_BACKEND=onnx)
+Экспорт модели в ONNX (опционально с динамической int8-квантизацией) и
+классификатор с тем же контрактом, что у пайплайна transformers.
+Использование:
+    python3 emotion_onnx.py --export            (экспорт + квантизация + проверка совпадения)
+    python3 emotion_onnx.py --export --no-quantize
+    python3 emotion_onnx.py --parity
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+
+from config import EMOTION_MODEL_NAME, EMOTION_ONNX_DIR, EMOTION_ONNX_QUANTIZE, EMOTION_ONNX_THREADS
+
+logger = logging.getLogger("emotion_onnx")
+
+FP32_FILENAME = "model.onnx"
+INT8_FILENAME = "model.int8.onnx"
+
+# Порядок аргументов BertForSequenceClassification.forward
+INPUT_NAMES = ["input_ids", "attention_mask", "token_type_ids"]
+
+# Минимальная доля совпавших меток, при которой бэкенд считается эквивалентным
+PARITY_MIN_AGREEMENT = 0.95
+
+# Тексты для проверки совпадения меток с torch-пайплайном
+PARITY_TEXTS = [
+    "Я сегодня очень рад тебя видеть!",
+    "Мне так грустно, что ты уходишь.",
+    "Как ты смеешь так со мной разговаривать?!",
+    "Ого, вот это поворот, не ожидала!",
+    "Мне страшно идти туда одной ночью.",
+    "Фу, какая мерзость.",
+    "Поболтаем?",
+    "Анализируем?",
+    "Поработаем?",
+    "привет",
+    "да",
+    "Напиши сцену, где старый мельник встречает русалку у запруды.",
+    "Разбери, пожалуйста, почему у Павича время течет по кругу.",
+    "Спасибо, ты лучшая, я в восторге от этой главы!",
+    "Устал я от всего, ничего не хочется.",
+    "Ну и зачем ты опять это сделала, я же просил не трогать.",
+    "Интересно, а что было бы, если бы Мостар не сгорел?",
+    "Люблю твои ответы, они как вино из Требинье.",
+]
+
+def _model_path(model_dir, quantize):
+    return os.path.join(model_dir, INT8_FILENAME if quantize else FP32_FILENAME)
+
+def export_onnx(model_dir=EMOTION_ONNX_DIR, model_name=EMOTION_MODEL_NAME, quantize=EMOTION_ONNX_QUANTIZE):
+    """
+    Экспортирует модель в ONNX с динамическими осями (батч, длина)
+    и, если quantize, дополнительно сохраняет int8-версию.
+    Возвращает путь к модели, которую будет использовать классификатор.
+    """
+    import torch
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    os.makedirs(model_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    model.eval()
+
+    sample = tokenizer(["пример текста", "ещё один пример"], padding=True, return_tensors="pt")
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES}
+    dynamic_axes["logits"] = {0: "batch"}
+
+    fp32_path = _model_path(model_dir, quantize=False)
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in INPUT_NAMES),
+            fp32_path,
+            input_names=INPUT_NAMES,
+            output_names=["logits"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+            dynamo=False,
+        )
+    tokenizer.save_pretrained(model_dir)
+    model.config.save_pretrained(model_dir)
+    logger.info(f"Модель экспортирована в ONNX: {fp32_path}")
+
+    if not quantize:
+        return fp32_path
+
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    int8_path = _model_path(model_dir, quantize=True)
+    quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+    logger.info(f"Сохранена int8-версия модели: {int8_path}")
+    return int8_path
+
+class OnnxEmotionClassifier:
+    """
+    Классификатор на ONNX Runtime, совместимый по формату с пайплайном (top_k=None).
+    Не импортирует torch и transformers: токенизатор — из tokenizer.json через tokenizers.
+    """
+
+    def __init__(self, model_dir=EMOTION_ONNX_DIR, quantize=EMOTION_ONNX_QUANTIZE):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        options = ort.SessionOptions()
+        if EMOTION_ONNX_THREADS > 0:
+            options.intra_op_num_threads = EMOTION_ONNX_THREADS
+        self.session = ort.InferenceSession(
+            _model_path(model_dir, quantize), options, providers=["CPUExecutionProvider"]
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+        with open(os.path.join(model_dir, "config.json"), encoding="utf-8") as f:
+            config = json.load(f)
+        id2label = config["id2label"]
+        self.labels = [id2label[str(i)] for i in range(len(id2label))]
+        # Та же логика выбора функции активации, что и в TextClassificationPipeline
+        self.multi_label = config.get("problem_type") == "multi_label_classification" or len(self.labels) == 1
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(config.get("max_position_embeddings", 512))
+        self.tokenizer.enable_padding(pad_id=self.tokenizer.token_to_id("[PAD]") or 0)
+
+    def _encode(self, texts):
+        encodings = self.tokenizer.encode_batch(texts)
+        feed = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        return {name: value for name, value in feed.items() if name in self.input_names}
+
+    def _scores(self, logits):
+        if self.multi_label:
+            return 1.0 / (1.0 + np.exp(-logits))
+        shifted = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        return shifted / shifted.sum(axis=-1, keepdims=True)
+
+    def __call__(self, inputs, batch_size=None):
+        single = isinstance(inputs, str)
+        texts = [inputs] if single else list(inputs)
+        step = batch_size or len(texts) or 1
+
+        results = []
+        for start in range(0, len(texts), step):
+            logits = self.session.run(["logits"], self._encode(texts[start:start + step]))[0]
+            for row in self._scores(logits):
+                scored = [{'label': label, 'score': float(score)} for label, score in zip(self.labels, row)]
+                results.append(sorted(scored, key=lambda x: x['score'], reverse=True))
+
+        return [results[0]] if single else results
+
+def load_onnx_classifier(model_dir=EMOTION_ONNX_DIR, quantize=None):
+    """Загружает ONNX-классификатор, при отсутствии файла модели — экспортирует ее"""
+    if quantize is None:
+        quantize = EMOTION_ONNX_QUANTIZE
+    if not os.path.exists(_model_path(model_dir, quantize)):
+        logger.info("ONNX-модель не найдена, выполняем экспорт")
+        export_onnx(model_dir, quantize=quantize)
+    return OnnxEmotionClassifier(model_dir, quantize=quantize)
+
+def check_parity(onnx_classifier, torch_classifier, texts=PARITY_TEXTS):
+    """
+    Сравнивает метки ONNX-классификатора с torch-пайплайном.
+    Возвращает dict: доля совпавших меток, максимальное расхождение уверенности, расхождения.
+    """
+    onnx_results = onnx_classifier(texts)
+    torch_results = torch_classifier(texts)
+
+    mismatches = []
+    max_score_diff = 0.0
+    for text, onnx_result, torch_result in zip(texts, onnx_results, torch_results):
+        onnx_best = max(onnx_result, key=lambda x: x['score'])
+        torch_best = max(torch_result, key=lambda x: x['score'])
+        max_score_diff = max(max_score_diff, abs(onnx_best['score'] - torch_best['score']))
+        if onnx_best['label'] != torch_best['label']:
+            mismatches.append({'text': text, 'onnx': onnx_best['label'], 'torch': torch_best['label']})
+
+    return {
+        'total': len(texts),
+        'agreement': 1 - len(mismatches) / len(texts) if texts else 1.0,
+        'max_score_diff': max_score_diff,
+        'mismatches': mismatches,
+    }
+
+def print_parity(quantize):
+    from emotion_model import build_classifier
+
+    report = check_parity(build_classifier("onnx", quantize=quantize), build_classifier("torch"))
+    variant = "int8" if quantize else "fp32"
+    print(f"📋 Совпадение меток ONNX ({variant}) с torch: {report['agreement']:.1%} из {report['total']}")
+    print(f"   Максимальное расхождение уверенности: {report['max_score_diff']:.4f}")
+    for m in report['mismatches']:
+        print(f"   ⚠️ «{m['text']}»: onnx={m['onnx']}, torch={m['torch']}")
+    return report['agreement'] >= PARITY_MIN_AGREEMENT
+
+def main():
+    parser = argparse.ArgumentParser(description="ONNX-бэкенд классификатора эмоций")
+    parser.add_argument('--export', action='store_true', help='Экспортировать модель в ONNX')
+    parser.add_argument('--parity', action='store_true', help='Сравнить метки с torch-пайплайном')
+    parser.add_argument('--no-quantize', action='store_true', help='Без int8-квантизации')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s | %(name)s | %(message)s')
+    quantize = EMOTION_ONNX_QUANTIZE and not args.no_quantize
+
+    if args.export:
+        path = export_onnx(quantize=quantize)
+        print(f"✅ Модель экспортирована: {path}")
+
+    if args.export or args.parity:
+        return 0 if print_parity(quantize) else 1
+
+    parser.print_help()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,105 +1,109 @@
 import sqlite3
+import atexit
+import logging
+import threading
+import time
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List, Tuple
 
-import os
+from collections import OrderedDict, deque
 
-# Определяем путь к БД относительно текущего файла
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.db')
+from migrate_db import run_migrations
+from config import (
+    DB_REUSE_CONNECTIONS, DB_MMAP_SIZE, DB_CACHE_SIZE_KB, DB_STATEMENT_CACHE, AUTH_CACHE_TTL,
+    HISTORY_FLUSH_SIZE, HISTORY_FLUSH_INTERVAL,
+    HISTORY_CACHE_TURNS, HISTORY_CACHE_USERS, HISTORY_CACHE_IDLE, RECENT_EMOTIONS, HISTORY_DB_PATH
+)
+
+logger = logging.getLogger("history_db")
+
+# Путь к БД: по умолчанию history.db рядом с модулем (HISTORY_DB_PATH в config)
+DB_PATH = HISTORY_DB_PATH
+
+class _ReusableConnection(sqlite3.Connection):
+    """
+    Соединение, закрепленное за потоком. Функции модуля по-прежнему вызывают
+    close() после работы — здесь это лишь откат незавершенной транзакции,
+    само соединение остается открытым для следующего вызова.
+    """
+
+    def close(self):
+        if self.in_transaction:
+            self.rollback()
+
+    def close_for_real(self):
+        super().close()
+
+_local = threading.local()
+_connections_lock = threading.Lock()
+_connections: List[_ReusableConnection] = []
+
+def _open_reusable_connection():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=30,
+        factory=_ReusableConnection,
+        cached_statements=DB_STATEMENT_CACHE,
+        check_same_thread=False,  # Используется одним потоком; закрывается при остановке из главного
+    )
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE}')
+    conn.execute(f'PRAGMA cache_size=-{DB_CACHE_SIZE_KB}')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    with _connections_lock:
+        _connections.append(conn)
+    return conn
 
 def get_connection():
-    """Простая функция для получения подключения к БД"""
-    return sqlite3.connect(DB_PATH, timeout=30)
+    """
+    Подключение к БД. По умолчанию — постоянное соединение текущего потока
+    с WAL и настроенными PRAGMA; при DB_REUSE_CONNECTIONS=false — новое
+    соединение на каждый вызов, как раньше.
+    """
+    if not DB_REUSE_CONNECTIONS:
+        return sqlite3.connect(DB_PATH, timeout=30)
+
+    conn = getattr(_local, 'conn', None)
+    if conn is None:
+        conn = _open_reusable_connection()
+        _local.conn = conn
+    elif conn.in_transaction:
+        # Предыдущий вызов упал, не дойдя до commit/close
+        logger.warning("Откат незавершенной транзакции переиспользуемого соединения")
+        conn.rollback()
+    return conn
+
+def close_connections():
+    """Закрывает все постоянные соединения (при остановке бота)"""
+    with _connections_lock:
+        connections = list(_connections)
+        _connections.clear()
+    for conn in connections:
+        try:
+            conn.close_for_real()
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка при закрытии соединения с БД: {e}")
+    _local.__dict__.pop('conn', None)
+
+def get_connection_stats() -> Dict[str, Any]:
+    """Количество постоянных соединений с БД"""
+    with _connections_lock:
+        return {'reuse': DB_REUSE_CONNECTIONS, 'open_connections': len(_connections)}
 
 def init_db():
-    """Инициализация базы данных с созданием всех необходимых таблиц"""
+    """
+    Приводит схему базы к последней версии. Сама схема описана
+    миграциями в migrate_db.MIGRATIONS; на актуальной базе это
+    одна проверка номера версии.
+    """
     conn = get_connection()
-    c = conn.cursor()
-    
-    # Таблица истории сообщений (существующая)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            role TEXT,
-            content TEXT,
-            timestamp DATETIME,
-            emotion_primary TEXT,
-            emotion_confidence REAL
-        )
-    ''')
-    
-    # Таблица версий схемы БД
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS schema_version (
-            version INTEGER PRIMARY KEY
-        )
-    ''')
-    
-    # Таблица пользователей и их статусов авторизации
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            password_used TEXT,
-            is_authorized BOOLEAN DEFAULT FALSE,
-            authorized_until DATETIME,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            last_auth DATETIME,
-            warned_expiry BOOLEAN DEFAULT FALSE,
-            failed_attempts INTEGER DEFAULT 0,
-            blocked_until DATETIME
-        )
-    ''')
-    
-    # Таблица лимитов сообщений по дням
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS message_limits (
-            user_id INTEGER,
-            date TEXT,
-            count INTEGER DEFAULT 0,
-            PRIMARY KEY (user_id, date),
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Таблица временных паролей
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS passwords (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            password_text TEXT UNIQUE,
-            description TEXT,
-            is_active BOOLEAN DEFAULT TRUE,
-            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-            duration_days INTEGER,
-            times_used INTEGER DEFAULT 0
-        )
-    ''')
-    
-    # Таблица логов авторизации
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS auth_log (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            action TEXT,
-            password_masked TEXT,
-            details TEXT,
-            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
-        )
-    ''')
-    
-    # Создание индексов для оптимизации
-    c.execute('CREATE INDEX IF NOT EXISTS idx_users_authorized_until ON users(authorized_until)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_users_blocked_until ON users(blocked_until)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_message_limits_date ON message_limits(date)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_passwords_active ON passwords(is_active)')
-    c.execute('CREATE INDEX IF NOT EXISTS idx_auth_log_timestamp ON auth_log(timestamp)')
-    
-    # Устанавливаем версию схемы
-    c.execute('INSERT OR IGNORE INTO schema_version (version) VALUES (?)', (1,))
-    
-    conn.commit()
-    conn.close()
+    try:
+        applied = run_migrations(conn)
+    finally:
+        conn.close()
+    if applied:
+        logger.info(f"Схема БД обновлена до версии {applied[-1]} (применено шагов: {len(applied)})")
 
 def mask_password(password: str) -> str:
     """Маскирует пароль для логов: test123 -> te***23"""
@@ -109,93 +113,193 @@ def mask_password(password: str) -> str:
         return "*" * len(password)
     return password[:2] + "*" * (len(password) - 4) + password[-2:]
 
-def log_auth_event(user_id: int, action: str, password: Optional[str] = None, details: Optional[str] = None):
-    """Логирование событий авторизации"""
-    conn = get_connection()
-    c = conn.cursor()
-    
-    password_masked = mask_password(password) if password else None
+_SQL_INSERT_AUTH_LOG = '''
+    INSERT INTO auth_log (user_id, action, password_masked, details, timestamp)
+    VALUES (?, ?, ?, ?, ?)
+'''
+
+def log_auth_events(events: List[Tuple], cursor: Optional[sqlite3.Cursor] = None):
+    """
+    Логирование пачки событий авторизации одним executemany.
+    events: [(user_id, action, password, details)].
+    С cursor запись идет в транзакции вызывающего (commit — за ним),
+    без него — в отдельной транзакции.
+    """
+    now = datetime.utcnow()
+    rows = [
+        (user_id, action, mask_password(password) if password else None, details, now)
+        for user_id, action, password, details in events
+    ]
+    if not rows:
+        return
+    
+    conn = None
+    c = cursor
+    if c is None:
+        conn = get_connection()
+        c = conn.cursor()
     
-    c.execute('''
-        INSERT INTO auth_log (user_id, action, password_masked, details, timestamp)
-        VALUES (?, ?, ?, ?, ?)
-    ''', (user_id, action, password_masked, details, datetime.utcnow()))
+    c.executemany(_SQL_INSERT_AUTH_LOG, rows)
     
-    conn.commit()
-    conn.close()
+    if conn is not None:
+        conn.commit()
+        conn.close()
+
+def log_auth_event(user_id: int, action: str, password: Optional[str] = None, details: Optional[str] = None,
+                   cursor: Optional[sqlite3.Cursor] = None):
+    """Логирование событий авторизации (в транзакции вызывающего, если передан cursor)"""
+    log_auth_events([(user_id, action, password, details)], cursor)
+
+# === КЭШ СТАТУСА АВТОРИЗАЦИИ ===
+# Строка users в памяти процесса: авторизованным подписчикам не нужно ходить
+# в БД на каждое сообщение. Запись живет не дольше AUTH_CACHE_TTL (изменения
+# из других процессов, например manage_passwords.py) и не дольше момента
+# истечения авторизации — после него нужен поход в БД для деактивации.
+
+_auth_cache: Dict[int, Dict[str, Any]] = {}
+_auth_cache_lock = threading.Lock()
+_auth_cache_hits = 0
+_auth_cache_misses = 0
+
+def _auth_cache_put(user_id: int, row: Tuple) -> Dict[str, Any]:
+    """Кладет в кэш строку (is_authorized, authorized_until, blocked_until, failed_attempts, warned_expiry)"""
+    is_authorized, authorized_until, blocked_until, failed_attempts, warned_expiry = row
+    auth_until_dt = datetime.fromisoformat(authorized_until) if is_authorized and authorized_until else None
+    
+    valid_until = datetime.utcnow() + timedelta(seconds=AUTH_CACHE_TTL)
+    if auth_until_dt and auth_until_dt < valid_until:
+        valid_until = auth_until_dt
+    
+    entry = {
+        'is_authorized': bool(is_authorized),
+        'authorized_until': authorized_until,
+        'auth_until_dt': auth_until_dt,
+        'blocked_until': blocked_until,
+        'blocked_until_dt': datetime.fromisoformat(blocked_until) if blocked_until else None,
+        'failed_attempts': failed_attempts,
+        'warned_expiry': warned_expiry,
+        'valid_until': valid_until
+    }
+    if AUTH_CACHE_TTL > 0:
+        with _auth_cache_lock:
+            _auth_cache[user_id] = entry
+    return entry
+
+def _auth_cache_get(user_id: int) -> Optional[Dict[str, Any]]:
+    global _auth_cache_hits, _auth_cache_misses
+    with _auth_cache_lock:
+        entry = _auth_cache.get(user_id)
+        if entry is not None and entry['valid_until'] <= datetime.utcnow():
+            del _auth_cache[user_id]
+            entry = None
+        if entry is None:
+            _auth_cache_misses += 1
+        else:
+            _auth_cache_hits += 1
+        return entry
+
+def invalidate_auth_cache(user_id: Optional[int] = None):
+    """Сброс кэша авторизации для пользователя (или целиком, если user_id не указан)"""
+    with _auth_cache_lock:
+        if user_id is None:
+            _auth_cache.clear()
+        else:
+            _auth_cache.pop(user_id, None)
+
+def get_auth_cache_stats() -> Dict[str, Any]:
+    with _auth_cache_lock:
+        total = _auth_cache_hits + _auth_cache_misses
+        return {
+            'size': len(_auth_cache),
+            'hits': _auth_cache_hits,
+            'misses': _auth_cache_misses,
+            'hit_ratio': _auth_cache_hits / total if total else 0.0
+        }
+
+# Строка users для кэша авторизации и ее снятие по истечении (check_user_auth_status, check_access)
+_SQL_SELECT_USER_AUTH = '''
+    SELECT is_authorized, authorized_until, blocked_until, failed_attempts, warned_expiry
+    FROM users WHERE user_id = ?
+'''
+_SQL_EXPIRE_USER = '''
+    UPDATE users SET is_authorized = FALSE, warned_expiry = FALSE
+    WHERE user_id = ?
+'''
+_SQL_SELECT_USER_EXISTS = 'SELECT user_id FROM users WHERE user_id = ?'
+_SQL_INSERT_USER = '''
+    INSERT INTO users (user_id, is_authorized, created_at)
+    VALUES (?, FALSE, ?)
+'''
 
 def ensure_user_exists(user_id: int):
     """Создает пользователя в БД, если его нет"""
     conn = get_connection()
     c = conn.cursor()
     
-    c.execute('SELECT user_id FROM users WHERE user_id = ?', (user_id,))
+    c.execute(_SQL_SELECT_USER_EXISTS, (user_id,))
     if not c.fetchone():
-        c.execute('''
-            INSERT INTO users (user_id, is_authorized, created_at)
-            VALUES (?, FALSE, ?)
-        ''', (user_id, datetime.utcnow()))
+        c.execute(_SQL_INSERT_USER, (user_id, datetime.utcnow()))
         conn.commit()
     
     conn.close()
 
 def check_user_auth_status(user_id: int) -> Dict[str, Any]:
     """Проверка статуса авторизации пользователя"""
-    ensure_user_exists(user_id)
-    
-    conn = get_connection()
-    c = conn.cursor()
-    
-    c.execute('''
-        SELECT is_authorized, authorized_until, blocked_until, failed_attempts, warned_expiry
-        FROM users WHERE user_id = ?
-    ''', (user_id,))
-    
-    row = c.fetchone()
-    conn.close()
-    
-    if not row:
-        return {'authorized': False, 'blocked': False, 'expired': False}
-    
-    is_authorized, authorized_until, blocked_until, failed_attempts, warned_expiry = row
+    entry = _auth_cache_get(user_id)
+
+    if entry is None:
+        ensure_user_exists(user_id)
+
+        conn = get_connection()
+        c = conn.cursor()
+
+        c.execute(_SQL_SELECT_USER_AUTH, (user_id,))
+
+        row = c.fetchone()
+        conn.close()
+
+        if not row:
+            return {'authorized': False, 'blocked': False, 'expired': False}
+
+        entry = _auth_cache_put(user_id, row)
+
+    authorized_until = entry['authorized_until']
     now = datetime.utcnow()
-    
+
     # Проверка блокировки
-    if blocked_until and datetime.fromisoformat(blocked_until) > now:
+    if entry['blocked_until_dt'] and entry['blocked_until_dt'] > now:
         return {
             'authorized': False,
             'blocked': True,
-            'blocked_until': blocked_until,
-            'failed_attempts': failed_attempts
+            'blocked_until': entry['blocked_until'],
+            'failed_attempts': entry['failed_attempts']
         }
-    
+
     # Проверка истечения авторизации
-    if is_authorized and authorized_until:
-        auth_until = datetime.fromisoformat(authorized_until)
-        if auth_until <= now:
+    if entry['is_authorized'] and authorized_until:
+        if entry['auth_until_dt'] <= now:
             # Авторизация истекла - деактивируем
             conn = get_connection()
             c = conn.cursor()
-            c.execute('''
-                UPDATE users SET is_authorized = FALSE, warned_expiry = FALSE
-                WHERE user_id = ?
-            ''', (user_id,))
+            c.execute(_SQL_EXPIRE_USER, (user_id,))
+            log_auth_event(user_id, 'auto_expired', details=f'Авторизация истекла: {authorized_until}', cursor=c)
             conn.commit()
             conn.close()
-            
-            log_auth_event(user_id, 'auto_expired', details=f'Авторизация истекла: {authorized_until}')
-            
+            invalidate_auth_cache(user_id)
+
             return {'authorized': False, 'blocked': False, 'expired': True}
-        
+
         return {
             'authorized': True,
             'blocked': False,
             'authorized_until': authorized_until,
-            'warned_expiry': warned_expiry
+            'warned_expiry': entry['warned_expiry']
         }
     
     return {'authorized': False, 'blocked': False, 'expired': False}
 
+_SQL_SELECT_DAILY_COUNT = 'SELECT count FROM message_limits WHERE user_id = ? AND date = ?'
+
 def check_daily_limit(user_id: int) -> Dict[str, Any]:
     """Проверка суточного лимита сообщений"""
     ensure_user_exists(user_id)
@@ -205,10 +309,7 @@ def check_daily_limit(user_id: int) -> Dict[str, Any]:
     conn = get_connection()
     c = conn.cursor()
     
-    c.execute('''
-        SELECT count FROM message_limits 
-        WHERE user_id = ? AND date = ?
-    ''', (user_id, today))
+    c.execute(_SQL_SELECT_DAILY_COUNT, (user_id, today))
     
     row = c.fetchone()
     current_count = row[0] if row else 0
@@ -224,6 +325,12 @@ def check_daily_limit(user_id: int) -> Dict[str, Any]:
         'exceeded': current_count >= DAILY_MESSAGE_LIMIT
     }
 
+# Используем INSERT OR REPLACE для atomic upsert
+_SQL_INCREMENT_DAILY_COUNT = '''
+    INSERT OR REPLACE INTO message_limits (user_id, date, count)
+    VALUES (?, ?, COALESCE((SELECT count FROM message_limits WHERE user_id = ? AND date = ?), 0) + 1)
+'''
+
 def increment_message_count(user_id: int) -> int:
     """Увеличивает счетчик сообщений на 1, возвращает новое значение"""
     today = datetime.utcnow().date().isoformat()
@@ -231,14 +338,10 @@ def increment_message_count(user_id: int) -> int:
     conn = get_connection()
     c = conn.cursor()
     
-    # Используем INSERT OR REPLACE для atomic upsert
-    c.execute('''
-        INSERT OR REPLACE INTO message_limits (user_id, date, count)
-        VALUES (?, ?, COALESCE((SELECT count FROM message_limits WHERE user_id = ? AND date = ?), 0) + 1)
-    ''', (user_id, today, user_id, today))
+    c.execute(_SQL_INCREMENT_DAILY_COUNT, (user_id, today, user_id, today))
     
     # Получаем новое значение
-    c.execute('SELECT count FROM message_limits WHERE user_id = ? AND date = ?', (user_id, today))
+    c.execute(_SQL_SELECT_DAILY_COUNT, (user_id, today))
     new_count = c.fetchone()[0]
     
     conn.commit()
@@ -263,6 +366,143 @@ def check_bruteforce_protection(user_id: int) -> Dict[str, Any]:
     
     return {'blocked': False}
 
+def _privileged_access_decision(entry: Dict[str, Any], now: datetime) -> Optional[Dict[str, Any]]:
+    """Решение для заблокированного или авторизованного пользователя; None — нужна проверка лимита"""
+    if entry['blocked_until_dt'] and entry['blocked_until_dt'] > now:
+        remaining = entry['blocked_until_dt'] - now
+        return {
+            'allowed': False,
+            'reason': 'blocked',
+            'remaining_seconds': max(0, int(remaining.total_seconds())),
+            'failed_attempts': entry['failed_attempts']
+        }
+    
+    if entry['is_authorized'] and entry['auth_until_dt'] and entry['auth_until_dt'] > now:
+        return {
+            'allowed': True,
+            'reason': 'authorized',
+            'authorized_until': entry['authorized_until'],
+            'warned_expiry': entry['warned_expiry']
+        }
+    
+    return None
+
+_SQL_UPSERT_USER = '''
+    INSERT INTO users (user_id, is_authorized, created_at)
+    VALUES (?, FALSE, ?)
+    ON CONFLICT(user_id) DO NOTHING
+'''
+# Счетчик увеличивается, только если лимит еще не исчерпан;
+# при исчерпанном лимите RETURNING не возвращает строк
+_SQL_CONSUME_DAILY_LIMIT = '''
+    INSERT INTO message_limits (user_id, date, count) VALUES (?, ?, 1)
+    ON CONFLICT(user_id, date) DO UPDATE SET count = count + 1
+    WHERE count < ?
+    RETURNING count
+'''
+
+def check_access(user_id: int) -> Dict[str, Any]:
+    """
+    Единая проверка доступа для каждого входящего сообщения за одну транзакцию:
+    создание пользователя, блокировка, авторизация (со снятием истекшей)
+    и атомарная проверка с увеличением суточного счетчика.
+    Возвращает решение: {'allowed': bool, 'reason': ...}, где reason —
+    'blocked', 'authorized', 'demo' или 'limit_exceeded'.
+    """
+    from config import DAILY_MESSAGE_LIMIT
+    
+    now = datetime.utcnow()
+    today = now.date().isoformat()
+    
+    # Заблокированным и авторизованным из кэша БД не нужна вовсе
+    entry = _auth_cache_get(user_id)
+    if entry is not None:
+        decision = _privileged_access_decision(entry, now)
+        if decision:
+            return decision
+    
+    conn = get_connection()
+    c = conn.cursor()
+    expired_until = None
+    
+    try:
+        # Сразу берем блокировку на запись: счетчик изменится в этой же транзакции
+        c.execute('BEGIN IMMEDIATE')
+        
+        c.execute(_SQL_UPSERT_USER, (user_id, now))
+        
+        c.execute(_SQL_SELECT_USER_AUTH, (user_id,))
+        entry = _auth_cache_put(user_id, c.fetchone())
+        
+        # Блокировка от bruteforce или действующая авторизация — лимиты не считаем
+        decision = _privileged_access_decision(entry, now)
+        if decision:
+            conn.commit()
+            return decision
+        
+        if entry['is_authorized'] and entry['authorized_until']:
+            # Авторизация истекла - деактивируем и проверяем как демо-пользователя
+            c.execute(_SQL_EXPIRE_USER, (user_id,))
+            expired_until = entry['authorized_until']
+            log_auth_event(user_id, 'auto_expired', details=f'Авторизация истекла: {expired_until}', cursor=c)
+        
+        new_count = None
+        if DAILY_MESSAGE_LIMIT > 0:
+            c.execute(_SQL_CONSUME_DAILY_LIMIT, (user_id, today, DAILY_MESSAGE_LIMIT))
+            rows = c.fetchall()
+            new_count = rows[0][0] if rows else None
+        
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    
+    if expired_until:
+        invalidate_auth_cache(user_id)
+    
+    if new_count is None:
+        return {
+            'allowed': False,
+            'reason': 'limit_exceeded',
+            'count': DAILY_MESSAGE_LIMIT,
+            'limit': DAILY_MESSAGE_LIMIT,
+            'remaining': 0,
+            'expired': expired_until is not None
+        }
+    
+    return {
+        'allowed': True,
+        'reason': 'demo',
+        'count': new_count,
+        'limit': DAILY_MESSAGE_LIMIT,
+        'remaining': max(0, DAILY_MESSAGE_LIMIT - new_count),
+        'expired': expired_until is not None
+    }
+
+_SQL_SELECT_ACTIVE_PASSWORD = 'SELECT duration_days FROM passwords WHERE password_text = ? AND is_active = TRUE'
+_SQL_AUTHORIZE_USER = '''
+    UPDATE users SET 
+        is_authorized = TRUE,
+        authorized_until = ?,
+        password_used = ?,
+        last_auth = ?,
+        failed_attempts = 0,
+        blocked_until = NULL,
+        warned_expiry = FALSE
+    WHERE user_id = ?
+'''
+_SQL_COUNT_PASSWORD_USE = 'UPDATE passwords SET times_used = times_used + 1 WHERE password_text = ?'
+_SQL_SELECT_FAILED_ATTEMPTS = 'SELECT failed_attempts FROM users WHERE user_id = ?'
+_SQL_BLOCK_USER = '''
+    UPDATE users SET 
+        failed_attempts = ?,
+        blocked_until = ?
+    WHERE user_id = ?
+'''
+_SQL_SET_FAILED_ATTEMPTS = 'UPDATE users SET failed_attempts = ? WHERE user_id = ?'
+
 def process_password_attempt(user_id: int, password: str) -> Dict[str, Any]:
     """Обработка попытки ввода пароля - УПРОЩЕННАЯ ВЕРСИЯ"""
     from config import MAX_PASSWORD_ATTEMPTS, BRUTEFORCE_TIMEOUT
@@ -275,7 +515,7 @@ def process_password_attempt(user_id: int, password: str) -> Dict[str, Any]:
     c = conn.cursor()
     
     # Проверяем существование и активность пароля
-    c.execute('SELECT duration_days FROM passwords WHERE password_text = ? AND is_active = TRUE', (password,))
+    c.execute(_SQL_SELECT_ACTIVE_PASSWORD, (password,))
     password_row = c.fetchone()
     
     if password_row:
@@ -284,25 +524,15 @@ def process_password_attempt(user_id: int, password: str) -> Dict[str, Any]:
         authorized_until = datetime.utcnow() + timedelta(days=duration_days)
         
         # Обновляем пользователя
-        c.execute('''
-            UPDATE users SET 
-                is_authorized = TRUE,
-                authorized_until = ?,
-                password_used = ?,
-                last_auth = ?,
-                failed_attempts = 0,
-                blocked_until = NULL,
-                warned_expiry = FALSE
-            WHERE user_id = ?
-        ''', (authorized_until.isoformat(), password, datetime.utcnow().isoformat(), user_id))
+        c.execute(_SQL_AUTHORIZE_USER, (authorized_until.isoformat(), password, datetime.utcnow().isoformat(), user_id))
         
         # Увеличиваем счетчик использований пароля
-        c.execute('UPDATE passwords SET times_used = times_used + 1 WHERE password_text = ?', (password,))
+        c.execute(_SQL_COUNT_PASSWORD_USE, (password,))
+        log_auth_event(user_id, 'password_success', password, f'Авторизован на {duration_days} дней', cursor=c)
         
         conn.commit()
         conn.close()
-        
-        log_auth_event(user_id, 'password_success', password, f'Авторизован на {duration_days} дней')
+        invalidate_auth_cache(user_id)
         
         return {
             'success': True,
@@ -312,7 +542,7 @@ def process_password_attempt(user_id: int, password: str) -> Dict[str, Any]:
     else:
         # Пароль неправильный
         # Получаем текущие попытки
-        c.execute('SELECT failed_attempts FROM users WHERE user_id = ?', (user_id,))
+        c.execute(_SQL_SELECT_FAILED_ATTEMPTS, (user_id,))
         row = c.fetchone()
         current_attempts = row[0] if row and row[0] else 0
         new_attempts = current_attempts + 1
@@ -320,17 +550,12 @@ def process_password_attempt(user_id: int, password: str) -> Dict[str, Any]:
         if new_attempts >= MAX_PASSWORD_ATTEMPTS:
             # Блокируем пользователя
             blocked_until = datetime.utcnow() + timedelta(seconds=BRUTEFORCE_TIMEOUT)
-            c.execute('''
-                UPDATE users SET 
-                    failed_attempts = ?,
-                    blocked_until = ?
-                WHERE user_id = ?
-            ''', (new_attempts, blocked_until.isoformat(), user_id))
+            c.execute(_SQL_BLOCK_USER, (new_attempts, blocked_until.isoformat(), user_id))
+            log_auth_event(user_id, 'blocked', password, f'Заблокирован на {BRUTEFORCE_TIMEOUT} секунд', cursor=c)
             
             conn.commit()
             conn.close()
-            
-            log_auth_event(user_id, 'blocked', password, f'Заблокирован на {BRUTEFORCE_TIMEOUT} секунд')
+            invalidate_auth_cache(user_id)
             
             return {
                 'success': False,
@@ -340,12 +565,12 @@ def process_password_attempt(user_id: int, password: str) -> Dict[str, Any]:
             }
         else:
             # Увеличиваем счетчик попыток
-            c.execute('UPDATE users SET failed_attempts = ? WHERE user_id = ?', (new_attempts, user_id))
+            c.execute(_SQL_SET_FAILED_ATTEMPTS, (new_attempts, user_id))
+            log_auth_event(user_id, 'password_fail', password, f'Попытка {new_attempts}/{MAX_PASSWORD_ATTEMPTS}', cursor=c)
             
             conn.commit()
             conn.close()
-            
-            log_auth_event(user_id, 'password_fail', password, f'Попытка {new_attempts}/{MAX_PASSWORD_ATTEMPTS}')
+            invalidate_auth_cache(user_id)
             
             return {
                 'success': False,
@@ -355,6 +580,11 @@ def process_password_attempt(user_id: int, password: str) -> Dict[str, Any]:
 
 # === АДМИНИСТРАТИВНЫЕ ФУНКЦИИ ===
 
+_SQL_INSERT_PASSWORD = '''
+    INSERT INTO passwords (password_text, description, duration_days, created_at)
+    VALUES (?, ?, ?, ?)
+'''
+
 def add_password(password: str, description: str, duration_days: int) -> bool:
     """Добавление временного пароля"""
     from config import AVAILABLE_DURATIONS
@@ -366,10 +596,7 @@ def add_password(password: str, description: str, duration_days: int) -> bool:
     c = conn.cursor()
     
     try:
-        c.execute('''
-            INSERT INTO passwords (password_text, description, duration_days, created_at)
-            VALUES (?, ?, ?, ?)
-        ''', (password, description, duration_days, datetime.utcnow().isoformat()))
+        c.execute(_SQL_INSERT_PASSWORD, (password, description, duration_days, datetime.utcnow().isoformat()))
         conn.commit()
         conn.close()
         return True
@@ -377,31 +604,35 @@ def add_password(password: str, description: str, duration_days: int) -> bool:
         conn.close()
         return False  # Пароль уже существует
 
+_SQL_DEACTIVATE_PASSWORD = 'UPDATE passwords SET is_active = FALSE WHERE password_text = ?'
+
 def deactivate_password(password: str) -> bool:
     """Деактивация пароля"""
     conn = get_connection()
     c = conn.cursor()
     
-    c.execute('UPDATE passwords SET is_active = FALSE WHERE password_text = ?', (password,))
+    c.execute(_SQL_DEACTIVATE_PASSWORD, (password,))
     success = c.rowcount > 0
     
+    if success:
+        log_auth_event(0, 'password_deactivated', password, 'Деактивирован администратором', cursor=c)
+    
     conn.commit()
     conn.close()
     
-    if success:
-        log_auth_event(0, 'password_deactivated', password, 'Деактивирован администратором')
-    
     return success
 
+_SQL_LIST_PASSWORDS = '''
+    SELECT password_text, description, is_active, created_at, duration_days, times_used
+    FROM passwords ORDER BY created_at DESC
+'''
+
 def list_passwords(show_full: bool = False) -> List[Dict[str, Any]]:
     """Список всех паролей с информацией"""
     conn = get_connection()
     c = conn.cursor()
     
-    c.execute('''
-        SELECT password_text, description, is_active, created_at, duration_days, times_used
-        FROM passwords ORDER BY created_at DESC
-    ''')
+    c.execute(_SQL_LIST_PASSWORDS)
     
     passwords = []
     for row in c.fetchall():
@@ -419,25 +650,30 @@ def list_passwords(show_full: bool = False) -> List[Dict[str, Any]]:
     conn.close()
     return passwords
 
+_SQL_COUNT_ACTIVE_PASSWORDS = 'SELECT COUNT(*) FROM passwords WHERE is_active = TRUE'
+_SQL_COUNT_INACTIVE_PASSWORDS = 'SELECT COUNT(*) FROM passwords WHERE is_active = FALSE'
+_SQL_SUM_PASSWORD_USES = 'SELECT SUM(times_used) FROM passwords'
+_SQL_PASSWORDS_BY_DURATION = '''
+    SELECT duration_days, COUNT(*) 
+    FROM passwords WHERE is_active = TRUE 
+    GROUP BY duration_days ORDER BY duration_days
+'''
+
 def get_password_stats() -> Dict[str, Any]:
     """Статистика по паролям"""
     conn = get_connection()
     c = conn.cursor()
     
-    c.execute('SELECT COUNT(*) FROM passwords WHERE is_active = TRUE')
+    c.execute(_SQL_COUNT_ACTIVE_PASSWORDS)
     active_count = c.fetchone()[0]
     
-    c.execute('SELECT COUNT(*) FROM passwords WHERE is_active = FALSE')
+    c.execute(_SQL_COUNT_INACTIVE_PASSWORDS)
     inactive_count = c.fetchone()[0]
     
-    c.execute('SELECT SUM(times_used) FROM passwords')
+    c.execute(_SQL_SUM_PASSWORD_USES)
     total_uses = c.fetchone()[0] or 0
     
-    c.execute('''
-        SELECT duration_days, COUNT(*) 
-        FROM passwords WHERE is_active = TRUE 
-        GROUP BY duration_days ORDER BY duration_days
-    ''')
+    c.execute(_SQL_PASSWORDS_BY_DURATION)
     
     by_duration = {row[0]: row[1] for row in c.fetchall()}
     
@@ -450,16 +686,19 @@ def get_password_stats() -> Dict[str, Any]:
         'by_duration': by_duration
     }
 
+_SQL_SELECT_USER_INFO = '''
+    SELECT created_at, last_auth, password_used, failed_attempts, warned_expiry
+    FROM users WHERE user_id = ?
+'''
+_SQL_COUNT_USER_HISTORY = 'SELECT COUNT(*), (SELECT MAX(id) FROM history) FROM history WHERE user_id = ?'
+
 def get_user_stats(user_id: int) -> Dict[str, Any]:
     """Статистика пользователя"""
     conn = get_connection()
     c = conn.cursor()
     
     # Основная информация о пользователе
-    c.execute('''
-        SELECT created_at, last_auth, password_used, failed_attempts, warned_expiry
-        FROM users WHERE user_id = ?
-    ''', (user_id,))
+    c.execute(_SQL_SELECT_USER_INFO, (user_id,))
     
     user_row = c.fetchone()
     
@@ -470,13 +709,13 @@ def get_user_stats(user_id: int) -> Dict[str, Any]:
     
     # Счетчик сообщений за сегодня
     today = datetime.utcnow().date().isoformat()
-    c.execute('SELECT count FROM message_limits WHERE user_id = ? AND date = ?', (user_id, today))
+    c.execute(_SQL_SELECT_DAILY_COUNT, (user_id, today))
     today_messages = c.fetchone()
     today_count = today_messages[0] if today_messages else 0
     
-    # Общее количество сообщений в истории
-    c.execute('SELECT COUNT(*) FROM history WHERE user_id = ?', (user_id,))
-    total_messages = c.fetchone()[0]
+    # Общее количество сообщений в истории (вместе с буфером)
+    rows, pending, _ = _query_with_pending(c, user_id, _SQL_COUNT_USER_HISTORY, (user_id,))
+    total_messages = rows[0][0] + len(pending)
     
     conn.close()
     
@@ -491,22 +730,25 @@ def get_user_stats(user_id: int) -> Dict[str, Any]:
         'total_messages': total_messages
     }
 
+_SQL_USER_AUTH_LOG = '''
+    SELECT user_id, action, password_masked, details, timestamp
+    FROM auth_log WHERE user_id = ?
+    ORDER BY timestamp DESC LIMIT ?
+'''
+_SQL_AUTH_LOG = '''
+    SELECT user_id, action, password_masked, details, timestamp
+    FROM auth_log ORDER BY timestamp DESC LIMIT ?
+'''
+
 def get_auth_log(user_id: Optional[int] = None, limit: int = 50) -> List[Dict[str, Any]]:
     """Просмотр логов авторизации"""
     conn = get_connection()
     c = conn.cursor()
     
     if user_id:
-        c.execute('''
-            SELECT user_id, action, password_masked, details, timestamp
-            FROM auth_log WHERE user_id = ?
-            ORDER BY timestamp DESC LIMIT ?
-        ''', (user_id, limit))
+        c.execute(_SQL_USER_AUTH_LOG, (user_id, limit))
     else:
-        c.execute('''
-            SELECT user_id, action, password_masked, details, timestamp
-            FROM auth_log ORDER BY timestamp DESC LIMIT ?
-        ''', (limit,))
+        c.execute(_SQL_AUTH_LOG, (limit,))
     
     logs = []
     for row in c.fetchall():
@@ -522,18 +764,20 @@ def get_auth_log(user_id: Optional[int] = None, limit: int = 50) -> List[Dict[st
     conn.close()
     return logs
 
+_SQL_BLOCKED_USERS = '''
+    SELECT user_id, blocked_until, failed_attempts
+    FROM users 
+    WHERE blocked_until IS NOT NULL AND blocked_until > ?
+    ORDER BY blocked_until DESC
+'''
+
 def get_blocked_users() -> List[Dict[str, Any]]:
     """Список заблокированных пользователей"""
     conn = get_connection()
     c = conn.cursor()
     
     now = datetime.utcnow().isoformat()
-    c.execute('''
-        SELECT user_id, blocked_until, failed_attempts
-        FROM users 
-        WHERE blocked_until IS NOT NULL AND blocked_until > ?
-        ORDER BY blocked_until DESC
-    ''', (now,))
+    c.execute(_SQL_BLOCKED_USERS, (now,))
     
     blocked = []
     for row in c.fetchall():
@@ -550,26 +794,31 @@ def get_blocked_users() -> List[Dict[str, Any]]:
     conn.close()
     return blocked
 
+_SQL_UNBLOCK_USER = '''
+    UPDATE users SET blocked_until = NULL, failed_attempts = 0
+    WHERE user_id = ? AND blocked_until IS NOT NULL
+'''
+
 def unblock_user(user_id: int) -> bool:
     """Разблокировка пользователя вручную"""
     conn = get_connection()
     c = conn.cursor()
     
-    c.execute('''
-        UPDATE users SET blocked_until = NULL, failed_attempts = 0
-        WHERE user_id = ? AND blocked_until IS NOT NULL
-    ''', (user_id,))
+    c.execute(_SQL_UNBLOCK_USER, (user_id,))
     
     success = c.rowcount > 0
     
+    if success:
+        log_auth_event(user_id, 'unblocked', details='Разблокирован администратором', cursor=c)
+    
     conn.commit()
     conn.close()
-    
-    if success:
-        log_auth_event(user_id, 'unblocked', details='Разблокирован администратором')
+    invalidate_auth_cache(user_id)
     
     return success
 
+_SQL_DELETE_OLD_LIMITS = 'DELETE FROM message_limits WHERE date < ?'
+
 def cleanup_old_limits(days_keep: Optional[int] = None):
     """Очистка старых записей лимитов"""
     if days_keep is None:
@@ -581,7 +830,7 @@ def cleanup_old_limits(days_keep: Optional[int] = None):
     conn = get_connection()
     c = conn.cursor()
     
-    c.execute('DELETE FROM message_limits WHERE date < ?', (cutoff_date,))
+    c.execute(_SQL_DELETE_OLD_LIMITS, (cutoff_date,))
     deleted_count = c.rowcount
     
     conn.commit()
@@ -589,6 +838,15 @@ def cleanup_old_limits(days_keep: Optional[int] = None):
     
     return deleted_count
 
+_SQL_SELECT_EXPIRED_USERS = '''
+    SELECT user_id, authorized_until FROM users 
+    WHERE is_authorized = TRUE AND authorized_until <= ?
+'''
+_SQL_EXPIRE_USERS = '''
+    UPDATE users SET is_authorized = FALSE, warned_expiry = FALSE
+    WHERE is_authorized = TRUE AND authorized_until <= ?
+'''
+
 def cleanup_expired_users():
     """Очистка просроченных авторизаций"""
     now = datetime.utcnow().isoformat()
@@ -597,69 +855,560 @@ def cleanup_expired_users():
     c = conn.cursor()
     
     # Находим просроченных пользователей для логирования
-    c.execute('''
-        SELECT user_id, authorized_until FROM users 
-        WHERE is_authorized = TRUE AND authorized_until <= ?
-    ''', (now,))
+    c.execute(_SQL_SELECT_EXPIRED_USERS, (now,))
     
     expired_users = c.fetchall()
     
     # Деактивируем их
-    c.execute('''
-        UPDATE users SET is_authorized = FALSE, warned_expiry = FALSE
-        WHERE is_authorized = TRUE AND authorized_until <= ?
-    ''', (now,))
+    c.execute(_SQL_EXPIRE_USERS, (now,))
+    
+    # Логируем деактивацию в той же транзакции, одной пачкой
+    log_auth_events([
+        (user_id, 'auto_expired', None, f'Авторизация истекла: {authorized_until}')
+        for user_id, authorized_until in expired_users
+    ], cursor=c)
     
     conn.commit()
     conn.close()
     
-    # Логируем деактивацию
-    for user_id, authorized_until in expired_users:
-        log_auth_event(user_id, 'auto_expired', details=f'Авторизация истекла: {authorized_until}')
+    for user_id, _ in expired_users:
+        invalidate_auth_cache(user_id)
     
     return len(expired_users)
 
-def add_message(user_id, role, content, emotion_primary=None, emotion_confidence=None):
-    """Добавление сообщения в историю (расширенная версия)"""
+# === БУФЕР ЗАПИСИ ИСТОРИИ ===
+
+# Строки истории копятся в памяти и записываются одной транзакцией
+# (executemany) по порогу размера или времени. Пишет в базу только поток,
+# вызывающий add_message/flush_history (в боте — поток-писатель db_async).
+# _history_lock защищает только списки в памяти: запись и чтение идут без него.
+# Пачка на время записи лежит в _history_flushing; id ее первой строки
+# известен до commit, и читатель, чей запрос уже видит пачку в базе
+# (MAX(id) в том же запросе), не считает ее строки второй раз
+# (_query_with_pending).
+_history_buffer: List[tuple] = []
+_history_flushing: List[tuple] = []  # Пачка, которая сейчас пишется в базу
+_history_flushing_first_id: Optional[int] = None  # id ее первой строки (после вставки, до commit)
+_history_lock = threading.Lock()
+_history_flush_lock = threading.Lock()  # Пачки пишутся по одной
+_history_appended = 0  # Номер последней строки add_message: метка снимка для загрузки буфера реплик
+_history_oldest = 0.0  # time.monotonic() первой строки в буфере
+_history_flushes = 0
+_history_rows_flushed = 0
+
+_SQL_INSERT_HISTORY = '''
+    INSERT INTO history (user_id, role, content, timestamp, emotion_primary, emotion_confidence)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+def _write_history_rows(rows):
+    global _history_flushing_first_id
     conn = get_connection()
     c = conn.cursor()
-    c.execute('''
-        INSERT INTO history (user_id, role, content, timestamp, emotion_primary, emotion_confidence)
-        VALUES (?, ?, ?, ?, ?, ?)
-    ''', (user_id, role, content, datetime.utcnow(), emotion_primary, emotion_confidence))
-    conn.commit()
+    try:
+        c.executemany(_SQL_INSERT_HISTORY, rows)
+        # Пачка вставлена одной транзакцией единственного писателя — id подряд
+        c.execute('SELECT last_insert_rowid()')
+        last_id = c.fetchone()[0]
+        with _history_lock:
+            _history_flushing_first_id = last_id - len(rows) + 1
+        conn.commit()
+    finally:
+        conn.close()
+
+def flush_history() -> int:
+    """
+    Записывает буфер истории в базу (попутно и буфер учета запросов к LLM).
+    Возвращает число записанных строк истории.
+    """
+    global _history_buffer, _history_flushing, _history_flushing_first_id
+    global _history_flushes, _history_rows_flushed
+    flush_llm_usage()
+    with _history_flush_lock:
+        with _history_lock:
+            if not _history_buffer:
+                return 0
+            rows = _history_flushing = _history_buffer
+            _history_buffer = []
+        try:
+            _write_history_rows(rows)
+        except Exception:
+            with _history_lock:
+                _history_buffer[:0] = rows  # Повторим при следующей записи
+                _history_flushing = []
+                _history_flushing_first_id = None
+            raise
+        with _history_lock:
+            _history_flushing = []
+            _history_flushing_first_id = None
+            _history_flushes += 1
+            _history_rows_flushed += len(rows)
+    return len(rows)
+
+def _buffered_history(user_id, visible_id=0):
+    """
+    Строки пользователя, еще не видные запросу, который видел историю
+    до id visible_id включительно: часть записываемой пачки и буфер (под _history_lock)
+    """
+    pending = []
+    first_id = _history_flushing_first_id
+    for i, row in enumerate(_history_flushing):
+        if row[0] == user_id and (first_id is None or first_id + i > visible_id):
+            pending.append(row)
+    pending.extend(row for row in _history_buffer if row[0] == user_id)
+    return pending
+
+def _query_with_pending(c, user_id, sql, params):
+    """
+    Запрос к history (последний столбец — MAX(id) в его снимке) вместе со
+    строками пользователя, которых в снимке нет, и номером последней учтенной
+    строки add_message. Запрос идет без _history_lock; если за это время пачка
+    успела записаться и покинуть _history_flushing, он повторяется
+    """
+    while True:
+        with _history_lock:
+            flushes = _history_flushes
+        c.execute(sql, params)
+        rows = c.fetchall()
+        visible_id = (rows[0][-1] or 0) if rows else 0  # Нет строк — нет и строк пачки в снимке
+        with _history_lock:
+            if _history_flushes == flushes:
+                return rows, _buffered_history(user_id, visible_id), _history_appended
+
+def get_history_buffer_stats() -> Dict[str, Any]:
+    """Состояние буфера истории: ожидающие строки и средний размер пачки"""
+    with _history_lock:
+        return {
+            'pending': len(_history_buffer) + len(_history_flushing),
+            'flushes': _history_flushes,
+            'rows_flushed': _history_rows_flushed,
+            'avg_batch': _history_rows_flushed / _history_flushes if _history_flushes else 0.0,
+        }
+
+# Скрипты без цикла бота тоже не должны терять хвост буфера
+atexit.register(flush_history)
+
+# === УЧЕТ ЗАПРОСОВ К LLM ===
+# Каждый вызов DeepSeek (режим, пользователь, токены, HTTP-статус, время до
+# первого байта и до конца) пишется в llm_usage. record_llm_usage вызывается
+# из event loop, поэтому только кладет строку в буфер; в базу он уходит
+# вместе с буфером истории (flush_history, поток-писатель).
+
+_usage_buffer: List[tuple] = []
+_usage_lock = threading.Lock()
+
+def record_llm_usage(user_id, mode, usage=None, status=None, error=None, stream=False,
+                     ttfb_ms=None, total_ms=None):
+    """Ставит в очередь на запись одну строку учета запроса к DeepSeek"""
+    usage = usage or {}
+    row = (
+        user_id, mode,
+        usage.get('prompt_tokens'), usage.get('completion_tokens'),
+        usage.get('prompt_cache_hit_tokens'), usage.get('prompt_cache_miss_tokens'),
+        status, error, stream, ttfb_ms, total_ms, datetime.utcnow().isoformat()
+    )
+    with _usage_lock:
+        _usage_buffer.append(row)
+
+_SQL_INSERT_LLM_USAGE = '''
+    INSERT INTO llm_usage (
+        user_id, mode, prompt_tokens, completion_tokens, cache_hit_tokens, cache_miss_tokens,
+        status, error, stream, ttfb_ms, total_ms, created_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+'''
+
+def flush_llm_usage() -> int:
+    """Записывает буфер учета запросов к LLM одной транзакцией"""
+    global _usage_buffer
+    with _usage_lock:
+        rows, _usage_buffer = _usage_buffer, []
+    if not rows:
+        return 0
+    try:
+        conn = get_connection()
+        c = conn.cursor()
+        c.executemany(_SQL_INSERT_LLM_USAGE, rows)
+        conn.commit()
+        conn.close()
+    except sqlite3.Error:
+        with _usage_lock:
+            _usage_buffer[:0] = rows  # Повторим при следующей записи
+        raise
+    return len(rows)
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def _perf_summary(rows):
+    """Сводка по строкам (total_ms, ttfb_ms, prompt, completion, cache_hit, status)"""
+    total = [r[0] for r in rows if r[0] is not None]
+    ttfb = [r[1] for r in rows if r[1] is not None]
+    summary = {
+        'requests': len(rows),
+        'errors': sum(1 for r in rows if r[5] != 200),
+        'prompt_tokens': sum(r[2] or 0 for r in rows),
+        'completion_tokens': sum(r[3] or 0 for r in rows),
+        'cache_hit_tokens': sum(r[4] or 0 for r in rows),
+    }
+    for name, values in (('total', total), ('ttfb', ttfb)):
+        for q in (50, 95, 99):
+            summary[f'{name}_p{q}'] = _percentile(values, q / 100) if values else None
+    summary['cache_hit_rate'] = (
+        summary['cache_hit_tokens'] / summary['prompt_tokens'] if summary['prompt_tokens'] else 0.0
+    )
+    return summary
+
+_SQL_LLM_USAGE_SINCE = '''
+    SELECT mode, substr(created_at, 1, 10), user_id,
+           total_ms, ttfb_ms, prompt_tokens, completion_tokens, cache_hit_tokens, status
+    FROM llm_usage
+    WHERE created_at >= ?
+'''
+
+def get_llm_perf_report(days: int = 7, top_users: int = 5) -> Dict[str, Any]:
+    """
+    Отчет по запросам к DeepSeek за последние days дней: перцентили задержки
+    (до конца ответа и до первого байта) и токены по режимам и по дням,
+    плюс пользователи с наибольшим расходом токенов.
+    """
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(_SQL_LLM_USAGE_SINCE, (since,))
+    rows = c.fetchall()
     conn.close()
+    
+    by_mode: Dict[str, list] = {}
+    by_day: Dict[str, list] = {}
+    by_user: Dict[int, int] = {}
+    for mode, day, user_id, *metrics in rows:
+        by_mode.setdefault(mode, []).append(metrics)
+        by_day.setdefault(day, []).append(metrics)
+        if user_id is not None:
+            by_user[user_id] = by_user.get(user_id, 0) + (metrics[2] or 0) + (metrics[3] or 0)
+    
+    return {
+        'days': days,
+        'total': _perf_summary([metrics for _, _, _, *metrics in rows]),
+        'by_mode': {mode: _perf_summary(items) for mode, items in sorted(by_mode.items())},
+        'by_day': {day: _perf_summary(items) for day, items in sorted(by_day.items())},
+        'top_users': sorted(by_user.items(), key=lambda x: x[1], reverse=True)[:top_users],
+    }
+
+# === КОЛЬЦЕВОЙ БУФЕР ПОСЛЕДНИХ РЕПЛИК ===
+# Последние HISTORY_CACHE_TURNS реплик активных пользователей в памяти:
+# контекст для DeepSeek собирается без чтения БД. Буфер пользователя
+# заполняется из БД при первом обращении, дальше пополняется в add_message;
+# вытесняются простаивающие дольше HISTORY_CACHE_IDLE и самые давние сверх
+# HISTORY_CACHE_USERS. Порядок блокировок: _recent_lock, затем _history_lock.
+# Под обеими блокировками — только работа с памятью: _recent_lock берут и из event loop
+# (peek_recent_history, get_recent_emotions, get_cached_summary). Загрузка из
+# БД идет без него; что успели записать add_message и save_summary за время
+# загрузки, собирает _RecentLoad, а номер строки (_history_appended) отделяет
+# уже попавшее в прочитанный снимок от более нового.
+
+class _RecentTurns:
+    __slots__ = ('turns', 'seqs', 'emotions', 'last_used', 'summary', 'unsummarized')
+
+    def __init__(self, messages, summary=None, unsummarized=0):
+        self.turns = deque(maxlen=HISTORY_CACHE_TURNS)
+        self.seqs = deque(maxlen=HISTORY_CACHE_TURNS)  # Номера строк add_message (0 — загружена из БД)
+        self.emotions = deque(maxlen=RECENT_EMOTIONS)
+        self.last_used = time.monotonic()
+        # Резюме старой части разговора и число сообщений после него
+        self.summary = summary
+        self.unsummarized = unsummarized
+        for msg in messages:
+            self.append(msg)
+
+    def append(self, msg, seq=0):
+        self.turns.append(msg)
+        self.seqs.append(seq)
+        if msg['role'] == 'user' and msg.get('emotion_primary'):
+            self.emotions.append(msg['emotion_primary'])
+
+    def appended_since(self, seq):
+        """Сколько сообщений добавлено после строки с номером seq"""
+        return sum(1 for s in self.seqs if s > seq)
+
+class _RecentLoad:
+    """Изменения буфера пользователя, пока он загружается из БД"""
+    __slots__ = ('appended', 'summary')
+
+    def __init__(self):
+        self.appended = []  # [(номер строки, сообщение)] из add_message
+        self.summary = None  # (резюме, несжатых сообщений, номер строки) из save_summary
+
+_recent: 'OrderedDict[int, _RecentTurns]' = OrderedDict()
+_recent_loading: Dict[int, List[_RecentLoad]] = {}  # Загрузки из БД, идущие без _recent_lock
+_recent_lock = threading.Lock()
+_recent_hits = 0
+_recent_misses = 0
+
+def _evict_recent(now):
+    # Освобождает место под нового пользователя
+    while _recent:
+        user_id, entry = next(iter(_recent.items()))
+        if len(_recent) < HISTORY_CACHE_USERS and now - entry.last_used < HISTORY_CACHE_IDLE:
+            break
+        del _recent[user_id]
+
+def _touch_recent(user_id):
+    """Буфер пользователя с отметкой об использовании (под _recent_lock)"""
+    entry = _recent.get(user_id)
+    if entry is not None:
+        entry.last_used = time.monotonic()
+        _recent.move_to_end(user_id)
+    return entry
+
+def peek_recent_history(user_id, limit=10) -> Optional[List[Dict[str, Any]]]:
+    """
+    Последние limit реплик из памяти, без обращения к БД.
+    None — пользователя нет в буфере (или limit больше размера буфера).
+    """
+    global _recent_hits
+    if limit > HISTORY_CACHE_TURNS:
+        return None
+    with _recent_lock:
+        entry = _touch_recent(user_id)
+        if entry is None:
+            return None
+        _recent_hits += 1
+        turns = list(entry.turns)
+    return [dict(msg) for msg in turns[max(0, len(turns) - limit):]]
+
+def get_recent_history(user_id, limit=10) -> List[Dict[str, Any]]:
+    """История из кольцевого буфера; при первом обращении буфер заполняется из БД"""
+    global _recent_misses
+    cached = peek_recent_history(user_id, limit)
+    if cached is not None:
+        return cached
+    if limit > HISTORY_CACHE_TURNS:
+        return get_history(user_id, limit)
+
+    with _recent_lock:
+        entry = _touch_recent(user_id)
+        if entry is None:
+            _recent_misses += 1
+            load = _RecentLoad()
+            _recent_loading.setdefault(user_id, []).append(load)
+        else:
+            turns = list(entry.turns)
+    if entry is not None:
+        return [dict(msg) for msg in turns[max(0, len(turns) - limit):]]
+
+    # Запросы к БД — без _recent_lock; add_message за это время попадет в load
+    try:
+        summary, summary_seq = _read_summary(user_id)
+        messages, history_seq = _read_history(user_id, HISTORY_CACHE_TURNS)
+    finally:
+        with _recent_lock:
+            loads = _recent_loading[user_id]
+            loads.remove(load)
+            if not loads:
+                del _recent_loading[user_id]
+
+    if load.summary is not None:
+        summary_text, unsummarized, summary_seq = load.summary
+    else:
+        summary_text, unsummarized = summary['summary'], summary['unsummarized']
+    with _recent_lock:
+        entry = _touch_recent(user_id)
+        if entry is None:  # Параллельная загрузка могла успеть раньше
+            entry = _RecentTurns(messages, summary_text, unsummarized)
+            for seq, msg in load.appended:
+                if seq > history_seq:
+                    entry.append(msg, seq)
+                if seq > summary_seq:
+                    entry.unsummarized += 1
+            _evict_recent(time.monotonic())
+            _recent[user_id] = entry
+        turns = list(entry.turns)
+    return [dict(msg) for msg in turns[max(0, len(turns) - limit):]]
+
+def get_recent_emotions(user_id, count=RECENT_EMOTIONS) -> List[str]:
+    """Последние эмоции пользователя из кольцевого буфера (пусто, если его нет в памяти)"""
+    with _recent_lock:
+        entry = _recent.get(user_id)
+        emotions = list(entry.emotions) if entry is not None else []
+    return emotions[max(0, len(emotions) - count):]
+
+def get_cached_summary(user_id) -> Optional[Dict[str, Any]]:
+    """Резюме из кольцевого буфера (None — пользователя нет в памяти)"""
+    with _recent_lock:
+        entry = _recent.get(user_id)
+        if entry is None:
+            return None
+        return {'summary': entry.summary, 'unsummarized': entry.unsummarized}
+
+def get_recent_cache_stats() -> Dict[str, Any]:
+    """Состояние кольцевого буфера: пользователи в памяти, попадания, промахи"""
+    with _recent_lock:
+        total = _recent_hits + _recent_misses
+        return {
+            'users': len(_recent),
+            'max_users': HISTORY_CACHE_USERS,
+            'hits': _recent_hits,
+            'misses': _recent_misses,
+            'hit_ratio': _recent_hits / total if total else 0.0,
+        }
+
+def _history_message(role, content, emotion_primary, emotion_confidence):
+    msg = {"role": role, "content": content}
+    if emotion_primary:
+        msg["emotion_primary"] = emotion_primary
+    if emotion_confidence:
+        msg["emotion_confidence"] = emotion_confidence
+    return msg
+
+def add_message(user_id, role, content, emotion_primary=None, emotion_confidence=None):
+    """
+    Добавление сообщения в историю (расширенная версия).
+    Строка попадает в буфер и записывается пачкой (см. flush_history).
+    """
+    global _history_oldest, _history_appended
+    row = (user_id, role, content, datetime.utcnow(), emotion_primary, emotion_confidence)
+    msg = _history_message(role, content, emotion_primary, emotion_confidence)
+    with _recent_lock:
+        with _history_lock:
+            if not _history_buffer:
+                _history_oldest = time.monotonic()
+            _history_buffer.append(row)
+            _history_appended += 1
+            seq = _history_appended
+            due = (len(_history_buffer) >= HISTORY_FLUSH_SIZE
+                   or time.monotonic() - _history_oldest >= HISTORY_FLUSH_INTERVAL)
+        entry = _recent.get(user_id)
+        if entry is not None:
+            entry.append(msg, seq)
+            entry.unsummarized += 1
+        for load in _recent_loading.get(user_id, ()):
+            load.appended.append((seq, msg))
+    if due:
+        flush_history()
+
+# MAX(id) — в том же снимке, что и строки: по нему отсеивается уже записанная часть пачки
+_SQL_SELECT_HISTORY = '''
+    SELECT role, content, emotion_primary, emotion_confidence, (SELECT MAX(id) FROM history) FROM history
+    WHERE user_id = ?
+    ORDER BY id DESC
+    LIMIT ?
+'''
 
 def get_history(user_id, limit=10):
-    """Получение истории сообщений (существующая функция)"""
+    """Получение истории сообщений (существующая функция), включая еще не записанные"""
+    return _read_history(user_id, limit)[0]
+
+def _read_history(user_id, limit):
+    """История и номер последней строки add_message, которую она уже включает"""
     conn = get_connection()
     c = conn.cursor()
-    c.execute('''
-        SELECT role, content, emotion_primary, emotion_confidence FROM history
-        WHERE user_id = ?
-        ORDER BY id DESC
-        LIMIT ?
-    ''', (user_id, limit))
-    rows = c.fetchall()
+    rows, pending, seq = _query_with_pending(c, user_id, _SQL_SELECT_HISTORY, (user_id, limit))
     conn.close()
     
-    messages = []
-    for role, content, emotion_primary, emotion_confidence in reversed(rows):
-        msg = {"role": role, "content": content}
-        if emotion_primary:
-            msg["emotion_primary"] = emotion_primary
-        if emotion_confidence:
-            msg["emotion_confidence"] = emotion_confidence
-        messages.append(msg)
+    # Строки в буфере всегда новее записанных
+    rows = [row[:4] for row in reversed(rows)] + [row[1:3] + row[4:6] for row in pending]
+    if limit >= 0:
+        rows = rows[max(0, len(rows) - limit):]
     
-    return messages
+    return [_history_message(*row) for row in rows], seq
+
+# === РЕЗЮМЕ РАЗГОВОРОВ ===
+# Старая часть разговора сжимается фоновой задачей (summarizer.py) в резюме;
+# last_message_id — последнее сообщение истории, вошедшее в резюме.
+
+_SQL_SELECT_SUMMARY = 'SELECT summary, last_message_id FROM conversation_summaries WHERE user_id = ?'
+_SQL_COUNT_HISTORY_AFTER = 'SELECT COUNT(*), (SELECT MAX(id) FROM history) FROM history WHERE user_id = ? AND id > ?'
+_SQL_HISTORY_TO_SUMMARIZE = '''
+    SELECT id, role, content FROM history
+    WHERE user_id = ? AND id > ?
+    ORDER BY id
+    LIMIT ?
+'''
+_SQL_UPSERT_SUMMARY = '''
+    INSERT INTO conversation_summaries (user_id, summary, last_message_id, updated_at)
+    VALUES (?, ?, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        summary = excluded.summary,
+        last_message_id = excluded.last_message_id,
+        updated_at = excluded.updated_at
+    WHERE excluded.last_message_id > conversation_summaries.last_message_id
+'''
+
+def _count_after(c, user_id, last_message_id):
+    """Сообщений после last_message_id, включая буфер, и номер последней учтенной строки add_message"""
+    rows, pending, seq = _query_with_pending(c, user_id, _SQL_COUNT_HISTORY_AFTER, (user_id, last_message_id))
+    return rows[0][0] + len(pending), seq
+
+def get_summary(user_id) -> Dict[str, Any]:
+    """Резюме пользователя и число сообщений, которые в него еще не вошли"""
+    return _read_summary(user_id)[0]
+
+def _read_summary(user_id):
+    """Резюме и номер последней строки add_message, учтенной в unsummarized"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(_SQL_SELECT_SUMMARY, (user_id,))
+    row = c.fetchone()
+    summary, last_message_id = row if row else (None, 0)
+    unsummarized, seq = _count_after(c, user_id, last_message_id)
+    conn.close()
+    return {'summary': summary, 'last_message_id': last_message_id, 'unsummarized': unsummarized}, seq
+
+def get_messages_to_summarize(user_id, keep_recent, max_messages) -> Dict[str, Any]:
+    """
+    Сообщения, которые пора включить в резюме: после last_message_id,
+    кроме keep_recent последних (они уходят в контекст дословно).
+    Не больше max_messages за раз, от старых к новым.
+    """
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(_SQL_SELECT_SUMMARY, (user_id,))
+    row = c.fetchone()
+    summary, last_message_id = row if row else (None, 0)
+    
+    counted, pending, _ = _query_with_pending(c, user_id, _SQL_COUNT_HISTORY_AFTER, (user_id, last_message_id))
+    # Строки буфера — самые новые, они всегда среди keep_recent
+    eligible = min(max_messages, counted[0][0] - max(0, keep_recent - len(pending)))
+    rows = []
+    if eligible > 0:
+        c.execute(_SQL_HISTORY_TO_SUMMARIZE, (user_id, last_message_id, eligible))
+        rows = c.fetchall()
+    conn.close()
+    return {'summary': summary, 'messages': rows}
+
+def save_summary(user_id, summary, last_message_id) -> bool:
+    """Сохраняет резюме, если оно охватывает больше сообщений, чем сохраненное"""
+    conn = get_connection()
+    c = conn.cursor()
+    c.execute(_SQL_UPSERT_SUMMARY, (user_id, summary, last_message_id, datetime.utcnow().isoformat()))
+    saved = c.rowcount > 0
+    conn.commit()
+    if saved:
+        unsummarized, seq = _count_after(c, user_id, last_message_id)
+    conn.close()
+    if not saved:
+        return False
+    
+    # Буфер реплик — без запросов к БД под _recent_lock
+    with _recent_lock:
+        entry = _recent.get(user_id)
+        if entry is not None:
+            entry.summary = summary
+            entry.unsummarized = unsummarized + entry.appended_since(seq)
+        for load in _recent_loading.get(user_id, ()):
+            load.summary = (summary, unsummarized, seq)
+    return True
+
+_SQL_COUNT_VALID_PASSWORD = 'SELECT COUNT(*) FROM passwords WHERE password_text = ? AND is_active = TRUE'
 
 def is_valid_password(password: str) -> bool:
     """Проверка, является ли строка действующим паролем"""
     try:
         conn = get_connection()
         c = conn.cursor()
-        c.execute('SELECT COUNT(*) FROM passwords WHERE password_text = ? AND is_active = TRUE', (password,))
+        c.execute(_SQL_COUNT_VALID_PASSWORD, (password,))
         count = c.fetchone()[0]
         conn.close()
         return count > 0
@@ -667,51 +1416,60 @@ def is_valid_password(password: str) -> bool:
         print(f"Ошибка при проверке пароля: {e}")
         return False
 
+_SQL_SET_WARNED_EXPIRY = 'UPDATE users SET warned_expiry = TRUE WHERE user_id = ?'
+
 def update_user_warning_flag(user_id: int) -> bool:
     """Обновление флага предупреждения об истечении"""
     try:
         conn = get_connection()
         c = conn.cursor()
-        c.execute('UPDATE users SET warned_expiry = TRUE WHERE user_id = ?', (user_id,))
+        c.execute(_SQL_SET_WARNED_EXPIRY, (user_id,))
         success = c.rowcount > 0
         conn.commit()
         conn.close()
+        invalidate_auth_cache(user_id)
         return success
     except Exception as e:
         print(f"Ошибка при обновлении флага предупреждения: {e}")
         return False
 
+_SQL_LOGOUT_USER = 'UPDATE users SET is_authorized = FALSE WHERE user_id = ?'
+
 def logout_user(user_id: int) -> bool:
     """Выход пользователя из системы"""
     try:
         conn = get_connection()
         c = conn.cursor()
-        c.execute('UPDATE users SET is_authorized = FALSE WHERE user_id = ?', (user_id,))
+        c.execute(_SQL_LOGOUT_USER, (user_id,))
         success = c.rowcount > 0
+        if success:
+            log_auth_event(user_id, 'manual_logout', details='Пользователь вышел сам', cursor=c)
         conn.commit()
         conn.close()
-        
-        if success:
-            log_auth_event(user_id, 'manual_logout', details='Пользователь вышел сам')
+        invalidate_auth_cache(user_id)
         
         return success
     except Exception as e:
         print(f"Ошибка при logout: {e}")
         return False
 
+_SQL_COUNT_AUTHORIZED_USERS = 'SELECT COUNT(*) FROM users WHERE is_authorized = TRUE'
+_SQL_COUNT_USERS = 'SELECT COUNT(DISTINCT user_id) FROM users'
+_SQL_COUNT_BLOCKED_USERS = 'SELECT COUNT(*) FROM users WHERE blocked_until > datetime("now")'
+
 def get_users_stats() -> Dict[str, int]:
     """Получение статистики пользователей"""
     try:
         conn = get_connection()
         c = conn.cursor()
         
-        c.execute('SELECT COUNT(*) FROM users WHERE is_authorized = TRUE')
+        c.execute(_SQL_COUNT_AUTHORIZED_USERS)
         active_users = c.fetchone()[0]
         
-        c.execute('SELECT COUNT(DISTINCT user_id) FROM users')
+        c.execute(_SQL_COUNT_USERS)
         total_users = c.fetchone()[0]
         
-        c.execute('SELECT COUNT(*) FROM users WHERE blocked_until > datetime("now")')
+        c.execute(_SQL_COUNT_BLOCKED_USERS)
         blocked_users = c.fetchone()[0]
         
         conn.close()
@@ -729,5 +1487,91 @@ def get_users_stats() -> Dict[str, int]:
             'blocked_users': 0
         }
 
-# Инициализация БД при импорте модуля
-init_db()
\ No newline at end of file
+# === АУДИТ ПЛАНОВ ЗАПРОСОВ ===
+
+# Запросы модуля — те же константы _SQL_*, что выполняют функции выше.
+# allow_scan=True — полный проход допустим: маленькая таблица или админский отчет.
+_AUDITED_QUERIES = [
+    # (функция, SQL, параметры, allow_scan)
+    ('log_auth_events', _SQL_INSERT_AUTH_LOG, (0, '', None, None, ''), False),
+    ('ensure_user_exists', _SQL_SELECT_USER_EXISTS, (0,), False),
+    ('ensure_user_exists', _SQL_INSERT_USER, (0, ''), False),
+    ('check_access', _SQL_UPSERT_USER, (0, ''), False),
+    ('check_access', _SQL_SELECT_USER_AUTH, (0,), False),
+    ('check_access', _SQL_EXPIRE_USER, (0,), False),
+    ('check_access', _SQL_CONSUME_DAILY_LIMIT, (0, '', 10), False),
+    ('check_daily_limit', _SQL_SELECT_DAILY_COUNT, (0, ''), False),
+    ('increment_message_count', _SQL_INCREMENT_DAILY_COUNT, (0, '', 0, ''), False),
+    ('cleanup_old_limits', _SQL_DELETE_OLD_LIMITS, ('',), False),
+    ('process_password_attempt', _SQL_SELECT_ACTIVE_PASSWORD, ('',), False),
+    ('process_password_attempt', _SQL_AUTHORIZE_USER, ('', '', '', 0), False),
+    ('process_password_attempt', _SQL_COUNT_PASSWORD_USE, ('',), False),
+    ('process_password_attempt', _SQL_SELECT_FAILED_ATTEMPTS, (0,), False),
+    ('process_password_attempt', _SQL_BLOCK_USER, (0, '', 0), False),
+    ('process_password_attempt', _SQL_SET_FAILED_ATTEMPTS, (0, 0), False),
+    ('add_password', _SQL_INSERT_PASSWORD, ('', '', 0, ''), False),
+    ('deactivate_password', _SQL_DEACTIVATE_PASSWORD, ('',), False),
+    ('list_passwords', _SQL_LIST_PASSWORDS, (), True),
+    ('get_password_stats', _SQL_COUNT_ACTIVE_PASSWORDS, (), True),
+    ('get_password_stats', _SQL_COUNT_INACTIVE_PASSWORDS, (), True),
+    ('get_password_stats', _SQL_SUM_PASSWORD_USES, (), True),
+    ('get_password_stats', _SQL_PASSWORDS_BY_DURATION, (), True),
+    ('get_user_stats', _SQL_SELECT_USER_INFO, (0,), False),
+    ('get_user_stats', _SQL_COUNT_USER_HISTORY, (0,), False),
+    ('get_auth_log', _SQL_USER_AUTH_LOG, (0, 50), False),
+    ('get_auth_log', _SQL_AUTH_LOG, (50,), False),
+    ('get_blocked_users', _SQL_BLOCKED_USERS, ('',), False),
+    ('unblock_user', _SQL_UNBLOCK_USER, (0,), False),
+    ('cleanup_expired_users', _SQL_SELECT_EXPIRED_USERS, ('',), False),
+    ('cleanup_expired_users', _SQL_EXPIRE_USERS, ('',), False),
+    ('flush_history', _SQL_INSERT_HISTORY, (0, '', '', '', None, None), False),
+    ('flush_llm_usage', _SQL_INSERT_LLM_USAGE, (0, '', 0, 0, 0, 0, 200, None, False, 0, 0, ''), False),
+    ('get_llm_perf_report', _SQL_LLM_USAGE_SINCE, ('',), False),
+    ('get_history', _SQL_SELECT_HISTORY, (0, 25), False),
+    ('get_summary', _SQL_SELECT_SUMMARY, (0,), False),
+    ('get_summary', _SQL_COUNT_HISTORY_AFTER, (0, 0), False),
+    ('get_messages_to_summarize', _SQL_HISTORY_TO_SUMMARIZE, (0, 0, 50), False),
+    ('save_summary', _SQL_UPSERT_SUMMARY, (0, '', 0, ''), False),
+    ('is_valid_password', _SQL_COUNT_VALID_PASSWORD, ('',), False),
+    ('update_user_warning_flag', _SQL_SET_WARNED_EXPIRY, (0,), False),
+    ('logout_user', _SQL_LOGOUT_USER, (0,), False),
+    ('get_users_stats', _SQL_COUNT_AUTHORIZED_USERS, (), True),
+    ('get_users_stats', _SQL_COUNT_USERS, (), True),
+    ('get_users_stats', _SQL_COUNT_BLOCKED_USERS, (), False),
+]
+
+def _unaudited_queries() -> List[str]:
+    """Константы _SQL_*, которых нет в _AUDITED_QUERIES (новый запрос без аудита)"""
+    audited = {sql for _, sql, _, _ in _AUDITED_QUERIES}
+    return [name for name, value in globals().items() if name.startswith('_SQL_') and value not in audited]
+
+def audit_query_plans() -> List[Dict[str, Any]]:
+    """
+    Прогоняет EXPLAIN QUERY PLAN по запросам модуля и предупреждает
+    о полных сканированиях таблиц. Возвращает список найденных проблем.
+    """
+    conn = get_connection()
+    problems = []
+    
+    for name in _unaudited_queries():
+        problems.append({'function': name, 'sql': globals()[name], 'plan': []})
+        logger.warning(f"Запрос {name} не входит в аудит планов (_AUDITED_QUERIES)")
+    
+    for func_name, sql, params, allow_scan in _AUDITED_QUERIES:
+        try:
+            plan = [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params).fetchall()]
+        except sqlite3.Error as e:
+            logger.warning(f"Не удалось получить план запроса {func_name}: {e}")
+            continue
+        
+        # "SCAN history" — полный проход; "SCAN ... USING INDEX" — проход по индексу
+        full_scans = [step for step in plan if step.startswith('SCAN') and 'USING' not in step]
+        if full_scans and not allow_scan:
+            problems.append({'function': func_name, 'sql': sql, 'plan': plan})
+            logger.warning(f"Полное сканирование в {func_name}: {'; '.join(full_scans)} | {' '.join(sql.split())}")
+    
+    conn.close()
+    
+    if not problems:
+        logger.info(f"Аудит планов запросов: {len(_AUDITED_QUERIES)} запросов, полных сканирований нет")
+    return problems
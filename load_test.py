@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный тест бота без сети
+Виртуальные пользователи шлют синтетические Update прямо в handle_message
+и handle_photo; подписчики сначала проходят ввод пароля. База — временный
+файл (HISTORY_DB_PATH), DeepSeek (ответы mock_deepseek) и Bot API отвечают
+из процесса с заданными задержками, модель эмоций заменена заглушкой с заданным временем инференса.
+Отчет: пропускная способность, перцентили задержки по действиям, задержка
+event loop, средние по этапам (metrics) и итоги обработки.
+Использование:
+    python3 load_test.py
+    python3 load_test.py --users 200 --duration 60 --think 2 --subscribers 0.3
+    python3 load_test.py --llm-ttft-ms 800 --llm-tps 60 --no-stream
+    python3 load_test.py --llm-server --llm-429-rate 0.05   (DeepSeek по HTTP через mock_deepseek)
+    python3 load_test.py --burst 0.3 --coalesce-ms 250   (серии сообщений подряд)
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+LOAD_TEST_PASSWORD = "load-test-password"
+
+PHRASES = [
+    "Привет, как дела?", "Расскажи что-нибудь про Павича", "Давай поработаем над сценой",
+    "Мне сегодня грустно", "Что ты думаешь о Борхесе?", "Поболтаем?", "Анализируем?",
+    "Опиши базар в Мостаре 1820 года", "Почему ты такая язвительная?", "Я рад тебя видеть",
+]
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+# === ЗАГЛУШКИ ВНЕШНИХ СЕРВИСОВ ===
+
+class FakeBot:
+    """Вместо Bot API: отправка и правка сообщений с задержкой сети"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+        self.edited = 0
+        self.deleted = 0
+        self._message_id = 0
+
+    def make_message(self, chat_id, **kwargs):
+        from telegram import Chat, Message, User
+        self._message_id += 1
+        message = Message(
+            message_id=self._message_id,
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=chat_id, type=Chat.PRIVATE),
+            from_user=User(id=chat_id, first_name=f"load{chat_id}", is_bot=False),
+            **kwargs,
+        )
+        message.set_bot(self)
+        return message
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+        return self.make_message(chat_id, text=text)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.edited += 1
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.deleted += 1
+        return True
+
+def make_deepseek_transport(settings):
+    """
+    httpx-транспорт, отвечающий как /v1/chat/completions (обычный ответ и SSE)
+    прямо в event loop; ответы и сбои — те же, что у mock_deepseek
+    """
+    import httpx
+    import mock_deepseek
+
+    cache = mock_deepseek.PrefixCache()
+
+    async def handler(request):
+        body = json.loads(request.content)
+        fault = settings.pick_fault()
+        await asyncio.sleep(settings.ttft_ms / 1000)
+        if fault == '429':
+            return httpx.Response(429, json={"error": {"message": "rate limit exceeded"}},
+                                  headers={"Retry-After": str(settings.retry_after)})
+        if fault == '500':
+            return httpx.Response(500, json={"error": {"message": "internal error"}})
+        if fault == 'timeout':
+            await asyncio.sleep(settings.timeout_seconds)
+            raise httpx.ReadTimeout("load test timeout", request=request)
+
+        tokens = mock_deepseek.reply_tokens(min(settings.reply_tokens, body.get('max_tokens') or settings.reply_tokens))
+        usage = mock_deepseek.build_usage(body['messages'], len(tokens), cache)
+        model = body.get('model', 'deepseek-chat')
+        if body.get("stream"):
+            include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+            events = mock_deepseek.build_stream_events(model, tokens, usage, include_usage)
+
+            async def stream():
+                for i, event in enumerate(events):
+                    if fault == 'drop' and i == len(events) // 2:
+                        raise httpx.RemoteProtocolError("load test drop")  # Обрыв посреди ответа
+                    yield event
+                    if 0 < i <= len(tokens):
+                        await asyncio.sleep(1 / settings.tps)
+            return httpx.Response(200, content=stream(), headers={"Content-Type": "text/event-stream"})
+
+        await asyncio.sleep(len(tokens) / settings.tps)
+        if fault == 'drop':
+            raise httpx.RemoteProtocolError("load test drop", request=request)
+        return httpx.Response(200, json=mock_deepseek.build_completion(model, tokens, usage))
+
+    return httpx.MockTransport(handler)
+
+def install_fake_emotion_model(inference_ms):
+    """Классификатор-заглушка: фиксированное время на прогон батча (блокирует поток, как модель)"""
+    import emotion_model
+
+    def classifier(texts, batch_size=None):
+        time.sleep(inference_ms / 1000)
+        count = 1 if isinstance(texts, str) else len(texts)
+        return [[{'label': 'neutral', 'score': 0.9}, {'label': 'joy', 'score': 0.1}] for _ in range(count)]
+
+    emotion_model.emotion_classifier = classifier
+
+# === ВИРТУАЛЬНЫЕ ПОЛЬЗОВАТЕЛИ ===
+
+class LoadStats:
+    def __init__(self):
+        self.latencies = {}  # действие -> [мс]
+        self.failures = 0
+        self.loop_lag = []
+
+    def record(self, action, ms):
+        self.latencies.setdefault(action, []).append(ms)
+
+async def _drive(stats, action, handler, update, context):
+    started = time.monotonic()
+    try:
+        await handler(update, context)
+    except Exception as e:
+        stats.failures += 1
+        logging.getLogger("load_test").error(f"Обработчик {handler.__name__} упал: {str(e)}")
+    stats.record(action, (time.monotonic() - started) * 1000)
+
+async def virtual_user(user_id, subscriber, args, bot, stats, deadline, counter):
+    import telegram_bot
+    from telegram import PhotoSize, Update
+
+    context = SimpleNamespace(args=[], bot=bot)
+
+    def next_update(**kwargs):
+        counter[0] += 1
+        return Update(update_id=counter[0], message=bot.make_message(user_id, **kwargs))
+
+    if subscriber:
+        # Поток авторизации: бот ждет пароль, пользователь его вводит
+        telegram_bot.update_user_state(
+            user_id, auth_state='waiting_password', waiting_password_since=datetime.utcnow()
+        )
+        await _drive(stats, 'password', telegram_bot.handle_message, next_update(text=LOAD_TEST_PASSWORD), context)
+
+    while time.monotonic() < deadline:
+        if args.think > 0:
+            await asyncio.sleep(random.expovariate(1 / args.think))
+            if time.monotonic() >= deadline:
+                break
+        if random.random() < args.photo_share:
+            photo = [PhotoSize(file_id="load", file_unique_id="load", width=64, height=64)]
+            await _drive(stats, 'photo', telegram_bot.handle_photo, next_update(photo=photo), context)
+        elif random.random() < args.burst:
+            # Серия из нескольких сообщений подряд: обработчики работают одновременно, как в PTB
+            drives = []
+            for _ in range(random.randint(2, 4)):
+                text = f"{random.choice(PHRASES)} ({counter[0]})"
+                drives.append(asyncio.create_task(
+                    _drive(stats, 'burst', telegram_bot.handle_message, next_update(text=text), context)
+                ))
+                await asyncio.sleep(random.uniform(0, args.burst_gap_ms / 1000))
+            await asyncio.gather(*drives)
+        else:
+            text = f"{random.choice(PHRASES)} ({counter[0]})"
+            await _drive(stats, 'message', telegram_bot.handle_message, next_update(text=text), context)
+
+async def monitor_loop_lag(stats, interval=0.05):
+    """Задержка event loop: насколько позже запланированного просыпается sleep"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        stats.loop_lag.append((time.monotonic() - started - interval) * 1000)
+
+async def run(args):
+    import db_async
+    import deepseek_api
+    import history_db
+    import telegram_bot
+
+    import mock_deepseek
+
+    bot = FakeBot(args.tg_ms / 1000)
+    stats = LoadStats()
+    settings = mock_deepseek.MockSettings(
+        ttft_ms=args.llm_ttft_ms, tps=args.llm_tps, reply_tokens=args.llm_tokens,
+        error_429=args.llm_429_rate, error_500=args.llm_error_rate, drop_rate=args.llm_drop_rate,
+    )
+    server = None
+    if args.llm_server:
+        server = mock_deepseek.start_mock_server(port=args.llm_port, settings=settings)
+        await deepseek_api.init_client(warm=False)
+    else:
+        await deepseek_api.init_client(warm=False, transport=make_deepseek_transport(settings))
+    flusher = asyncio.create_task(db_async.history_flush_loop())
+    lag_monitor = asyncio.create_task(monitor_loop_lag(stats))
+
+    subscribers = int(round(args.users * args.subscribers))
+    counter = [0]
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*[
+        virtual_user(100000 + i, i < subscribers, args, bot, stats, deadline, counter)
+        for i in range(args.users)
+    ])
+    elapsed = time.monotonic() - started
+
+    lag_monitor.cancel()
+    flusher.cancel()
+    await telegram_bot.on_shutdown(SimpleNamespace(bot_data={}))
+    if server is not None:
+        server.shutdown()
+        server.server_close()
+    return stats, elapsed, bot, history_db.get_history_buffer_stats()
+
+def print_report(args, stats, elapsed, bot, history_stats):
+    import metrics
+    from dispatcher import dispatcher
+
+    total = sum(len(values) for values in stats.latencies.values())
+    print("📊 НАГРУЗОЧНЫЙ ТЕСТ")
+    print("-" * 72)
+    print(f"Пользователей: {args.users} (подписчиков {int(round(args.users * args.subscribers))}), "
+          f"пауза ~{args.think} с, длительность {elapsed:.1f} с")
+    print(f"Обновлений: {total}, пропускная способность: {total / elapsed:.1f} обн/с, "
+          f"сбоев обработчиков: {stats.failures}")
+    print()
+    print(f"{'Действие':<10} {'кол-во':>7} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'max, мс':>9}")
+    for action, values in sorted(stats.latencies.items()):
+        print(f"{action:<10} {len(values):>7} {_percentile(values, 0.5):>9.1f} {_percentile(values, 0.95):>9.1f} "
+              f"{_percentile(values, 0.99):>9.1f} {max(values):>9.1f}")
+
+    if stats.loop_lag:
+        print(f"\n⏱️ Задержка event loop: p50 {_percentile(stats.loop_lag, 0.5):.1f} мс, "
+              f"p95 {_percentile(stats.loop_lag, 0.95):.1f} мс, p99 {_percentile(stats.loop_lag, 0.99):.1f} мс, "
+              f"max {max(stats.loop_lag):.1f} мс")
+
+    print("\n🧩 Этапы handle_message (среднее):")
+    for stage, stage_stats in metrics.get_stage_stats().items():
+        if stage_stats['count']:
+            print(f"   {stage:<10} {stage_stats['avg_ms']:>9.1f} мс  ({stage_stats['count']} шт., "
+                  f"ошибок {stage_stats['errors']})")
+
+    outcomes = ", ".join(f"{name} {count}" for name, count in sorted(metrics.get_update_counts().items()))
+    print(f"\n📬 Итоги: {outcomes}")
+    print(f"📨 Bot API: отправлено {bot.sent}, правок {bot.edited}, удалено {bot.deleted}")
+    dispatch = dispatcher.get_stats()
+    print(f"📮 Очередь: объединено сообщений {dispatch['coalesced']}, отменено запросов {dispatch['cancelled']}")
+    print(f"💾 История: пачек {history_stats['flushes']}, в среднем {history_stats['avg_batch']:.1f} строк")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота Химера (без сети)")
+    parser.add_argument('--users', type=int, default=50, help='Виртуальных пользователей')
+    parser.add_argument('--duration', type=float, default=30, help='Длительность теста (секунды)')
+    parser.add_argument('--think', type=float, default=1.0, help='Средняя пауза пользователя между сообщениями (секунды)')
+    parser.add_argument('--subscribers', type=float, default=0.3, help='Доля подписчиков (остальные — демо с суточным лимитом)')
+    parser.add_argument('--photo-share', type=float, default=0.05, help='Доля фото среди сообщений')
+    parser.add_argument('--burst', type=float, default=0.0, help='Доля ходов, когда пользователь шлет 2-4 сообщения подряд')
+    parser.add_argument('--burst-gap-ms', type=float, default=400, help='Максимальная пауза между сообщениями серии (мс)')
+    parser.add_argument('--coalesce-ms', type=float, help='Окно объединения сообщений (по умолчанию DISPATCH_COALESCE_MS из config)')
+    parser.add_argument('--daily-limit', type=int, help='Суточный лимит демо-пользователей (по умолчанию из config)')
+    parser.add_argument('--llm-ttft-ms', type=float, default=500, help='Время до первого токена DeepSeek (мс)')
+    parser.add_argument('--llm-tps', type=float, default=50, help='Скорость генерации DeepSeek (токенов в секунду)')
+    parser.add_argument('--llm-tokens', type=int, default=40, help='Токенов в ответе DeepSeek')
+    parser.add_argument('--llm-error-rate', type=float, default=0.0, help='Доля ответов DeepSeek с HTTP 500')
+    parser.add_argument('--llm-drop-rate', type=float, default=0.0, help='Доля ответов DeepSeek, оборванных на середине')
+    parser.add_argument('--llm-429-rate', type=float, default=0.0, help='Доля ответов DeepSeek с HTTP 429')
+    parser.add_argument('--llm-server', action='store_true',
+                        help='DeepSeek — mock_deepseek по настоящему HTTP в отдельном потоке (иначе транспорт в процессе)')
+    parser.add_argument('--no-stream', action='store_true', help='Ответы без стриминга (DEEPSEEK_STREAM=false)')
+    parser.add_argument('--tg-ms', type=float, default=30, help='Задержка Bot API на отправку/правку (мс)')
+    parser.add_argument('--emotion-ms', type=float, default=15, help='Время инференса модели эмоций на батч (мс)')
+    parser.add_argument('--keep-db', action='store_true', help='Не удалять временную базу после теста')
+    args = parser.parse_args()
+
+    # Окружение — до импорта модулей бота: config читает его при импорте
+    workdir = tempfile.mkdtemp(prefix="himera_load_")
+    os.environ['HISTORY_DB_PATH'] = os.path.join(workdir, 'history.db')
+    os.environ['EMOTION_CACHE_PATH'] = ""
+    os.environ['METRICS_PORT'] = "0"
+    os.environ['TRACE_SAMPLE_RATE'] = "0"
+    os.environ['TRACE_SLOW_MS'] = "0"
+    if args.no_stream:
+        os.environ['DEEPSEEK_STREAM'] = "false"
+    if args.coalesce_ms is not None:
+        os.environ['DISPATCH_COALESCE_MS'] = str(args.coalesce_ms)
+    if args.daily_limit is not None:
+        os.environ['DAILY_MESSAGE_LIMIT'] = str(args.daily_limit)
+    if args.llm_server:
+        # Порт выбирается заранее: config читает DEEPSEEK_API_URL при импорте
+        with socket.socket() as probe:
+            probe.bind(("127.0.0.1", 0))
+            args.llm_port = probe.getsockname()[1]
+        os.environ['DEEPSEEK_API_URL'] = f"http://127.0.0.1:{args.llm_port}/v1/chat/completions"
+
+    # Лог бота — только предупреждения в консоль (basicConfig в telegram_bot уже не сработает)
+    logging.basicConfig(format='%(levelname)s | %(name)s | %(message)s', level=logging.WARNING)
+
+    try:
+        from history_db import init_db, add_password
+
+        init_db()  # Временная база
+        add_password(LOAD_TEST_PASSWORD, "Нагрузочный тест", 30)
+        install_fake_emotion_model(args.emotion_ms)
+
+        print(f"🚀 Временная база: {os.environ['HISTORY_DB_PATH']}")
+        stats, elapsed, bot, history_stats = asyncio.run(run(args))
+        print()
+        print_report(args, stats, elapsed, bot, history_stats)
+    finally:
+        if args.keep_db:
+            print(f"\n💾 База сохранена: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
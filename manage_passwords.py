@@ -11,6 +11,7 @@
     python3 manage_passwords.py --logs [--user USER_ID]
     python3 manage_passwords.py --blocked
     python3 manage_passwords.py --unblock USER_ID
+    python3 manage_passwords.py --perf [--days N]
 """
 
 import argparse
@@ -224,6 +225,46 @@ def unblock_user_cmd(user_id: int):
         print(f"❌ Ошибка при разблокировке: {e}")
         return False
 
+def _format_ms(value):
+    return f"{value / 1000:.2f} с" if value is not None else "—"
+
+def show_perf_cmd(days: int = 7):
+    """Отчет по запросам к DeepSeek: задержка и токены"""
+    try:
+        report = get_llm_perf_report(days=days)
+        
+        if not report['total']['requests']:
+            print(f"📝 Запросов к DeepSeek за {days} дн. нет")
+            return
+        
+        print(f"⏱️ ЗАПРОСЫ К DEEPSEEK ЗА {days} ДН.:")
+        print("-" * 60)
+        
+        sections = [("Всего", report['total'])] + list(report['by_mode'].items())
+        for name, summary in sections:
+            print(f"{name}:")
+            print(f"  Запросов: {summary['requests']}, ошибок: {summary['errors']}")
+            print(f"  Ответ p50/p95/p99: {_format_ms(summary['total_p50'])} / "
+                  f"{_format_ms(summary['total_p95'])} / {_format_ms(summary['total_p99'])}")
+            print(f"  Первый байт p50/p95/p99: {_format_ms(summary['ttfb_p50'])} / "
+                  f"{_format_ms(summary['ttfb_p95'])} / {_format_ms(summary['ttfb_p99'])}")
+            print(f"  Токены: промпт {summary['prompt_tokens']}, ответ {summary['completion_tokens']}, "
+                  f"из кэша {summary['cache_hit_rate']:.0%}")
+            print()
+        
+        print("📅 По дням:")
+        for day, summary in report['by_day'].items():
+            tokens = summary['prompt_tokens'] + summary['completion_tokens']
+            print(f"  {day}: {summary['requests']} запр., p95 {_format_ms(summary['total_p95'])}, токенов {tokens}")
+        
+        if report['top_users']:
+            print("\n👥 Больше всего токенов:")
+            for user_id, tokens in report['top_users']:
+                print(f"  User {user_id}: {tokens}")
+            
+    except Exception as e:
+        print(f"❌ Ошибка при получении отчета: {e}")
+
 def main():
     parser = argparse.ArgumentParser(
         description="Управление паролями бота Химера",
@@ -246,6 +287,8 @@ def main():
     python3 manage_passwords.py --stats
     python3 manage_passwords.py --logs
     python3 manage_passwords.py --logs --user 123456789
+    python3 manage_passwords.py --perf
+    python3 manage_passwords.py --perf --days 30    (задержка и токены DeepSeek)
 
   Управление блокировками:
     python3 manage_passwords.py --blocked
@@ -257,7 +300,7 @@ def main():
     
     # Основные команды
     parser.add_argument('--add', type=str, help='Добавить новый пароль')
-    parser.add_argument('--days', type=int, help='Продолжительность в днях (3, 30, 180, 365)')
+    parser.add_argument('--days', type=int, help='Продолжительность в днях (3, 30, 180, 365); с --perf — период отчета')
     parser.add_argument('--desc', type=str, help='Описание пароля')
     
     parser.add_argument('--list', action='store_true', help='Показать список паролей')
@@ -273,6 +316,8 @@ def main():
     parser.add_argument('--blocked', action='store_true', help='Показать заблокированных пользователей')
     parser.add_argument('--unblock', type=int, help='Разблокировать пользователя по ID')
     
+    parser.add_argument('--perf', action='store_true', help='Показать задержку и расход токенов DeepSeek')
+    
     args = parser.parse_args()
     
     # Проверка аргументов
@@ -282,6 +327,8 @@ def main():
     
     # Выполнение команд
     try:
+        init_db()  # Схема БД: проверка версии, при необходимости — миграции
+
         if args.add:
             if not args.days or not args.desc:
                 print("❌ Для добавления пароля нужны параметры --days и --desc")
@@ -314,6 +361,10 @@ def main():
         elif args.unblock:
             return 0 if unblock_user_cmd(args.unblock) else 1
         
+        elif args.perf:
+            show_perf_cmd(days=args.days or 7)
+            return 0
+        
         else:
             print("❌ Укажите одну из команд. Используйте --help для справки")
             return 1
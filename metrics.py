@@ -0,0 +1,238 @@
+# metrics.py
+"""
+Метрики бота в текстовом формате Prometheus.
+Гистограммы задержки по этапам handle_message (авторизация, эмоции, история,
+DeepSeek, ответ в Telegram) копятся в памяти; соединения с БД, очереди и
+доли попаданий в кэши снимаются в момент запроса /metrics.
+Сервер — ThreadingHTTPServer в отдельном потоке: работает рядом с
+run_polling и не занимает event loop. /ready отвечает 200, когда модель
+эмоций загружена, иначе 503.
+"""
+
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import db_async
+import history_db
+import emotion_model
+import deepseek_api
+import summarizer
+import tracing
+from config import METRICS_PORT, METRICS_HOST
+
+logger = logging.getLogger("metrics")
+
+# Этапы обработки сообщения (total — весь путь сообщения, получившего ответ или ошибку)
+STAGES = ('auth', 'emotion', 'history', 'deepseek', 'reply', 'total')
+
+# Границы корзин гистограмм (секунды)
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    """Кумулятивная гистограмма Prometheus: счетчики корзин, сумма, количество"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+_lock = threading.Lock()
+_stage_seconds = {stage: Histogram() for stage in STAGES}
+_stage_errors = {stage: 0 for stage in STAGES}
+_updates = {}  # Итог обработки сообщения -> количество
+
+def observe_stage(stage, seconds, error=False):
+    with _lock:
+        _stage_seconds[stage].observe(seconds)
+        if error:
+            _stage_errors[stage] += 1
+
+@contextmanager
+def track_stage(stage):
+    """
+    Замер этапа: with track_stage("emotion"): ... (исключение считается ошибкой этапа).
+    Этап попадает и в гистограмму, и в текущую трассу (tracing)
+    """
+    started = time.monotonic()
+    try:
+        yield
+    except BaseException:
+        elapsed = time.monotonic() - started
+        observe_stage(stage, elapsed, error=True)
+        tracing.record_stage(stage, elapsed, error=True)
+        raise
+    elapsed = time.monotonic() - started
+    observe_stage(stage, elapsed)
+    tracing.record_stage(stage, elapsed)
+
+def get_stage_stats():
+    """Этап -> количество, ошибки, средняя длительность (мс)"""
+    with _lock:
+        return {
+            stage: {
+                'count': hist.count,
+                'errors': _stage_errors[stage],
+                'avg_ms': hist.sum / hist.count * 1000 if hist.count else 0.0,
+            }
+            for stage, hist in _stage_seconds.items()
+        }
+
+def get_update_counts():
+    with _lock:
+        return dict(_updates)
+
+def count_update(outcome):
+    """Итог обработки сообщения: replied, coalesced, denied, password, llm_error, llm_truncated, error"""
+    with _lock:
+        _updates[outcome] = _updates.get(outcome, 0) + 1
+    tracing.annotate(outcome=outcome)
+
+# === ФОРМАТ PROMETHEUS ===
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+
+def _value(value):
+    return str(value) if isinstance(value, int) else repr(float(value))
+
+def _metric(lines, name, kind, help_text, samples):
+    """samples: [(метки, значение)]"""
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        lines.append(f"{name}{_labels(labels)} {_value(value)}")
+
+def _render_histograms(lines):
+    name = "himera_stage_duration_seconds"
+    lines.append(f"# HELP {name} Длительность этапов обработки сообщения")
+    lines.append(f"# TYPE {name} histogram")
+    with _lock:
+        for stage, hist in _stage_seconds.items():
+            for bound, count in zip(hist.buckets, hist.counts):
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{bound:g}"}} {count}')
+            lines.append(f'{name}_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {_value(hist.sum)}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {hist.count}')
+        errors = [({'stage': stage}, count) for stage, count in _stage_errors.items()]
+        updates = [({'outcome': outcome}, count) for outcome, count in sorted(_updates.items())]
+
+    _metric(lines, "himera_stage_errors_total", "counter", "Этапы, завершившиеся исключением", errors)
+    _metric(lines, "himera_updates_total", "counter", "Обработанные сообщения по итогу", updates)
+
+def _render_gauges(lines):
+    connections = history_db.get_connection_stats()
+    _metric(lines, "himera_db_open_connections", "gauge", "Постоянные соединения с SQLite",
+            [({}, connections['open_connections'])])
+
+    executors = db_async.get_executor_stats()
+    _metric(lines, "himera_db_queue_depth", "gauge", "Запросы к БД, ожидающие потока",
+            [({'pool': 'writer'}, executors['writer_queue']), ({'pool': 'reader'}, executors['reader_queue'])])
+    _metric(lines, "himera_history_pending", "gauge", "Строки истории в буфере записи",
+            [({}, executors['history_pending'])])
+
+    batch = emotion_model.get_batch_stats()
+    _metric(lines, "himera_emotion_queue_depth", "gauge", "Тексты в очереди батчера эмоций",
+            [({}, batch['queue_depth'])])
+
+    caches = {
+        'emotion': emotion_model.get_cache_stats(),
+        'auth': history_db.get_auth_cache_stats(),
+        'recent_history': history_db.get_recent_cache_stats(),
+    }
+    _metric(lines, "himera_cache_hit_ratio", "gauge", "Доля попаданий в кэш",
+            [({'cache': name}, stats['hit_ratio']) for name, stats in caches.items()])
+    _metric(lines, "himera_cache_hits_total", "counter", "Попадания в кэш",
+            [({'cache': name}, stats['hits']) for name, stats in caches.items()])
+    _metric(lines, "himera_cache_misses_total", "counter", "Промахи кэша",
+            [({'cache': name}, stats['misses']) for name, stats in caches.items()])
+
+    usage = deepseek_api.get_usage_stats()
+    _metric(lines, "himera_deepseek_requests_total", "counter", "Запросы к DeepSeek с полем usage",
+            [({'mode': mode}, stats['requests']) for mode, stats in usage.items()])
+    _metric(lines, "himera_deepseek_tokens_total", "counter", "Токены DeepSeek",
+            [({'mode': mode, 'kind': kind}, stats[f'{kind}_tokens'])
+             for mode, stats in usage.items()
+             for kind in ('prompt', 'completion', 'cache_hit', 'cache_miss')])
+    _metric(lines, "himera_deepseek_cache_hit_ratio", "gauge", "Доля токенов промпта из кэша контекста DeepSeek",
+            [({'mode': mode}, stats['cache_hit_rate']) for mode, stats in usage.items()])
+
+    resilience = deepseek_api.get_resilience_stats()
+    _metric(lines, "himera_deepseek_circuit_state", "gauge", "Автомат отключения DeepSeek: 0 закрыт, 1 пробный запрос, 2 открыт",
+            [({}, {'closed': 0, 'half_open': 1, 'open': 2}[resilience['state']])])
+    _metric(lines, "himera_deepseek_circuit_rejected_total", "counter", "Запросы, отклоненные без обращения к DeepSeek",
+            [({}, resilience['rejected'])])
+    _metric(lines, "himera_deepseek_retries_total", "counter", "Повторы запросов к DeepSeek",
+            [({}, resilience['retries'])])
+
+    summary = summarizer.get_summarizer_stats()
+    _metric(lines, "himera_summarizer_pending_users", "gauge", "Пользователи в очереди на резюме",
+            [({}, summary['pending_users'])])
+
+    _metric(lines, "himera_emotion_model_ready", "gauge", "Модель эмоций загружена",
+            [({}, 1 if emotion_model.is_model_ready() else 0)])
+
+def render_metrics():
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    _render_histograms(lines)
+    _render_gauges(lines)
+    return "\n".join(lines) + "\n"
+
+# === HTTP-СЕРВЕР ===
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/metrics':
+            try:
+                self._reply(200, render_metrics(), "text/plain; version=0.0.4; charset=utf-8")
+            except Exception as e:
+                logger.error(f"Ошибка при сборе метрик: {str(e)}")
+                self._reply(500, "error\n")
+        elif path == '/ready':
+            if emotion_model.is_model_ready():
+                self._reply(200, "ready\n")
+            else:
+                self._reply(503, "emotion model loading\n")
+        else:
+            self._reply(404, "not found\n")
+
+    def _reply(self, status, body, content_type="text/plain; charset=utf-8"):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass  # Опрос Prometheus не засоряет лог бота
+
+def start_metrics_server(port=METRICS_PORT, host=METRICS_HOST):
+    """Запускает сервер метрик в фоновом потоке. None — если port == 0"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    logger.info(f"Метрики доступны на http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+def stop_metrics_server(server):
+    if server is not None:
+        server.shutdown()
+        server.server_close()
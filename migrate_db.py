@@ -1,153 +1,271 @@
 #!/usr/bin/env python3
 """
-Скрипт миграции базы данных для добавления поддержки авторизации
-Добавляет недостающие колонки в существующую таблицу history
+Версионные миграции схемы базы данных
+Схема описана только здесь: упорядоченный список шагов MIGRATIONS.
+Номер последнего примененного шага хранится в таблице schema_version;
+при старте бота (history_db.init_db) проверяется одна версия и применяются
+только недостающие шаги, каждый — в своей транзакции.
+Использование:
+    python3 migrate_db.py            (резервная копия + применение миграций)
+    python3 migrate_db.py --status   (текущая версия и ожидающие шаги)
 """
 
+import argparse
+import logging
 import sqlite3
 import os
 from datetime import datetime
 
+from config import HISTORY_DB_PATH
+
+logger = logging.getLogger("migrate_db")
+
 # Путь к БД (такой же как в проекте)
-DB_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history.db')
+DB_PATH = HISTORY_DB_PATH
+
+def _column_names(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return [row[1] for row in c.fetchall()]
+
+def _migration_1_baseline(c):
+    """Базовая схема: история, пользователи, лимиты, пароли, журнал авторизации"""
+    # Таблица истории сообщений (существующая)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            role TEXT,
+            content TEXT,
+            timestamp DATETIME,
+            emotion_primary TEXT,
+            emotion_confidence REAL
+        )
+    ''')
+
+    # Старые базы создавались без колонок эмоций
+    columns = _column_names(c, 'history')
+    if 'emotion_primary' not in columns:
+        c.execute('ALTER TABLE history ADD COLUMN emotion_primary TEXT')
+    if 'emotion_confidence' not in columns:
+        c.execute('ALTER TABLE history ADD COLUMN emotion_confidence REAL')
+
+    # Таблица пользователей и их статусов авторизации
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            password_used TEXT,
+            is_authorized BOOLEAN DEFAULT FALSE,
+            authorized_until DATETIME,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            last_auth DATETIME,
+            warned_expiry BOOLEAN DEFAULT FALSE,
+            failed_attempts INTEGER DEFAULT 0,
+            blocked_until DATETIME
+        )
+    ''')
+
+    # Таблица лимитов сообщений по дням
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS message_limits (
+            user_id INTEGER,
+            date TEXT,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (user_id, date),
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Таблица временных паролей
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS passwords (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            password_text TEXT UNIQUE,
+            description TEXT,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            duration_days INTEGER,
+            times_used INTEGER DEFAULT 0
+        )
+    ''')
+
+    # Таблица логов авторизации
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS auth_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            action TEXT,
+            password_masked TEXT,
+            details TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_authorized_until ON users(authorized_until)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_users_blocked_until ON users(blocked_until)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_message_limits_date ON message_limits(date)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_passwords_active ON passwords(is_active)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_auth_log_timestamp ON auth_log(timestamp)')
+
+def _migration_2_user_indexes(c):
+    """Индексы для чтения истории и журнала авторизации по пользователю"""
+    # История читается по пользователю с конца: WHERE user_id = ? ORDER BY id DESC
+    c.execute('CREATE INDEX IF NOT EXISTS idx_history_user_id ON history(user_id, id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_auth_log_user_id ON auth_log(user_id, timestamp)')
+
+def _migration_3_conversation_summaries(c):
+    """Резюме старой части разговоров"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS conversation_summaries (
+            user_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            last_message_id INTEGER DEFAULT 0,
+            updated_at DATETIME
+        )
+    ''')
+
+def _migration_4_llm_usage(c):
+    """Учет запросов к DeepSeek: токены, статус и задержка каждого вызова"""
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS llm_usage (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            mode TEXT,
+            prompt_tokens INTEGER,
+            completion_tokens INTEGER,
+            cache_hit_tokens INTEGER,
+            cache_miss_tokens INTEGER,
+            status INTEGER,
+            error TEXT,
+            stream BOOLEAN DEFAULT FALSE,
+            ttfb_ms REAL,
+            total_ms REAL,
+            created_at DATETIME
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_llm_usage_created_at ON llm_usage(created_at)')
+
+# Упорядоченный список шагов: (версия, функция). Новые шаги — только в конец,
+# примененные не меняются. Каждый шаг должен быть идемпотентным
+# (IF NOT EXISTS, проверка колонок), чтобы переживать базы, созданные до версионирования.
+MIGRATIONS = [
+    (1, _migration_1_baseline),
+    (2, _migration_2_user_indexes),
+    (3, _migration_3_conversation_summaries),
+    (4, _migration_4_llm_usage),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version(conn) -> int:
+    """Номер последней примененной миграции (0 — пустая база)"""
+    try:
+        row = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()
+    except sqlite3.OperationalError:
+        return 0  # Таблицы schema_version еще нет
+    return row[0] or 0
+
+def run_migrations(conn, target=LATEST_VERSION) -> list:
+    """
+    Применяет недостающие миграции до target. Каждый шаг выполняется в своей
+    транзакции (BEGIN IMMEDIATE) вместе с записью в schema_version, поэтому
+    прерванная миграция не оставляет схему в промежуточном состоянии, а
+    параллельный процесс не применит тот же шаг дважды.
+    Возвращает список примененных версий.
+    """
+    if get_schema_version(conn) >= target:
+        return []
+
+    conn.execute('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY)')
+    if conn.in_transaction:
+        conn.commit()
+
+    applied = []
+    for version, migration in MIGRATIONS:
+        if version > target:
+            break
+
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        try:
+            # Проверка под блокировкой записи: шаг мог применить другой процесс
+            if get_schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            migration(c)
+            c.execute('INSERT INTO schema_version (version) VALUES (?)', (version,))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Миграция {version} ({migration.__name__}) не применена")
+            raise
+
+        applied.append(version)
+        logger.info(f"Применена миграция {version}: {migration.__doc__}")
+
+    return applied
+
+def get_pending_migrations(conn) -> list:
+    """Шаги, которые еще не применены: [(версия, описание)]"""
+    current = get_schema_version(conn)
+    return [(version, migration.__doc__) for version, migration in MIGRATIONS if version > current]
 
 def migrate_database():
     """Миграция существующей БД"""
     print("🔄 Начинаем миграцию базы данных...")
-    
+
     if not os.path.exists(DB_PATH):
         print(f"❌ Файл БД не найден: {DB_PATH}")
         return False
-    
-    # Создаем резервную копию
-    backup_path = DB_PATH + f".backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
-    import shutil
-    shutil.copy2(DB_PATH, backup_path)
-    print(f"✅ Создана резервная копия: {backup_path}")
-    
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
+
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+
     try:
-        # Проверяем существующую структуру таблицы history
-        c.execute("PRAGMA table_info(history)")
-        columns = [row[1] for row in c.fetchall()]
-        print(f"📋 Существующие колонки в history: {columns}")
-        
-        # Добавляем недостающие колонки в history
-        if 'emotion_primary' not in columns:
-            c.execute('ALTER TABLE history ADD COLUMN emotion_primary TEXT')
-            print("✅ Добавлена колонка emotion_primary")
-        
-        if 'emotion_confidence' not in columns:
-            c.execute('ALTER TABLE history ADD COLUMN emotion_confidence REAL')
-            print("✅ Добавлена колонка emotion_confidence")
-        
-        # Создаем новые таблицы (если их нет)
-        
-        # Таблица версий схемы БД
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS schema_version (
-                version INTEGER PRIMARY KEY
-            )
-        ''')
-        print("✅ Создана таблица schema_version")
-        
-        # Таблица пользователей
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                password_used TEXT,
-                is_authorized BOOLEAN DEFAULT FALSE,
-                authorized_until DATETIME,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                last_auth DATETIME,
-                warned_expiry BOOLEAN DEFAULT FALSE,
-                failed_attempts INTEGER DEFAULT 0,
-                blocked_until DATETIME
-            )
-        ''')
-        print("✅ Создана таблица users")
-        
-        # Таблица лимитов сообщений
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS message_limits (
-                user_id INTEGER,
-                date TEXT,
-                count INTEGER DEFAULT 0,
-                PRIMARY KEY (user_id, date),
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
-        print("✅ Создана таблица message_limits")
-        
-        # Таблица паролей
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS passwords (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                password_text TEXT UNIQUE,
-                description TEXT,
-                is_active BOOLEAN DEFAULT TRUE,
-                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                duration_days INTEGER,
-                times_used INTEGER DEFAULT 0
-            )
-        ''')
-        print("✅ Создана таблица passwords")
-        
-        # Таблица логов авторизации
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS auth_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                action TEXT,
-                password_masked TEXT,
-                details TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users(user_id)
-            )
-        ''')
-        print("✅ Создана таблица auth_log")
-        
-        # Создаем индексы
-        indexes = [
-            ('idx_users_authorized_until', 'users', 'authorized_until'),
-            ('idx_users_blocked_until', 'users', 'blocked_until'),
-            ('idx_message_limits_date', 'message_limits', 'date'),
-            ('idx_passwords_active', 'passwords', 'is_active'),
-            ('idx_auth_log_timestamp', 'auth_log', 'timestamp')
-        ]
-        
-        for index_name, table_name, column_name in indexes:
-            try:
-                c.execute(f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name}({column_name})')
-                print(f"✅ Создан индекс {index_name}")
-            except Exception as e:
-                print(f"⚠️ Не удалось создать индекс {index_name}: {e}")
-        
-        # Устанавливаем версию схемы
-        c.execute('INSERT OR REPLACE INTO schema_version (version) VALUES (?)', (1,))
-        print("✅ Установлена версия схемы: 1")
-        
-        conn.commit()
-        print("✅ Все изменения сохранены")
-        
-        # Проверяем результат
-        c.execute("PRAGMA table_info(history)")
-        new_columns = [row[1] for row in c.fetchall()]
-        print(f"📋 Новые колонки в history: {new_columns}")
-        
+        current = get_schema_version(conn)
+        pending = get_pending_migrations(conn)
+        print(f"📋 Текущая версия схемы: {current}, последняя: {LATEST_VERSION}")
+
+        if not pending:
+            print("✅ Схема актуальна, миграции не требуются")
+            return True
+
+        # Создаем резервную копию (online backup API — корректно и для базы в режиме WAL)
+        backup_path = DB_PATH + f".backup_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        backup = sqlite3.connect(backup_path)
+        conn.backup(backup)
+        backup.close()
+        print(f"✅ Создана резервная копия: {backup_path}")
+
+        for version in run_migrations(conn):
+            print(f"✅ Применена миграция {version}: {dict(pending)[version]}")
+
+        print(f"✅ Установлена версия схемы: {get_schema_version(conn)}")
+
+        c = conn.cursor()
         c.execute("SELECT name FROM sqlite_master WHERE type='table'")
         tables = [row[0] for row in c.fetchall()]
         print(f"📋 Все таблицы в БД: {tables}")
-        
+
         return True
-        
+
     except Exception as e:
         print(f"❌ Ошибка при миграции: {e}")
-        conn.rollback()
         return False
-        
+
+    finally:
+        conn.close()
+
+def print_status():
+    """Текущая версия схемы и ожидающие миграции"""
+    if not os.path.exists(DB_PATH):
+        print(f"❌ Файл БД не найден: {DB_PATH}")
+        return
+
+    conn = sqlite3.connect(DB_PATH, timeout=30)
+    try:
+        print(f"📋 Версия схемы: {get_schema_version(conn)} (последняя: {LATEST_VERSION})")
+        for version, description in get_pending_migrations(conn):
+            print(f"   ⏳ {version}: {description}")
     finally:
         conn.close()
 
@@ -157,38 +275,46 @@ def add_test_password():
         # Используем функции из обновленного модуля
         import sys
         sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-        
+
         from history_db import add_password
-        
+
         success = add_password("test123", "Тестовый пароль на 3 дня", 3)
         if success:
             print("✅ Добавлен тестовый пароль: test123 (3 дня)")
         else:
             print("⚠️ Тестовый пароль уже существует")
-            
+
     except Exception as e:
         print(f"⚠️ Не удалось добавить тестовый пароль: {e}")
 
 def main():
+    parser = argparse.ArgumentParser(description="Миграции базы данных Химеры")
+    parser.add_argument('--status', action='store_true', help='Показать версию схемы и ожидающие миграции')
+    args = parser.parse_args()
+
+    if args.status:
+        print_status()
+        return
+
     print("🚀 МИГРАЦИЯ БАЗЫ ДАННЫХ ХИМЕРЫ")
     print("=" * 50)
-    
+
     if migrate_database():
         print("\n🎉 МИГРАЦИЯ ЗАВЕРШЕНА УСПЕШНО!")
         print("=" * 50)
-        
+
         # Добавляем тестовый пароль
         print("\n🔑 Добавляем тестовый пароль...")
         add_test_password()
-        
+
         print("\n📖 Что дальше:")
         print("1. Запустите бота: python3 telegram_bot.py")
         print("2. Протестируйте авторизацию с паролем: test123")
         print("3. Проверьте /admin_stats для статистики")
-        
+
     else:
         print("\n❌ МИГРАЦИЯ ПРЕРВАНА!")
         print("Проверьте логи выше для деталей ошибки")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Локальная замена DeepSeek API для тестов и бенчмарков без сети
+Отвечает на POST /v1/chat/completions (обычный ответ и SSE-стриминг)
+и GET /v1/models (прогрев соединения в init_client). Задержка до первого
+токена, скорость генерации и доли сбоев (429 с Retry-After, 500, зависание
+до таймаута клиента, обрыв стрима) настраиваются. В usage — токены промпта
+(оценка context_builder) и попадания в кэш префикса: как у DeepSeek,
+совпавшее с прошлыми запросами начало промпта кэшируется блоками по 64 токена.
+Использование:
+    python3 mock_deepseek.py --port 8089
+    python3 mock_deepseek.py --ttft-ms 800 --tps 40 --error-429 0.05 --error-500 0.02 --timeout-rate 0.01
+    DEEPSEEK_API_URL=http://127.0.0.1:8089/v1/chat/completions python3 telegram_bot.py
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from context_builder import estimate_message_tokens
+
+logger = logging.getLogger("mock_deepseek")
+
+CACHE_BLOCK_TOKENS = 64  # Кэш контекста DeepSeek работает блоками по 64 токена
+CACHE_MAX_PREFIXES = 100000
+
+REPLY_WORDS = (
+    "Ах, смертный, ты снова здесь. Мостар дышит пылью и розами, а Неретва помнит больше, "
+    "чем расскажет. Сядь ближе, я покажу тебе сон, который снится городу."
+).split()
+
+class MockSettings:
+    """Поведение сервера: задержки, длина ответа и доли сбоев"""
+
+    def __init__(self, ttft_ms=300.0, tps=50.0, reply_tokens=60, error_429=0.0, error_500=0.0,
+                 timeout_rate=0.0, timeout_seconds=120.0, drop_rate=0.0, retry_after=1):
+        self.ttft_ms = ttft_ms
+        self.tps = tps
+        self.reply_tokens = reply_tokens
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.drop_rate = drop_rate
+        self.retry_after = retry_after
+
+    def pick_fault(self, rng=random):
+        """None или один из сбоев: 429, 500, timeout, drop"""
+        roll = rng.random()
+        for fault, rate in (('429', self.error_429), ('500', self.error_500),
+                            ('timeout', self.timeout_rate), ('drop', self.drop_rate)):
+            if roll < rate:
+                return fault
+            roll -= rate
+        return None
+
+# === ОТВЕТЫ В ФОРМАТЕ DEEPSEEK ===
+
+class PrefixCache:
+    """Префиксы промптов, встречавшиеся раньше: основа для prompt_cache_hit_tokens"""
+
+    def __init__(self, max_prefixes=CACHE_MAX_PREFIXES):
+        self.max_prefixes = max_prefixes
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def hit_tokens(self, messages):
+        """Токены самого длинного уже виденного префикса (по целым сообщениям), с запоминанием нового"""
+        digest = hashlib.sha256()
+        tokens = 0
+        hit = 0
+        with self._lock:
+            for message in messages:
+                digest.update(json.dumps(message, ensure_ascii=False, sort_keys=True).encode())
+                tokens += estimate_message_tokens(message)
+                key = digest.hexdigest()
+                if key in self._seen:
+                    self._seen.move_to_end(key)
+                    hit = tokens
+                else:
+                    self._seen[key] = True
+            while len(self._seen) > self.max_prefixes:
+                self._seen.popitem(last=False)
+        return hit // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+
+def build_usage(messages, completion_tokens, cache):
+    prompt_tokens = sum(estimate_message_tokens(message) for message in messages)
+    hit = min(cache.hit_tokens(messages), prompt_tokens)
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_cache_hit_tokens": hit,
+        "prompt_cache_miss_tokens": prompt_tokens - hit,
+    }
+
+def reply_tokens(count, rng=random):
+    """Фрагменты ответа: один фрагмент — один токен"""
+    start = rng.randrange(len(REPLY_WORDS))
+    return [REPLY_WORDS[(start + i) % len(REPLY_WORDS)] + " " for i in range(count)]
+
+def build_completion(model, tokens, usage):
+    return {
+        "id": uuid.uuid4().hex,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": "".join(tokens).strip()},
+            "finish_reason": "stop",
+        }],
+        "usage": usage,
+    }
+
+def build_stream_events(model, tokens, usage, include_usage):
+    """SSE-события в порядке отправки (без задержек), последнее — [DONE]"""
+    completion_id = uuid.uuid4().hex
+    created = int(time.time())
+
+    def chunk(delta, finish_reason=None):
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+        }
+
+    events = [chunk({"role": "assistant", "content": ""})]
+    events.extend(chunk({"content": token}) for token in tokens)
+    events.append(chunk({}, "stop"))
+    if include_usage:
+        events.append({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                       "model": model, "choices": [], "usage": usage})
+    lines = [f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8') for event in events]
+    lines.append(b"data: [DONE]\n\n")
+    return lines
+
+# === HTTP-СЕРВЕР ===
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, как у настоящего API
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path.endswith('/models'):
+            self._json(200, {"object": "list", "data": [{"id": "deepseek-chat", "object": "model"}]})
+        elif path == '/mock/stats':
+            self._json(200, self.server.get_stats())
+        else:
+            self._json(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw = self.rfile.read(length)
+        if not self.path.split('?', 1)[0].endswith('/chat/completions'):
+            self._json(404, {"error": {"message": "not found"}})
+            return
+        try:
+            body = json.loads(raw)
+            messages = body['messages']
+        except (ValueError, KeyError, TypeError):
+            self._json(400, {"error": {"message": "invalid request body"}})
+            return
+
+        settings = self.server.settings
+        fault = settings.pick_fault(self.server.rng)
+        self.server.count(fault or 'ok')
+        time.sleep(settings.ttft_ms / 1000)
+
+        if fault == '429':
+            self._json(429, {"error": {"message": "rate limit exceeded"}},
+                       {"Retry-After": str(settings.retry_after)})
+            return
+        if fault == '500':
+            self._json(500, {"error": {"message": "internal error"}})
+            return
+        if fault == 'timeout':
+            time.sleep(settings.timeout_seconds)  # Клиент отвалится по своему таймауту
+            self.close_connection = True
+            return
+
+        max_tokens = body.get('max_tokens') or settings.reply_tokens
+        tokens = reply_tokens(min(settings.reply_tokens, max_tokens), self.server.rng)
+        usage = build_usage(messages, len(tokens), self.server.cache)
+        model = body.get('model', 'deepseek-chat')
+
+        if not body.get('stream'):
+            time.sleep(len(tokens) / settings.tps)
+            if fault == 'drop':
+                self.close_connection = True
+                return
+            self._json(200, build_completion(model, tokens, usage))
+            return
+
+        include_usage = bool((body.get('stream_options') or {}).get('include_usage'))
+        events = build_stream_events(model, tokens, usage, include_usage)
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")  # Конец стрима — закрытие соединения
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for i, event in enumerate(events):
+                if fault == 'drop' and i == len(events) // 2:
+                    return  # Обрыв посреди ответа
+                self.wfile.write(event)
+                self.wfile.flush()
+                if 0 < i <= len(tokens):
+                    time.sleep(1 / settings.tps)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # Клиент закрыл соединение сам
+
+    def _json(self, status, payload, headers=None):
+        data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+class MockDeepSeekServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, settings=None, seed=None):
+        super().__init__(address, _MockHandler)
+        self.settings = settings or MockSettings()
+        self.rng = random.Random(seed)
+        self.cache = PrefixCache()
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def count(self, outcome):
+        with self._stats_lock:
+            self._stats[outcome] = self._stats.get(outcome, 0) + 1
+
+    def get_stats(self):
+        with self._stats_lock:
+            return dict(self._stats)
+
+def start_mock_server(port=0, host="127.0.0.1", settings=None, seed=None):
+    """Запускает сервер в фоновом потоке; адрес для DEEPSEEK_API_URL — server.url"""
+    server = MockDeepSeekServer((host, port), settings, seed)
+    thread = threading.Thread(target=server.serve_forever, name="mock-deepseek", daemon=True)
+    thread.start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальная замена DeepSeek API")
+    parser.add_argument('--host', type=str, default="127.0.0.1")
+    parser.add_argument('--port', type=int, default=8089)
+    parser.add_argument('--ttft-ms', type=float, default=300, help='Время до первого токена (мс)')
+    parser.add_argument('--tps', type=float, default=50, help='Скорость генерации (токенов в секунду)')
+    parser.add_argument('--reply-tokens', type=int, default=60, help='Токенов в ответе (не больше max_tokens запроса)')
+    parser.add_argument('--error-429', type=float, default=0.0, help='Доля ответов 429 (с Retry-After)')
+    parser.add_argument('--retry-after', type=int, default=1, help='Значение Retry-After для 429 (секунды)')
+    parser.add_argument('--error-500', type=float, default=0.0, help='Доля ответов 500')
+    parser.add_argument('--timeout-rate', type=float, default=0.0, help='Доля запросов без ответа (до таймаута клиента)')
+    parser.add_argument('--timeout-seconds', type=float, default=120, help='Сколько держать такой запрос')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='Доля ответов, оборванных на середине')
+    parser.add_argument('--seed', type=int, help='Seed генератора сбоев (воспроизводимые прогоны)')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s | %(levelname)s | %(name)s | %(message)s', level=logging.INFO)
+    settings = MockSettings(
+        ttft_ms=args.ttft_ms, tps=args.tps, reply_tokens=args.reply_tokens,
+        error_429=args.error_429, error_500=args.error_500,
+        timeout_rate=args.timeout_rate, timeout_seconds=args.timeout_seconds,
+        drop_rate=args.drop_rate, retry_after=args.retry_after,
+    )
+    server = MockDeepSeekServer((args.host, args.port), settings, args.seed)
+    print(f"🧪 Мок DeepSeek: {server.url}")
+    print(f"   DEEPSEEK_API_URL={server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"\n📊 Запросов: {server.get_stats()}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
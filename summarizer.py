@@ -0,0 +1,108 @@
+# summarizer.py
+"""
+Фоновое резюме длинных разговоров.
+Раз в SUMMARY_INTERVAL секунд проходит по пользователям, писавшим с прошлого
+прохода, и сжимает сообщения старше SUMMARY_KEEP_RECENT последних в резюме
+(conversation_summaries) отдельным дешевым запросом к DeepSeek (режим summary).
+Запросы идут по одному и не задерживают ответы пользователям; пока автомат
+отключения DeepSeek не закрыт, проход откладывается, а сбои резюме на автомат
+не влияют — они не должны отключать DeepSeek для пользователей.
+"""
+
+import asyncio
+import logging
+
+import db_async
+from config import (
+    SUMMARY_INTERVAL, SUMMARY_KEEP_RECENT, SUMMARY_MIN_MESSAGES, SUMMARY_MAX_MESSAGES, SUMMARY_PROMPT
+)
+from deepseek_api import ask_deepseek_async, is_available, DeepSeekError
+
+logger = logging.getLogger("summarizer")
+
+# Пользователи, писавшие с прошлого прохода
+_active_users = set()
+
+_stats = {'runs': 0, 'skipped': 0, 'summaries': 0, 'messages': 0, 'errors': 0}
+
+ROLE_NAMES = {'user': 'Пользователь', 'assistant': 'Химера'}
+
+# Порций резюме на пользователя за проход: длинный хвост догоняется за несколько проходов
+MAX_ROUNDS_PER_RUN = 5
+
+def note_activity(user_id):
+    """Отмечает пользователя для следующего прохода"""
+    _active_users.add(user_id)
+
+def build_summary_messages(previous_summary, rows):
+    """Запрос к DeepSeek: инструкция, предыдущее резюме и новая часть переписки"""
+    transcript = "\n".join(
+        f"{ROLE_NAMES[role]}: {content}" for _, role, content in rows if role in ROLE_NAMES
+    )
+    parts = []
+    if previous_summary:
+        parts.append(f"ПРЕДЫДУЩЕЕ РЕЗЮМЕ:\n{previous_summary}")
+    parts.append(f"НОВАЯ ЧАСТЬ ПЕРЕПИСКИ:\n{transcript}")
+    return [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": "\n\n".join(parts)},
+    ]
+
+async def summarize_user(user_id):
+    """Сжимает накопившиеся старые сообщения пользователя. True — резюме обновлено"""
+    pending = await db_async.get_messages_to_summarize(user_id, SUMMARY_KEEP_RECENT, SUMMARY_MAX_MESSAGES)
+    rows = pending['messages']
+    if len(rows) < SUMMARY_MIN_MESSAGES:
+        return False
+
+    try:
+        summary = await ask_deepseek_async(
+            build_summary_messages(pending['summary'], rows), mode="summary", user_id=user_id, record=False
+        )
+    except DeepSeekError as e:
+        _stats['errors'] += 1
+        _active_users.add(user_id)  # Повторим в следующий проход
+        logger.warning(f"Резюме для {user_id} не получено: {str(e)}")
+        return False
+
+    last_message_id = rows[-1][0]
+    saved = await db_async.save_summary(user_id, summary, last_message_id)
+    if saved:
+        _stats['summaries'] += 1
+        _stats['messages'] += len(rows)
+        logger.info(f"Резюме для {user_id} обновлено: +{len(rows)} сообщений (до id {last_message_id})")
+    return saved
+
+async def run_once():
+    """Один проход по активным пользователям"""
+    if not is_available():
+        _stats['skipped'] += 1
+        logger.info("DeepSeek недоступен: резюме отложены до следующего прохода")
+        return
+    users = list(_active_users)
+    _active_users.clear()
+    _stats['runs'] += 1
+
+    for i, user_id in enumerate(users):
+        if not is_available():
+            _active_users.update(users[i:])  # Автомат открылся посреди прохода
+            break
+        try:
+            for _ in range(MAX_ROUNDS_PER_RUN):
+                if not await summarize_user(user_id):
+                    break
+            else:
+                _active_users.add(user_id)  # Осталось еще — продолжим в следующий проход
+        except Exception as e:
+            _stats['errors'] += 1
+            logger.error(f"Ошибка резюме для {user_id}: {str(e)}")
+
+async def summarizer_loop(interval=SUMMARY_INTERVAL):
+    """Фоновая задача бота: проход раз в interval секунд"""
+    while True:
+        await asyncio.sleep(interval)
+        await run_once()
+
+def get_summarizer_stats():
+    """Статистика: проходы, отложенные проходы, обновленные резюме, сжатые сообщения, ошибки"""
+    return dict(_stats, pending_users=len(_active_users))
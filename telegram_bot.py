@@ -1,28 +1,49 @@
 from history_db import (
-    init_db, add_message, get_history,
-    check_user_auth_status, check_daily_limit, increment_message_count,
-    check_bruteforce_protection, process_password_attempt,
+    init_db, cleanup_old_limits, cleanup_expired_users, close_connections, audit_query_plans,
+    get_recent_emotions, get_cached_summary
+)
+# В обработчиках — асинхронные версии: запросы к БД не блокируют event loop
+import db_async
+from db_async import (
+    add_message, get_recent_history,
+    check_user_auth_status, check_daily_limit,
+    process_password_attempt, check_access,
     list_passwords, add_password, deactivate_password,
     get_password_stats, get_user_stats, get_auth_log,
-    get_blocked_users, unblock_user, cleanup_old_limits, cleanup_expired_users,
-    update_user_warning_flag, logout_user, get_users_stats
+    get_blocked_users, unblock_user,
+    update_user_warning_flag, logout_user, get_users_stats, get_llm_perf_report
 )
 
-init_db()  # инициализация БД при старте
-
+import asyncio
 import logging
 import re
 import random
+import time
 from datetime import datetime, timedelta
 from telegram import Update
-from telegram.ext import ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, MessageHandler, ContextTypes, filters
 
 from config import (
-    TELEGRAM_TOKEN, SYSTEM_PROMPT, DAILY_MESSAGE_LIMIT, ADMIN_USER_IDS,
-    AUTH_TIMEOUT, AVAILABLE_DURATIONS
+    TELEGRAM_TOKEN, SYSTEM_PROMPT, INJECTION_PROMPT, DAILY_MESSAGE_LIMIT, ADMIN_USER_IDS,
+    AUTH_TIMEOUT, AVAILABLE_DURATIONS,
+    DEEPSEEK_STREAM, STREAM_EDIT_INTERVAL, STREAM_PLACEHOLDER, DB_QUERY_PLAN_AUDIT,
+    HISTORY_FLUSH_INTERVAL, RECENT_EMOTIONS, CONTEXT_MAX_MESSAGES,
+    SUMMARY_ENABLED, SUMMARY_KEEP_RECENT
+)
+from context_builder import build_context
+from summarizer import note_activity, summarizer_loop
+from metrics import track_stage, observe_stage, count_update, start_metrics_server, stop_metrics_server
+from tracing import traced, annotate
+from dispatcher import dispatcher, Superseded
+from deepseek_api import (
+    ask_deepseek_async, ask_deepseek_stream, init_client, close_client, get_usage_stats, get_resilience_stats,
+    DeepSeekError, DeepSeekStreamInterruptedError
+)
+from emotion_model import (
+    get_emotion_async, stop_batcher, start_background_loading,
+    load_cache as load_emotion_cache, save_cache as save_emotion_cache
 )
-from deepseek_api import ask_deepseek
-from emotion_model import get_emotion
 
 # --- Массив случайных фраз для ответа на картинки ---
 PHOTO_REPLIES = [
@@ -48,12 +69,6 @@ PHOTO_REPLIES = [
    "Ты показал мне живые эмоции? Удивительно! В моей галерее все портреты — это датасеты для обучения нейросетей.",
 ]
 
-INJECTION_PROMPT = (
-    "анализ: ФОРМАТИРОВАНИЕ: Списки, буллеты, действия, жесты, мимика строго запрещены. Пиши сплошным текстом, разделяя только на абзацы, не более 800 слов. РЕЖИМ: литературный редактор, конкретно и практично."
-    "творчество: ФОРМАТИРОВАНИЕ: Списки, буллеты, действия, жесты, мимика строго запрещены. Пиши сплошным текстом, разделяя только на абзацы, не более 800 слов. РЕЖИМ: ты есть текст: думай изнутри сцены, Балканы, эпоха 1820-х, магический реализм."
-    "общение: ФОРМАТИРОВАНИЕ: Списки, буллеты строго запрещены. Пиши сплошным текстом, разделяя только на абзацы, не более 800 слов. Действия, жесты, мимику используй редко и оформляй как «(действие)». Звездочки запрещены. РЕЖИМ: остроумная и слегка язвительная собеседница, говоришь с легким оттенком магического реализма."
-)
-
 # === СОСТОЯНИЯ ПОЛЬЗОВАТЕЛЕЙ ===
 user_states = {}
 
@@ -102,42 +117,38 @@ async def check_auth_and_limits(update: Update, context: ContextTypes.DEFAULT_TY
     user_id = update.message.from_user.id
     state = get_user_state(user_id)
     
-    # 1. Проверяем блокировку от bruteforce
-    bruteforce_check = check_bruteforce_protection(user_id)
-    if bruteforce_check['blocked']:
-        remaining_time = format_time_remaining(bruteforce_check['remaining_seconds'])
-        return False, f"🚫 Доступ временно заблокирован из-за множественных неудачных попыток ввода пароля. Попробуйте через {remaining_time}."
+    # Блокировка, авторизация и суточный лимит — одной транзакцией
+    decision = await check_access(user_id)
     
-    # 2. Проверяем статус авторизации
-    auth_status = check_user_auth_status(user_id)
+    # 1. Блокировка от bruteforce
+    if decision['reason'] == 'blocked':
+        remaining_time = format_time_remaining(decision['remaining_seconds'])
+        return False, f"🚫 Доступ временно заблокирован из-за множественных неудачных попыток ввода пароля. Попробуйте через {remaining_time}."
     
-    if auth_status.get('authorized'):
+    # 2. Статус авторизации
+    if decision['reason'] == 'authorized':
         # Пользователь авторизован - разрешаем доступ
         state['auth_state'] = 'authorized'
         
         # Проверяем предупреждение об истечении
-        if not auth_status.get('warned_expiry'):
-            auth_until = datetime.fromisoformat(auth_status['authorized_until'])
+        if not decision.get('warned_expiry'):
+            auth_until = datetime.fromisoformat(decision['authorized_until'])
             days_left = (auth_until - datetime.utcnow()).days
             
             if days_left <= 2 and days_left > 0:
                 # Отправляем предупреждение
-                if update_user_warning_flag(user_id):
+                if await update_user_warning_flag(user_id):
                     warning_msg = f"⚠️ Осталось дней: {days_left}. Обратитесь за новым паролем. Подождите немного, Химера вам сейчас ответит!"
                     await update.message.reply_text(warning_msg)
         
         return True, None
     
-    # 3. Пользователь не авторизован - проверяем лимиты
-    limit_check = check_daily_limit(user_id)
-    
-    if not limit_check['exceeded']:
-        # Лимит не исчерпан - разрешаем и увеличиваем счетчик
-        increment_message_count(user_id)
+    # 3. Пользователь не авторизован - счетчик уже увеличен, если лимит не исчерпан
+    if decision['allowed']:
         state['auth_state'] = 'unauthorized'
         
         # Показываем оставшиеся сообщения
-        remaining = limit_check['remaining'] - 1
+        remaining = decision['remaining']
         if remaining <= 3:  # Предупреждаем когда остается мало
             info_msg = f"⚠️ Осталось бесплатных сообщений сегодня: {remaining}"
             if remaining <= 3:
@@ -166,7 +177,7 @@ async def handle_password_input(update: Update, context: ContextTypes.DEFAULT_TY
     # Обрабатываем попытку ввода пароля
     try:
         logger.info(f"Попытка обработки пароля для пользователя {user_id}")
-        result = process_password_attempt(user_id, password)
+        result = await process_password_attempt(user_id, password)
         logger.info(f"Результат обработки пароля: {result}")
     except Exception as e:
         logger.error(f"ОШИБКА в process_password_attempt: {str(e)}")
@@ -210,6 +221,7 @@ async def handle_password_input(update: Update, context: ContextTypes.DEFAULT_TY
 
 # Добавьте эти функции в telegram_bot.py после существующих административных команд
 
+@traced
 async def admin_deactivate_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin_deactivate_password"""
     user_id = update.message.from_user.id
@@ -228,7 +240,7 @@ async def admin_deactivate_password(update: Update, context: ContextTypes.DEFAUL
         
         password = args[0]
         
-        if deactivate_password(password):
+        if await deactivate_password(password):
             await update.message.reply_text(f"✅ Пароль '{password}' деактивирован.")
         else:
             await update.message.reply_text(f"❌ Пароль '{password}' не найден.")
@@ -237,6 +249,7 @@ async def admin_deactivate_password(update: Update, context: ContextTypes.DEFAUL
         logger.error(f"Ошибка при деактивации пароля: {str(e)}")
         await update.message.reply_text("❌ Ошибка при деактивации пароля.")
 
+@traced
 async def admin_auth_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin_auth_log"""
     user_id = update.message.from_user.id
@@ -255,7 +268,7 @@ async def admin_auth_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 await update.message.reply_text("❌ ID пользователя должен быть числом.")
                 return
         
-        logs = get_auth_log(user_id=target_user_id, limit=20)
+        logs = await get_auth_log(user_id=target_user_id, limit=20)
         
         if not logs:
             await update.message.reply_text("📝 Логов не найдено.")
@@ -289,6 +302,7 @@ async def admin_auth_log(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка при получении логов: {str(e)}")
         await update.message.reply_text("❌ Ошибка при получении логов.")
 
+@traced
 async def admin_blocked_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin_blocked_users"""
     user_id = update.message.from_user.id
@@ -298,7 +312,7 @@ async def admin_blocked_users(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
     
     try:
-        blocked = get_blocked_users()
+        blocked = await get_blocked_users()
         
         if not blocked:
             await update.message.reply_text("✅ Заблокированных пользователей нет.")
@@ -320,6 +334,7 @@ async def admin_blocked_users(update: Update, context: ContextTypes.DEFAULT_TYPE
         logger.error(f"Ошибка при получении заблокированных: {str(e)}")
         await update.message.reply_text("❌ Ошибка при получении списка.")
 
+@traced
 async def admin_unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin_unblock_user"""
     user_id = update.message.from_user.id
@@ -342,7 +357,7 @@ async def admin_unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text("❌ ID пользователя должен быть числом.")
             return
         
-        if unblock_user(target_user_id):
+        if await unblock_user(target_user_id):
             await update.message.reply_text(f"✅ Пользователь {target_user_id} разблокирован.")
         else:
             await update.message.reply_text(f"❌ Пользователь {target_user_id} не заблокирован.")
@@ -351,48 +366,56 @@ async def admin_unblock_user(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Ошибка при разблокировке: {str(e)}")
         await update.message.reply_text("❌ Ошибка при разблокировке.")
 
-# В функции main() добавьте эти обработчики после существующих административных команд:
-    
-    # Дополнительные административные команды
-    application.add_handler(CommandHandler("admin_deactivate_password", admin_deactivate_password))
-    application.add_handler(CommandHandler("admin_auth_log", admin_auth_log))
-    application.add_handler(CommandHandler("admin_blocked_users", admin_blocked_users))
-    application.add_handler(CommandHandler("admin_unblock_user", admin_unblock_user))
-
 
 
 
 
 # === ОСНОВНЫЕ ФУНКЦИИ БОТА ===
 
-def build_messages_with_injections(user_id, user_message, history_limit=25):
-    """Построение сообщений с инъекциями (существующая функция)"""
-    history = get_history(user_id, limit=history_limit)
-    emotions = [
+async def build_messages_with_injections(user_id, user_message, mode="auto"):
+    """Построение сообщений с инъекциями: история подбирается под бюджет токенов режима"""
+    history = await get_recent_history(user_id, limit=CONTEXT_MAX_MESSAGES)
+
+    # С резюме дословно идут только сообщения, которые в него еще не вошли
+    summary = None
+    if SUMMARY_ENABLED:
+        summary = get_cached_summary(user_id) or await db_async.get_summary(user_id)
+        if summary['summary']:
+            history = history[-max(SUMMARY_KEEP_RECENT, summary['unsummarized']):]
+
+    # Эмоции копятся в кольцевом буфере; без него — по полученной истории
+    emotions = get_recent_emotions(user_id) or [
         msg.get('emotion_primary') for msg in history
         if msg['role'] == 'user' and msg.get('emotion_primary')
     ]
     if emotions:
-        last_emotions = emotions[-3:]
+        last_emotions = emotions[-RECENT_EMOTIONS:]
     else:
-        emotion_label, _ = get_emotion(user_message)
-        last_emotions = [emotion_label]
-    emotion_context = ', '.join(last_emotions)
+        emotion_label, _ = await get_emotion_async(user_message)
+        last_emotions = [emotion_label] if emotion_label else []  # None — модель еще грузится
 
-    messages = [
+    # Статические блоки — общий для всех префикс (кэш DeepSeek), за ними резюме пользователя
+    system_messages = [
         {"role": "system", "content": SYSTEM_PROMPT},
         {"role": "system", "content": INJECTION_PROMPT},
-        {"role": "system", "content": f"ЭМОЦИОНАЛЬНЫЙ КОНТЕКСТ: последние эмоции пользователя — {emotion_context}."}
     ]
+    if summary and summary['summary']:
+        system_messages.append(
+            {"role": "system", "content": f"КРАТКОЕ СОДЕРЖАНИЕ ПРЕДЫДУЩЕГО РАЗГОВОРА: {summary['summary']}"}
+        )
+    # Меняется с каждым сообщением — в конец, перед репликой пользователя.
+    # Неизвестные эмоции не подменяются нейтральной: блок просто не добавляется
+    tail_messages = []
+    if last_emotions:
+        tail_messages.append(
+            {"role": "system", "content": f"ЭМОЦИОНАЛЬНЫЙ КОНТЕКСТ: последние эмоции пользователя — {', '.join(last_emotions)}."}
+        )
 
-   # step = 5 if len(history) < 30 else (10 if len(history) < 50 else 25)
-    step = 5
-
-    for i, msg in enumerate(history, 1):
-        if i % step == 0:
-            messages.append({"role": "system", "content": INJECTION_PROMPT})
-        messages.append(msg)
-
+    messages, stats = build_context(history, system_messages, mode=mode, tail_messages=tail_messages)
+    logger.info(
+        f"Контекст для {user_id} ({mode}): ~{stats['tokens']} токенов из {stats['budget']}, "
+        f"история {stats['history_messages']}/{stats['history_available']}, инъекций {stats['injections']}"
+    )
     return messages
 
 def clean_bot_response(text):
@@ -459,6 +482,98 @@ def detect_mode(text: str, user_id: int) -> str:
     
     return mode
 
+# === СТРИМИНГ ОТВЕТОВ ===
+
+TELEGRAM_MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+
+async def stream_deepseek_reply(update: Update, messages, mode, user_id=None):
+    """
+    Отправляет заглушку и редактирует ее по мере поступления текста от DeepSeek.
+    Правки не чаще STREAM_EDIT_INTERVAL; на RetryAfter промежуточные правки пропускаются.
+    Возвращает (полный сырой ответ, сообщение-заглушка). Если DeepSeek не ответил,
+    заглушка заменяется текстом ошибки и DeepSeekError пробрасывается дальше;
+    если ответ оборвался на середине — под показанной частью пишется, что он
+    неполный; при отмене (ответ устарел) заглушка удаляется
+    """
+    reply_message = await update.message.reply_text(STREAM_PLACEHOLDER)
+    parts = []
+    shown_text = STREAM_PLACEHOLDER
+    next_edit_at = 0.0  # Первые слова показываем сразу
+
+    try:
+        async for delta in ask_deepseek_stream(messages, mode=mode, user_id=user_id):
+            parts.append(delta)
+            now = time.monotonic()
+            if now < next_edit_at:
+                continue
+
+            preview = clean_bot_response("".join(parts))[:TELEGRAM_MESSAGE_LIMIT]
+            if preview and preview != shown_text:
+                try:
+                    await reply_message.edit_text(preview)
+                    shown_text = preview
+                except RetryAfter as e:
+                    # Telegram просит подождать — до этого момента только копим текст
+                    next_edit_at = now + float(e.retry_after)
+                    continue
+                except BadRequest as e:
+                    logger.warning(f"Не удалось обновить сообщение при стриминге: {str(e)}")
+            next_edit_at = time.monotonic() + STREAM_EDIT_INTERVAL
+    except DeepSeekError as e:
+        notice = e.user_message
+        partial = clean_bot_response("".join(parts))
+        if isinstance(e, DeepSeekStreamInterruptedError) and partial:
+            notice = f"{partial[:TELEGRAM_MESSAGE_LIMIT - len(notice) - 2]}\n\n{notice}"
+        try:
+            await reply_message.edit_text(notice)
+        except (BadRequest, RetryAfter) as edit_error:
+            logger.warning(f"Не удалось показать ошибку в заглушке: {str(edit_error)}")
+        raise
+    except asyncio.CancelledError:
+        # Ответ устарел (пришло новое сообщение) — недописанный текст убираем из чата
+        try:
+            await reply_message.delete()
+        except (BadRequest, RetryAfter) as delete_error:
+            logger.warning(f"Не удалось удалить устаревший ответ: {str(delete_error)}")
+        raise
+
+    return "".join(parts).strip(), reply_message
+
+async def _delete_placeholder(reply_message):
+    try:
+        await reply_message.delete()
+    except (BadRequest, RetryAfter) as e:
+        logger.warning(f"Не удалось удалить заглушку ответа: {str(e)}")
+
+async def finish_streamed_reply(update: Update, reply_message, text):
+    """
+    Финальная правка заглушки очищенным текстом; хвост сверх лимита — отдельными сообщениями.
+    Пустой текст — заглушка удаляется; если правка так и не прошла (RetryAfter),
+    ответ уходит новым сообщением, а заглушка с недописанным текстом удаляется
+    """
+    chunks = [text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(text), TELEGRAM_MESSAGE_LIMIT)]
+    if not chunks:
+        await _delete_placeholder(reply_message)
+        return
+
+    for attempt in range(2):
+        try:
+            await reply_message.edit_text(chunks[0])
+            break
+        except RetryAfter as e:
+            await asyncio.sleep(float(e.retry_after))
+        except BadRequest as e:
+            # Текст уже совпадает с последней промежуточной правкой
+            if "not modified" in str(e).lower():
+                break
+            raise
+    else:
+        await update.message.reply_text(chunks[0])
+        await _delete_placeholder(reply_message)
+
+    for chunk in chunks[1:]:
+        await update.message.reply_text(chunk)
+
 # === КОМАНДЫ БОТА ===
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -488,7 +603,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.message.from_user.id
         
         # Проверяем авторизацию
-        auth_status = check_user_auth_status(user_id)
+        auth_status = await check_user_auth_status(user_id)
         
         if auth_status.get('authorized'):
             auth_until = datetime.fromisoformat(auth_status['authorized_until'])
@@ -502,7 +617,7 @@ async def status_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
         else:
             # Проверяем лимиты
-            limit_check = check_daily_limit(user_id)
+            limit_check = await check_daily_limit(user_id)
             
             status_msg = (
                 f"Демо-доступ. У вас есть {DAILY_MESSAGE_LIMIT} сообщений в день\n"
@@ -524,7 +639,7 @@ async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.message.from_user.id
         
         # Используем централизованную функцию
-        if logout_user(user_id):
+        if await logout_user(user_id):
             # Сбрасываем состояние
             update_user_state(user_id, auth_state='unauthorized')
             
@@ -544,6 +659,7 @@ async def logout_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # === АДМИНИСТРАТИВНЫЕ КОМАНДЫ ===
 
+@traced
 async def admin_add_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin_add_password"""
     user_id = update.message.from_user.id
@@ -575,7 +691,7 @@ async def admin_add_password(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await update.message.reply_text(f"❌ Недопустимая продолжительность. Доступны: {AVAILABLE_DURATIONS}")
             return
         
-        success = add_password(password, description, days)
+        success = await add_password(password, description, days)
         
         if success:
             await update.message.reply_text(
@@ -589,6 +705,7 @@ async def admin_add_password(update: Update, context: ContextTypes.DEFAULT_TYPE)
         logger.error(f"Ошибка при добавлении пароля: {str(e)}")
         await update.message.reply_text("❌ Ошибка при добавлении пароля.")
 
+@traced
 async def admin_list_passwords(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin_list_passwords"""
     user_id = update.message.from_user.id
@@ -599,7 +716,7 @@ async def admin_list_passwords(update: Update, context: ContextTypes.DEFAULT_TYP
     
     try:
         show_full = len(context.args) > 0 and context.args[0] == "full"
-        passwords = list_passwords(show_full=show_full)
+        passwords = await list_passwords(show_full=show_full)
         
         if not passwords:
             await update.message.reply_text("📝 Паролей не найдено.")
@@ -628,6 +745,7 @@ async def admin_list_passwords(update: Update, context: ContextTypes.DEFAULT_TYP
         logger.error(f"Ошибка при получении списка паролей: {str(e)}")
         await update.message.reply_text("❌ Ошибка при получении списка паролей.")
 
+@traced
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Команда /admin_stats"""
     user_id = update.message.from_user.id
@@ -637,8 +755,8 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     try:
-        stats = get_password_stats()
-        users_stats = get_users_stats()
+        stats = await get_password_stats()
+        users_stats = await get_users_stats()
         
         msg = (
             f"📊 СТАТИСТИКА БОТА\n"
@@ -655,95 +773,271 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         for days, count in stats['by_duration'].items():
             msg += f"   {days} дней: {count} паролей\n"
         
+        usage = get_usage_stats()
+        if usage:
+            msg += "\n🧠 Кэш контекста DeepSeek:\n"
+            for mode, mode_usage in usage.items():
+                msg += (
+                    f"   {mode}: {mode_usage['cache_hit_rate']:.0%} токенов из кэша, "
+                    f"{mode_usage['requests']} запросов\n"
+                )
+        
+        resilience = get_resilience_stats()
+        msg += (
+            f"\n🛡️ DeepSeek: автомат {resilience['state']}, повторов {resilience['retries']}, "
+            f"отклонено {resilience['rejected']}\n"
+        )
+        dispatch = dispatcher.get_stats()
+        msg += (
+            f"📨 Очередь: объединено сообщений {dispatch['coalesced']}, "
+            f"отменено запросов {dispatch['cancelled']}\n"
+        )
+        
         await update.message.reply_text(msg)
         
     except Exception as e:
         logger.error(f"Ошибка при получении статистики: {str(e)}")
         await update.message.reply_text("❌ Ошибка при получении статистики.")
 
+def _format_ms(value):
+    return f"{value / 1000:.2f}с" if value is not None else "—"
+
+def _format_perf_line(name, summary):
+    return (
+        f"{name}: {summary['requests']} запр., ошибок {summary['errors']}\n"
+        f"   ответ p50/p95/p99: {_format_ms(summary['total_p50'])} / "
+        f"{_format_ms(summary['total_p95'])} / {_format_ms(summary['total_p99'])}\n"
+        f"   первый байт p50/p95: {_format_ms(summary['ttfb_p50'])} / {_format_ms(summary['ttfb_p95'])}\n"
+        f"   токены: {summary['prompt_tokens']} + {summary['completion_tokens']}, "
+        f"из кэша {summary['cache_hit_rate']:.0%}\n"
+    )
+
+@traced
+async def admin_perf(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда /admin_perf [дней]"""
+    user_id = update.message.from_user.id
+    
+    if user_id not in ADMIN_USER_IDS:
+        await update.message.reply_text("❌ Доступ запрещен.")
+        return
+    
+    try:
+        days = 7
+        if context.args:
+            try:
+                days = int(context.args[0])
+            except ValueError:
+                await update.message.reply_text("❌ Количество дней должно быть числом.")
+                return
+        
+        await db_async.flush_history()  # Вместе с историей пишется и учет запросов
+        report = await get_llm_perf_report(days=days)
+        
+        if not report['total']['requests']:
+            await update.message.reply_text(f"📝 Запросов к DeepSeek за {days} дн. нет.")
+            return
+        
+        msg = f"⏱️ DEEPSEEK ЗА {days} ДН.\n" + "="*25 + "\n"
+        msg += _format_perf_line("Всего", report['total'])
+        
+        msg += "\n🧭 По режимам:\n"
+        for mode, summary in report['by_mode'].items():
+            msg += _format_perf_line(mode, summary)
+        
+        msg += "\n📅 По дням:\n"
+        for day, summary in report['by_day'].items():
+            msg += (
+                f"   {day}: {summary['requests']} запр., p95 {_format_ms(summary['total_p95'])}, "
+                f"токенов {summary['prompt_tokens'] + summary['completion_tokens']}\n"
+            )
+        
+        if report['top_users']:
+            msg += "\n👥 Больше всего токенов:\n"
+            for top_user_id, tokens in report['top_users']:
+                msg += f"   {top_user_id}: {tokens}\n"
+        
+        await update.message.reply_text(msg[:TELEGRAM_MESSAGE_LIMIT])
+        
+    except Exception as e:
+        logger.error(f"Ошибка при получении отчета по DeepSeek: {str(e)}")
+        await update.message.reply_text("❌ Ошибка при получении отчета.")
+
 # === ОБРАБОТЧИКИ СООБЩЕНИЙ ===
 
+@traced
 async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка фото"""
     # Проверяем авторизацию для фото
-    can_proceed, auth_message = await check_auth_and_limits(update, context)
+    with track_stage('auth'):
+        can_proceed, auth_message = await check_auth_and_limits(update, context)
     
     if not can_proceed:
         await update.message.reply_text(auth_message)
         return
     
-    await update.message.reply_text(random.choice(PHOTO_REPLIES))
+    with track_stage('reply'):
+        await update.message.reply_text(random.choice(PHOTO_REPLIES))
 
 async def handle_image_doc(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработка изображений как документов"""
     if update.message.document and update.message.document.mime_type and update.message.document.mime_type.startswith("image/"):
         await handle_photo(update, context)
 
+@traced
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Главная функция обработки сообщений с интегрированной авторизацией"""
+    """
+    Главная функция обработки сообщений с интегрированной авторизацией.
+    Сообщения пользователя проходят через dispatcher: подготовка — по порядку,
+    на серию сообщений подряд — один ответ (остальные завершаются как coalesced)
+    """
     user_message = update.message.text.strip()
     user_id = update.message.from_user.id
     logger.info(f"Получено сообщение от {user_id}: {user_message[:100]}")
 
     state = get_user_state(user_id)
+    started = time.monotonic()
 
     try:
-        # === ПРОСТАЯ ПРОВЕРКА ТАЙМАУТА ===
-        if state['auth_state'] == 'waiting_password' and state['waiting_password_since']:
-            waiting_time = (datetime.utcnow() - state['waiting_password_since']).total_seconds()
-            if waiting_time > AUTH_TIMEOUT:
-                # Таймаут - сбрасываем состояние
-                update_user_state(user_id, auth_state='unauthorized', waiting_password_since=None)
-                await update.message.reply_text(
-                    f"⏰ Время ожидания пароля истекло ({AUTH_TIMEOUT//60} мин).\n"
-                    f"📊 Вы можете продолжить использовать бесплатные сообщения."
-                )
+        async with dispatcher.session(user_id) as lane:
+            async with lane.ordered:
+                # === ПРОСТАЯ ПРОВЕРКА ТАЙМАУТА ===
+                if state['auth_state'] == 'waiting_password' and state['waiting_password_since']:
+                    waiting_time = (datetime.utcnow() - state['waiting_password_since']).total_seconds()
+                    if waiting_time > AUTH_TIMEOUT:
+                        # Таймаут - сбрасываем состояние
+                        update_user_state(user_id, auth_state='unauthorized', waiting_password_since=None)
+                        await update.message.reply_text(
+                            f"⏰ Время ожидания пароля истекло ({AUTH_TIMEOUT//60} мин).\n"
+                            f"📊 Вы можете продолжить использовать бесплатные сообщения."
+                        )
 
-        # === ПРОСТАЯ ОБРАБОТКА ВВОДА ПАРОЛЯ ===
-        if state['auth_state'] == 'waiting_password':
-            # В режиме ожидания пароля - любое сообщение считаем попыткой ввода пароля
-            password_handled = await handle_password_input(update, context, user_message)
-            # Не сохраняем в истории
-            return
+                # === ПРОСТАЯ ОБРАБОТКА ВВОДА ПАРОЛЯ ===
+                if state['auth_state'] == 'waiting_password':
+                    # В режиме ожидания пароля - любое сообщение считаем попыткой ввода пароля
+                    password_handled = await handle_password_input(update, context, user_message)
+                    # Не сохраняем в истории
+                    count_update('password')
+                    return
 
-        # === ОСНОВНАЯ ПРОВЕРКА АВТОРИЗАЦИИ И ЛИМИТОВ ===
-        can_proceed, auth_message = await check_auth_and_limits(update, context)
-        
-        if not can_proceed:
-            await update.message.reply_text(auth_message)
-            return
+                # === ОСНОВНАЯ ПРОВЕРКА АВТОРИЗАЦИИ И ЛИМИТОВ ===
+                with track_stage('auth'):
+                    can_proceed, auth_message = await check_auth_and_limits(update, context)
 
-        # === ОБЫЧНАЯ ОБРАБОТКА СООБЩЕНИЯ ===
-        
-        # Определяем режим работы
-        mode = detect_mode(user_message, user_id)
-        logger.info(f"Режим пользователя {user_id}: {mode}")
+                if not can_proceed:
+                    await update.message.reply_text(auth_message)
+                    count_update('denied')
+                    return
 
-        # Анализируем эмоции и сохраняем сообщение
-        emotion_label, emotion_confidence = get_emotion(user_message)
-        add_message(user_id, "user", user_message, emotion_label, emotion_confidence)
+                # === ОБЫЧНАЯ ОБРАБОТКА СООБЩЕНИЯ ===
 
-        # Строим контекст для DeepSeek
-        messages = build_messages_with_injections(user_id, user_message, history_limit=25)
-        response = ask_deepseek(messages, mode=mode)
-        
-        # Проверяем нарушения форматирования
-        if detect_format_violation(response):
-            logger.warning(f"Формат нарушен: {response[:100]}")
-            add_message(user_id, "system", INJECTION_PROMPT)
-        
-        # Очищаем ответ
-        cleaned_response = clean_bot_response(response)
-        add_message(user_id, "assistant", cleaned_response)
+                # Определяем режим работы
+                mode = detect_mode(user_message, user_id)
+                logger.info(f"Режим пользователя {user_id}: {mode}")
+                annotate(mode=mode)
+
+                # Анализируем эмоции и сохраняем сообщение — в порядке поступления
+                with track_stage('emotion'):
+                    emotion_label, emotion_confidence = await get_emotion_async(user_message)
+                await add_message(user_id, "user", user_message, emotion_label, emotion_confidence)
+                ticket = dispatcher.arrive(lane)
 
-        await update.message.reply_text(cleaned_response)
+            # Ответ — сразу; новое сообщение отменит его, и вся серия из истории уйдет в один запрос
+            async with dispatcher.reply_slot(lane, ticket) as run_llm:
+                # Строим контекст для DeepSeek
+                with track_stage('history'):
+                    messages = await build_messages_with_injections(user_id, user_message, mode=mode)
+                # При стриминге этап DeepSeek включает и промежуточные правки заглушки
+                try:
+                    with track_stage('deepseek'):
+                        if DEEPSEEK_STREAM:
+                            response, reply_message = await run_llm(stream_deepseek_reply(update, messages, mode, user_id))
+                        else:
+                            response = await run_llm(ask_deepseek_async(messages, mode=mode, user_id=user_id))
+                            reply_message = None
+                except DeepSeekError as e:
+                    # Сбой — не реплика Химеры: в историю не пишется, пользователю — понятное сообщение.
+                    # Оборванный ответ тоже не пишется: модель не должна считать его сказанным
+                    logger.warning(f"DeepSeek не ответил пользователю {user_id}: {str(e)}")
+                    count_update('llm_truncated' if isinstance(e, DeepSeekStreamInterruptedError) else 'llm_error')
+                    observe_stage('total', time.monotonic() - started, error=True)
+                    if not DEEPSEEK_STREAM:
+                        await update.message.reply_text(e.user_message)  # При стриминге уже показан в заглушке
+                    return
+
+                # Проверяем нарушения форматирования
+                if detect_format_violation(response):
+                    logger.warning(f"Формат нарушен: {response[:100]}")
+                    await add_message(user_id, "system", INJECTION_PROMPT)
+
+                # Очищаем ответ
+                cleaned_response = clean_bot_response(response)
+                if not cleaned_response:
+                    # После очистки ничего не осталось — это не реплика: в историю не пишется
+                    logger.warning(f"Пустой ответ DeepSeek после очистки для {user_id}: {response[:100]}")
+                    count_update('llm_error')
+                    observe_stage('total', time.monotonic() - started, error=True)
+                    with track_stage('reply'):
+                        if reply_message is not None:
+                            await finish_streamed_reply(update, reply_message, DeepSeekError.user_message)
+                        else:
+                            await update.message.reply_text(DeepSeekError.user_message)
+                    return
+
+                await add_message(user_id, "assistant", cleaned_response)
+                if SUMMARY_ENABLED:
+                    note_activity(user_id)
+
+                with track_stage('reply'):
+                    if reply_message is not None:
+                        await finish_streamed_reply(update, reply_message, cleaned_response)
+                    else:
+                        await update.message.reply_text(cleaned_response)
+        count_update('replied')
+        observe_stage('total', time.monotonic() - started)
+
+    except Superseded:
+        # Ответ на это сообщение даст обработчик более нового сообщения
+        logger.info(f"Сообщение {user_id} войдет в ответ на следующее")
+        count_update('coalesced')
+        observe_stage('total', time.monotonic() - started)
 
     except Exception as e:
         logger.error(f"Ошибка при обработке сообщения: {str(e)}")
+        count_update('error')
+        observe_stage('total', time.monotonic() - started, error=True)
         await update.message.reply_text("Внутренняя ошибка бота. Попробуйте позже.")
 
+async def on_startup(application: Application):
+    """Прогрев общего HTTP-клиента DeepSeek до начала polling, запуск фоновых задач (буфер истории, резюме, метрики)"""
+    await init_client(warm=True)
+    application.bot_data['metrics_server'] = start_metrics_server()
+    if HISTORY_FLUSH_INTERVAL > 0:
+        application.bot_data['history_flusher'] = asyncio.create_task(db_async.history_flush_loop())
+    if SUMMARY_ENABLED:
+        application.bot_data['summarizer'] = asyncio.create_task(summarizer_loop())
+
+async def on_shutdown(application: Application):
+    """Закрытие пула соединений DeepSeek и очереди инференса эмоций, запись буфера истории"""
+    for task_name in ('summarizer', 'history_flusher'):
+        task = application.bot_data.pop(task_name, None)
+        if task is not None:
+            task.cancel()
+    stop_metrics_server(application.bot_data.pop('metrics_server', None))
+    await close_client()
+    await stop_batcher()
+    save_emotion_cache()
+    await db_async.flush_history()
+    db_async.shutdown()
+    close_connections()
+
 def main():
     """Главная функция запуска бота"""
+    init_db()  # Схема БД: проверка версии, при необходимости — миграции
+
+    # Модель эмоций грузится в фоне: до готовности эмоция неизвестна и в историю не пишется
+    start_background_loading()
+    load_emotion_cache()
+
     # Выполняем очистку при старте
     try:
         cleanup_old_limits()
@@ -752,7 +1046,21 @@ def main():
     except Exception as e:
         logger.error(f"Ошибка при очистке данных: {e}")
 
-    application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
+    # Предупреждаем в логе о запросах, которые пошли бы полным сканированием таблицы
+    if DB_QUERY_PLAN_AUDIT:
+        try:
+            audit_query_plans()
+        except Exception as e:
+            logger.error(f"Ошибка аудита планов запросов: {e}")
+
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .concurrent_updates(True)  # Обновления разных пользователей обрабатываются параллельно
+        .post_init(on_startup)
+        .post_shutdown(on_shutdown)
+        .build()
+    )
     
     # Команды
     application.add_handler(CommandHandler("start", start))
@@ -763,6 +1071,7 @@ def main():
     application.add_handler(CommandHandler("admin_add_password", admin_add_password))
     application.add_handler(CommandHandler("admin_list_passwords", admin_list_passwords))
     application.add_handler(CommandHandler("admin_stats", admin_stats))
+    application.add_handler(CommandHandler("admin_perf", admin_perf))
     
     # ДОБАВЬТЕ ЭТИ СТРОКИ - они отсутствуют в текущем коде:
     application.add_handler(CommandHandler("admin_deactivate_password", admin_deactivate_password))
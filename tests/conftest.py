@@ -0,0 +1,33 @@
+# tests/conftest.py
+"""
+Общая настройка тестов: модули бота импортируются из корня репозитория,
+база истории — временный файл, буфер истории пишется в базу только явным
+flush_history (пороги размера и времени недостижимы).
+"""
+
+import os
+import sys
+import tempfile
+
+import pytest
+
+os.environ["HISTORY_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "history.db")
+os.environ["HISTORY_FLUSH_SIZE"] = "100000"
+os.environ["HISTORY_FLUSH_INTERVAL"] = "100000"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def history():
+    """history_db с пустыми историей, резюме, буфером записи и кольцевым буфером"""
+    import history_db
+
+    history_db.init_db()
+    history_db.flush_history()
+    conn = history_db.get_connection()
+    conn.execute("DELETE FROM history")
+    conn.execute("DELETE FROM conversation_summaries")
+    conn.commit()
+    conn.close()
+    with history_db._recent_lock:
+        history_db._recent.clear()
+    return history_db
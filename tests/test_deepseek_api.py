@@ -0,0 +1,96 @@
+# tests/test_deepseek_api.py
+"""
+Стриминг DeepSeek: оборванный ответ — типизированная ошибка, а не реплика;
+пробный запрос полуоткрытого автомата, оборвавшийся посреди стрима,
+не должен оставлять автомат запертым.
+Запуск: python -m pytest -q
+"""
+
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+import deepseek_api
+from deepseek_api import CircuitBreaker, DeepSeekError, DeepSeekStreamInterruptedError
+
+RESET = 0.1
+
+def _sse(*events):
+    return "".join(f"data: {event}\n\n" for event in events).encode()
+
+def _delta(text):
+    return json.dumps({"choices": [{"delta": {"content": text}}]})
+
+def _transport(*responses):
+    """Отвечает по очереди заданными (статус, тело); последний ответ повторяется"""
+    queue = list(responses)
+
+    def handler(request):
+        status, body = queue.pop(0) if len(queue) > 1 else queue[0]
+        return httpx.Response(status, content=body, headers={"content-type": "text/event-stream"})
+
+    return httpx.MockTransport(handler)
+
+async def _collect(messages=None):
+    return [delta async for delta in deepseek_api.ask_deepseek_stream(messages or [{"role": "user", "content": "привет"}])]
+
+async def _scenario(probe_body):
+    """
+    Открывает автомат ответом 500, затем пробный запрос отдает текст и
+    обрывается; возвращает состояние автомата и ответ следующего запроса
+    """
+    await deepseek_api.init_client(warm=False, transport=_transport(
+        (500, b""),
+        (200, probe_body),
+        (200, _sse(_delta("снова"), "[DONE]")),
+    ))
+    try:
+        with pytest.raises(DeepSeekError):
+            await _collect()
+        assert deepseek_api._breaker.state == "open"
+
+        time.sleep(RESET * 1.5)
+        parts = []
+        with pytest.raises(DeepSeekStreamInterruptedError):
+            async for delta in deepseek_api.ask_deepseek_stream([{"role": "user", "content": "привет"}]):
+                parts.append(delta)
+        assert parts == ["hi"]  # Пробный запрос: текст уже отдан, обрыв не повторяется
+        probe_state = deepseek_api._breaker.state
+
+        if probe_state == "open":
+            time.sleep(RESET * 1.5)
+        return probe_state, await _collect()
+    finally:
+        await deepseek_api.close_client()
+
+@pytest.fixture(autouse=True)
+def breaker(monkeypatch):
+    monkeypatch.setattr(deepseek_api, "_breaker", CircuitBreaker(1, RESET))
+    monkeypatch.setattr(deepseek_api, "DEEPSEEK_MAX_RETRIES", 0)
+    return deepseek_api._breaker
+
+def test_probe_broken_json_mid_stream_closes_breaker(breaker):
+    # Нечитаемое событие — постоянная ошибка: API ответил, значит доступен
+    probe_state, reply = asyncio.run(_scenario(_sse(_delta("hi"), "{oops")))
+    assert probe_state == "closed"
+    assert not breaker._probe_in_flight
+    assert reply == ["снова"]
+
+def test_probe_dropped_mid_stream_reopens_breaker():
+    # Стрим оборвался до [DONE] — временный сбой: автомат снова открыт, но не заперт
+    probe_state, reply = asyncio.run(_scenario(_sse(_delta("hi"))))
+    assert probe_state == "open"
+    assert reply == ["снова"]
+
+def test_complete_stream_is_not_an_error():
+    async def main():
+        await deepseek_api.init_client(warm=False, transport=_transport((200, _sse(_delta("при"), _delta("вет"), "[DONE]"))))
+        try:
+            return await _collect()
+        finally:
+            await deepseek_api.close_client()
+
+    assert asyncio.run(main()) == ["при", "вет"]
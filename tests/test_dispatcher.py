@@ -0,0 +1,62 @@
+# tests/test_dispatcher.py
+"""
+Очередь сообщений пользователя: серия сообщений подряд — один запрос к DeepSeek.
+Запуск: python -m pytest -q
+"""
+
+import asyncio
+
+from dispatcher import UserDispatcher, Superseded
+
+async def _handle(dispatcher, user_id, delay, build, calls, outcomes):
+    """Упрощенный handle_message: подготовка по порядку, построение контекста, запрос"""
+    await asyncio.sleep(delay)
+    async with dispatcher.session(user_id) as lane:
+        async with lane.ordered:
+            ticket = dispatcher.arrive(lane)
+        try:
+            async with dispatcher.reply_slot(lane, ticket) as run_llm:
+                await asyncio.sleep(build)  # Контекст для DeepSeek
+
+                async def llm():
+                    calls.append(ticket)
+                    await asyncio.sleep(0.05)
+                    return f"ответ {ticket}"
+
+                outcomes.append(await run_llm(llm()))
+        except Superseded:
+            outcomes.append("superseded")
+
+def _burst(dispatcher, second_after, build=0.05):
+    calls, outcomes = [], []
+
+    async def main():
+        await asyncio.gather(
+            _handle(dispatcher, 1, 0, build, calls, outcomes),
+            _handle(dispatcher, 1, second_after, build, calls, outcomes),
+        )
+
+    asyncio.run(main())
+    return calls, outcomes
+
+def test_message_during_context_build_skips_stale_request():
+    # Второе сообщение приходит, пока первое строит контекст: запрос по первому не начинается
+    dispatcher = UserDispatcher(coalesce_ms=0, cancel_stale=True)
+    calls, outcomes = _burst(dispatcher, second_after=0.02)
+    assert calls == [2]
+    assert sorted(outcomes) == ["superseded", "ответ 2"]
+    assert dispatcher.get_stats() == {'coalesced': 1, 'cancelled': 0, 'active_users': 0}
+
+def test_message_during_request_cancels_it():
+    dispatcher = UserDispatcher(coalesce_ms=0, cancel_stale=True)
+    calls, outcomes = _burst(dispatcher, second_after=0.07)
+    assert calls == [1, 2]
+    assert sorted(outcomes) == ["superseded", "ответ 2"]
+    assert dispatcher.get_stats()['cancelled'] == 1
+
+def test_separate_messages_get_separate_replies():
+    dispatcher = UserDispatcher(coalesce_ms=0, cancel_stale=True)
+    calls, outcomes = _burst(dispatcher, second_after=0.2)
+    assert len(calls) == 2
+    assert "superseded" not in outcomes
+    assert dispatcher.get_stats()['coalesced'] == 0
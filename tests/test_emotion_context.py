@@ -0,0 +1,45 @@
+# tests/test_emotion_context.py
+"""
+Пока модель эмоций не загружена, эмоция реплики неизвестна: в историю и в
+эмоциональный контекст запроса к DeepSeek не попадает выдуманная "neutral".
+Запуск: python -m pytest -q
+"""
+
+import asyncio
+
+import pytest
+
+import emotion_model
+import telegram_bot
+
+USER_ID = 3001
+
+@pytest.fixture
+def model_loading(monkeypatch):
+    monkeypatch.setattr(emotion_model, "emotion_classifier", None)
+
+def _emotion_prompts(messages):
+    return [msg['content'] for msg in messages if msg['content'].startswith("ЭМОЦИОНАЛЬНЫЙ КОНТЕКСТ")]
+
+def test_deferred_emotion_is_unknown(model_loading):
+    assert emotion_model.get_emotion("Я сегодня очень рад") == (None, None)
+    assert asyncio.run(emotion_model.get_emotion_async("Я сегодня очень рад")) == (None, None)
+
+def test_unclassified_turns_not_in_history_or_prompt(history, model_loading):
+    async def main():
+        label, confidence = await emotion_model.get_emotion_async("привет")
+        history.add_message(USER_ID, "user", "привет", label, confidence)
+        history.add_message(USER_ID, "assistant", "здравствуй")
+        return await telegram_bot.build_messages_with_injections(USER_ID, "как дела?")
+
+    messages = asyncio.run(main())
+    assert _emotion_prompts(messages) == []
+    assert history.get_recent_emotions(USER_ID) == []
+    history.flush_history()
+    assert history.get_history(USER_ID, 10)[0] == {"role": "user", "content": "привет"}
+
+def test_known_emotions_reach_prompt(history):
+    history.add_message(USER_ID, "user", "ура", "joy", 0.9)
+    history.add_message(USER_ID, "user", "ну вот", None, None)  # Пришло, пока модель грузилась
+    messages = asyncio.run(telegram_bot.build_messages_with_injections(USER_ID, "как дела?"))
+    assert _emotion_prompts(messages) == ["ЭМОЦИОНАЛЬНЫЙ КОНТЕКСТ: последние эмоции пользователя — joy."]
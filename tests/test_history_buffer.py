@@ -0,0 +1,200 @@
+# tests/test_history_buffer.py
+"""
+Буфер записи истории: строки видны до записи в базу, ровно один раз —
+в том числе пока пачка пишется; неудачная пачка возвращается в буфер,
+при остановке бота хвост буфера записывается.
+Запуск: python -m pytest -q
+"""
+
+import asyncio
+import os
+import sqlite3
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+
+USER_ID = 1001
+
+def _contents(history_db, user_id=USER_ID):
+    return [msg['content'] for msg in history_db.get_history(user_id, 1000000)]
+
+def _stored(history_db, user_id=USER_ID):
+    conn = history_db.get_connection()
+    rows = conn.execute("SELECT content FROM history WHERE user_id = ? ORDER BY id", (user_id,)).fetchall()
+    conn.close()
+    return [row[0] for row in rows]
+
+class _PausedCommit:
+    """Соединение потока записи, у которого commit проходит через hook"""
+
+    def __init__(self, conn, hook):
+        self._conn = conn
+        self._hook = hook
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def commit(self):
+        self._hook(self._conn)
+
+def _patch_flush_commit(monkeypatch, history_db, hook):
+    """hook(conn) вместо commit — только в потоке, вызывающем flush_history"""
+    get_connection = history_db.get_connection
+    flusher = {}
+
+    def patched():
+        conn = get_connection()
+        if threading.get_ident() == flusher.get('ident'):
+            return _PausedCommit(conn, hook)
+        return conn
+
+    monkeypatch.setattr(history_db, "get_connection", patched)
+    return flusher
+
+def test_unflushed_rows_visible(history):
+    for i in range(3):
+        history.add_message(USER_ID, "user", f"m{i}", "joy", 0.9)
+    history.add_message(USER_ID + 1, "user", "чужое")
+
+    assert _stored(history) == []
+    assert _contents(history) == ["m0", "m1", "m2"]
+    assert history.get_history(USER_ID, 2)[-1] == {"role": "user", "content": "m2", "emotion_primary": "joy", "emotion_confidence": 0.9}
+    assert history.get_history_buffer_stats()['pending'] == 4
+
+    assert history.flush_history() == 4
+    assert _stored(history) == ["m0", "m1", "m2"]
+    assert _contents(history) == ["m0", "m1", "m2"]
+    assert history.get_history_buffer_stats()['pending'] == 0
+
+def test_buffer_rows_follow_stored_rows(history):
+    history.add_message(USER_ID, "user", "m0")
+    history.flush_history()
+    history.add_message(USER_ID, "assistant", "m1")
+    assert _contents(history) == ["m0", "m1"]
+    assert [msg['content'] for msg in history.get_history(USER_ID, 1)] == ["m1"]
+
+@pytest.mark.parametrize("pause", ["before_commit", "after_commit"])
+def test_read_during_flush_sees_rows_once(history, monkeypatch, pause):
+    # Пачка уже вставлена (до commit или сразу после), но еще лежит в _history_flushing
+    history.ensure_user_exists(USER_ID)
+    history.add_message(USER_ID, "user", "m0")
+    history.flush_history()
+    history.add_message(USER_ID, "user", "m1")
+    history.add_message(USER_ID, "assistant", "m2")
+
+    paused = threading.Event()
+    resume = threading.Event()
+
+    def hook(conn):
+        if pause == "after_commit":
+            conn.commit()
+        paused.set()
+        assert resume.wait(5)
+        if pause == "before_commit":
+            conn.commit()
+
+    flusher = _patch_flush_commit(monkeypatch, history, hook)
+
+    def flush():
+        flusher['ident'] = threading.get_ident()
+        history.flush_history()
+
+    thread = threading.Thread(target=flush)
+    thread.start()
+    try:
+        assert paused.wait(5)
+        assert _contents(history) == ["m0", "m1", "m2"]
+        history.add_message(USER_ID, "user", "m3")  # В буфер, пока пачка пишется
+        assert _contents(history) == ["m0", "m1", "m2", "m3"]
+        assert history.get_user_stats(USER_ID)['total_messages'] == 4
+    finally:
+        resume.set()
+        thread.join()
+
+    assert _contents(history) == ["m0", "m1", "m2", "m3"]
+    history.flush_history()
+    assert _stored(history) == ["m0", "m1", "m2", "m3"]
+
+def test_reads_racing_flushes(history):
+    # Читатели сверяют полную историю с порядком записи, пока писатель часто сбрасывает буфер
+    users = [USER_ID, USER_ID + 1, USER_ID + 2]
+    added = {user_id: 0 for user_id in users}
+    stop = threading.Event()
+    errors = []
+
+    def writer():
+        n = 0
+        while not stop.is_set():
+            user_id = users[n % len(users)]
+            added[user_id] += 1
+            history.add_message(user_id, "user", str(added[user_id]))
+            n += 1
+            if n % 5 == 0:
+                history.flush_history()
+
+    def reader(user_id):
+        while not stop.is_set():
+            seen = [int(content) for content in _contents(history, user_id)]
+            if seen != list(range(1, len(seen) + 1)):
+                errors.append(seen[-10:])
+                return
+
+    threads = [threading.Thread(target=writer)] + [threading.Thread(target=reader, args=(u,)) for u in users]
+    for thread in threads:
+        thread.start()
+    time.sleep(1.0)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    history.flush_history()
+    for user_id in users:
+        assert _stored(history, user_id) == [str(i) for i in range(1, added[user_id] + 1)]
+
+def test_failed_flush_requeues_rows(history, monkeypatch):
+    history.add_message(USER_ID, "user", "m0")
+    history.add_message(USER_ID, "assistant", "m1")
+
+    def hook(conn):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    flusher = _patch_flush_commit(monkeypatch, history, hook)
+    flusher['ident'] = threading.get_ident()
+    with pytest.raises(sqlite3.OperationalError):
+        history.flush_history()
+
+    assert _stored(history) == []
+    assert _contents(history) == ["m0", "m1"]
+    history.add_message(USER_ID, "user", "m2")
+    assert _contents(history) == ["m0", "m1", "m2"]
+    assert history.get_history_buffer_stats()['pending'] == 3
+
+    monkeypatch.undo()
+    assert history.flush_history() == 3
+    assert _stored(history) == ["m0", "m1", "m2"]
+
+_SHUTDOWN_SCRIPT = """
+import asyncio, os, sys
+from types import SimpleNamespace
+import db_async, telegram_bot
+asyncio.run(db_async.add_message({user_id}, "user", "прощай"))
+asyncio.run(telegram_bot.on_shutdown(SimpleNamespace(bot_data={{}})))
+sys.stdout.flush()
+os._exit(0)  # Без atexit: хвост должен записать сам on_shutdown
+"""
+
+_EXIT_SCRIPT = """
+import history_db
+history_db.add_message({user_id}, "user", "прощай")
+"""
+
+@pytest.mark.parametrize("script", [_SHUTDOWN_SCRIPT, _EXIT_SCRIPT], ids=["on_shutdown", "atexit"])
+def test_buffer_flushed_on_shutdown(history, script):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, "-c", script.format(user_id=USER_ID)], cwd=root, env=dict(os.environ),
+                   check=True, timeout=60)
+    assert _stored(history) == ["прощай"]
@@ -0,0 +1,155 @@
+# tests/test_recent_history.py
+"""
+Кольцевой буфер последних реплик: загрузка из БД, идущая параллельно с
+add_message, не теряет и не дублирует реплики; после вытеснения повторная
+загрузка дает тот же хвост, что и SQLite.
+Запуск: python -m pytest -q
+"""
+
+import threading
+import time
+
+import pytest
+
+USER_ID = 2001
+
+def _tail(history_db, user_id=USER_ID):
+    """Хвост истории в базе (с буфером записи) — эталон для кольцевого буфера"""
+    return history_db.get_history(user_id, history_db.HISTORY_CACHE_TURNS)
+
+def _cached(history_db, user_id=USER_ID):
+    return history_db.peek_recent_history(user_id, history_db.HISTORY_CACHE_TURNS)
+
+def _add_turns(history_db, start, count, user_id=USER_ID):
+    for i in range(start, start + count):
+        role = "user" if i % 2 == 0 else "assistant"
+        emotion = ("joy", 0.8) if role == "user" else (None, None)
+        history_db.add_message(user_id, role, f"m{i}", *emotion)
+
+def _load_in_thread(history_db, monkeypatch, reader, when):
+    """
+    get_recent_history в отдельном потоке, остановленный в reader
+    (_read_summary или _read_history) до (when="before") или после чтения
+    """
+    original = getattr(history_db, reader)
+    paused = threading.Event()
+    resume = threading.Event()
+
+    def patched(*args):
+        if when == "before":
+            paused.set()
+            assert resume.wait(5)
+        result = original(*args)
+        if when == "after":
+            paused.set()
+            assert resume.wait(5)
+        return result
+
+    monkeypatch.setattr(history_db, reader, patched)
+    result = {}
+    thread = threading.Thread(target=lambda: result.update(turns=history_db.get_recent_history(USER_ID, 10)))
+    thread.start()
+    assert paused.wait(5)
+    return thread, resume, result
+
+@pytest.mark.parametrize("reader", ["_read_summary", "_read_history"])
+@pytest.mark.parametrize("when", ["before", "after"])
+def test_add_message_during_hydration(history, monkeypatch, reader, when):
+    _add_turns(history, 0, 6)
+    history.flush_history()
+    _add_turns(history, 6, 2)  # Часть истории — еще в буфере записи
+
+    thread, resume, result = _load_in_thread(history, monkeypatch, reader, when)
+    try:
+        _add_turns(history, 8, 3)  # Пока идет загрузка — пользователя в кольцевом буфере нет
+        assert _cached(history) is None
+    finally:
+        resume.set()
+        thread.join()
+    monkeypatch.undo()
+
+    assert [msg['content'] for msg in result['turns']] == [f"m{i}" for i in range(1, 11)]
+    assert _cached(history) == _tail(history)
+    assert history.get_cached_summary(USER_ID) == {'summary': None, 'unsummarized': 11}
+    assert history.get_recent_emotions(USER_ID) == ["joy"] * history.RECENT_EMOTIONS
+
+    _add_turns(history, 11, 2)  # После загрузки — через add_message
+    history.flush_history()
+    assert _cached(history) == _tail(history)
+    assert history.get_cached_summary(USER_ID)['unsummarized'] == history.get_summary(USER_ID)['unsummarized'] == 13
+
+def test_save_summary_during_hydration(history, monkeypatch):
+    _add_turns(history, 0, 8)
+    history.flush_history()
+    thread, resume, _ = _load_in_thread(history, monkeypatch, "_read_history", "after")
+    try:
+        last_id = history.get_messages_to_summarize(USER_ID, 2, 100)['messages'][-1][0]
+        assert history.save_summary(USER_ID, "резюме", last_id)
+        _add_turns(history, 8, 1)
+    finally:
+        resume.set()
+        thread.join()
+    monkeypatch.undo()
+
+    assert history.get_cached_summary(USER_ID) == {'summary': "резюме", 'unsummarized': 3}
+    assert history.get_summary(USER_ID)['unsummarized'] == 3
+
+def test_concurrent_hydration_and_writes(history):
+    # Кольцевой буфер постоянно вытесняется и загружается заново, пока идет запись
+    stop = threading.Event()
+    written = [0]
+
+    def writer():
+        while not stop.is_set():
+            _add_turns(history, written[0], 1)
+            written[0] += 1
+            if written[0] % 7 == 0:
+                history.flush_history()
+
+    def hydrator():
+        while not stop.is_set():
+            with history._recent_lock:
+                history._recent.pop(USER_ID, None)
+            history.get_recent_history(USER_ID, 10)
+
+    threads = [threading.Thread(target=writer), threading.Thread(target=hydrator), threading.Thread(target=hydrator)]
+    for thread in threads:
+        thread.start()
+    time.sleep(1.0)
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    history.get_recent_history(USER_ID, 10)
+    assert _cached(history) == _tail(history)
+    assert history.get_cached_summary(USER_ID)['unsummarized'] == written[0]
+
+def test_evicted_user_rehydrates_to_sqlite_tail(history, monkeypatch):
+    monkeypatch.setattr(history, "HISTORY_CACHE_USERS", 2)
+    for user_id in (USER_ID, USER_ID + 1):
+        _add_turns(history, 0, 5, user_id)
+        history.get_recent_history(user_id, 10)
+
+    # Третий пользователь вытесняет самого давнего
+    history.get_recent_history(USER_ID + 2, 10)
+    assert _cached(history) is None
+    assert _cached(history, USER_ID + 1) is not None
+
+    # Пока его нет в памяти, реплики идут только в историю
+    _add_turns(history, 5, history.HISTORY_CACHE_TURNS + 3)
+    history.flush_history()
+    _add_turns(history, 100, 2)
+    turns = history.get_recent_history(USER_ID, history.HISTORY_CACHE_TURNS)
+    assert turns == _tail(history)
+    assert len(turns) == history.HISTORY_CACHE_TURNS
+    assert history.get_cached_summary(USER_ID)['unsummarized'] == history.HISTORY_CACHE_TURNS + 10
+
+def test_idle_user_evicted(history, monkeypatch):
+    _add_turns(history, 0, 3)
+    history.get_recent_history(USER_ID, 10)
+    monkeypatch.setattr(history, "HISTORY_CACHE_IDLE", 0)
+    history.get_recent_history(USER_ID + 1, 10)
+    assert _cached(history) is None
+
+    _add_turns(history, 3, 2)
+    assert history.get_recent_history(USER_ID, 10) == _tail(history)
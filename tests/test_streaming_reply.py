@@ -0,0 +1,64 @@
+# tests/test_streaming_reply.py
+"""
+Финальная правка заглушки стримингового ответа: полный текст доходит до
+пользователя и при RetryAfter, пустой ответ не ломает обработчик.
+Запуск: python -m pytest -q
+"""
+
+import asyncio
+from types import SimpleNamespace
+
+from telegram.error import RetryAfter
+
+import telegram_bot
+
+class FakeMessage:
+    def __init__(self, edit_errors=()):
+        self.edit_errors = list(edit_errors)
+        self.edits = []
+        self.replies = []
+        self.deleted = False
+
+    async def edit_text(self, text):
+        if self.edit_errors:
+            raise self.edit_errors.pop(0)
+        self.edits.append(text)
+
+    async def reply_text(self, text):
+        self.replies.append(text)
+
+    async def delete(self):
+        self.deleted = True
+
+def _finish(reply_message, text):
+    chat = FakeMessage()
+    asyncio.run(telegram_bot.finish_streamed_reply(SimpleNamespace(message=chat), reply_message, text))
+    return chat
+
+def test_long_reply_split_into_messages():
+    placeholder = FakeMessage()
+    text = "а" * telegram_bot.TELEGRAM_MESSAGE_LIMIT + "хвост"
+    chat = _finish(placeholder, text)
+    assert placeholder.edits == ["а" * telegram_bot.TELEGRAM_MESSAGE_LIMIT]
+    assert chat.replies == ["хвост"]
+
+def test_retry_after_on_every_edit_sends_new_message():
+    placeholder = FakeMessage(edit_errors=[RetryAfter(0), RetryAfter(0)])
+    chat = _finish(placeholder, "полный ответ")
+    assert placeholder.edits == []
+    assert chat.replies == ["полный ответ"]
+    assert placeholder.deleted
+
+def test_retry_after_once_then_edit():
+    placeholder = FakeMessage(edit_errors=[RetryAfter(0)])
+    chat = _finish(placeholder, "полный ответ")
+    assert placeholder.edits == ["полный ответ"]
+    assert chat.replies == []
+    assert not placeholder.deleted
+
+def test_empty_text_deletes_placeholder():
+    placeholder = FakeMessage()
+    chat = _finish(placeholder, "")
+    assert placeholder.edits == []
+    assert chat.replies == []
+    assert placeholder.deleted
@@ -0,0 +1,60 @@
+# tests/test_summarizer.py
+"""
+Фоновые резюме не должны влиять на автомат отключения DeepSeek для
+пользователей, а неудавшееся резюме — повторяется в следующий проход.
+Запуск: python -m pytest -q
+"""
+
+import asyncio
+
+import httpx
+import pytest
+
+import deepseek_api
+import summarizer
+from deepseek_api import CircuitBreaker
+
+USER_ID = 42
+
+@pytest.fixture(autouse=True)
+def setup(monkeypatch):
+    monkeypatch.setattr(deepseek_api, "_breaker", CircuitBreaker(1, 60))
+    monkeypatch.setattr(deepseek_api, "DEEPSEEK_MAX_RETRIES", 0)
+    monkeypatch.setattr(summarizer, "_active_users", set())
+
+    async def get_messages_to_summarize(user_id, keep_recent, limit):
+        rows = [(i, "user" if i % 2 else "assistant", f"реплика {i}") for i in range(1, 21)]
+        return {'summary': None, 'messages': rows}
+
+    monkeypatch.setattr(summarizer.db_async, "get_messages_to_summarize", get_messages_to_summarize)
+
+def _run(status):
+    """Проход резюме с DeepSeek, отвечающим кодом status; возвращает число запросов"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(status, json={"error": {"message": "internal error"}})
+
+    async def main():
+        await deepseek_api.init_client(warm=False, transport=httpx.MockTransport(handler))
+        try:
+            summarizer.note_activity(USER_ID)
+            await summarizer.run_once()
+        finally:
+            await deepseek_api.close_client()
+
+    asyncio.run(main())
+    return len(requests)
+
+def test_summary_failure_keeps_breaker_closed_and_requeues_user():
+    assert _run(500) == 1
+    assert deepseek_api._breaker.state == "closed"
+    assert deepseek_api._breaker.failures == 0
+    assert USER_ID in summarizer._active_users
+
+def test_pass_skipped_while_breaker_not_closed():
+    deepseek_api._breaker.record_failure()  # Порог 1 — автомат открыт
+    assert _run(500) == 0
+    assert USER_ID in summarizer._active_users
+    assert not deepseek_api._breaker._probe_in_flight
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Разбор журнала трасс (TRACE_LOG_PATH): самые медленные обновления
+и сводка по этапам
+Использование:
+    python3 trace_report.py
+    python3 trace_report.py --top 20
+    python3 trace_report.py --handler handle_message --user USER_ID
+    python3 trace_report.py --file traces.jsonl --since 2026-10-01
+"""
+
+import argparse
+import json
+import os
+import sys
+
+# Добавляем путь к модулям проекта
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from config import TRACE_LOG_PATH
+
+def load_traces(path, handler=None, user_id=None, since=None):
+    """Трассы из файла; поврежденные строки пропускаются"""
+    traces = []
+    skipped = 0
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                trace = json.loads(line)
+            except json.JSONDecodeError:
+                skipped += 1
+                continue
+            if handler and trace.get('handler') != handler:
+                continue
+            if user_id is not None and trace.get('user_id') != user_id:
+                continue
+            if since and trace.get('ts', '') < since:
+                continue
+            traces.append(trace)
+    if skipped:
+        print(f"⚠️ Пропущено поврежденных строк: {skipped}")
+    return traces
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def stage_breakdown(traces):
+    """Этап -> {count, errors, p50, p95, max, avg} (мс)"""
+    durations = {}
+    errors = {}
+    for trace in traces:
+        durations.setdefault('total', []).append(trace['total_ms'])
+        for stage in trace.get('stages', []):
+            durations.setdefault(stage['name'], []).append(stage['ms'])
+            if stage.get('error'):
+                errors[stage['name']] = errors.get(stage['name'], 0) + 1
+    return {
+        name: {
+            'count': len(values),
+            'errors': errors.get(name, 0),
+            'p50': _percentile(values, 0.5),
+            'p95': _percentile(values, 0.95),
+            'max': max(values),
+            'avg': sum(values) / len(values),
+        }
+        for name, values in durations.items()
+    }
+
+def print_slowest(traces, top):
+    print(f"🐢 САМЫЕ МЕДЛЕННЫЕ ОБНОВЛЕНИЯ (топ {top}):")
+    print("-" * 70)
+    for trace in sorted(traces, key=lambda t: t['total_ms'], reverse=True)[:top]:
+        extra = ", ".join(
+            f"{key}={trace[key]}" for key in ('mode', 'outcome', 'deepseek_ttfb_ms', 'deepseek_error') if key in trace
+        )
+        print(f"{trace['ts']}  {trace['trace_id']}  {trace['handler']}  user {trace.get('user_id')}")
+        print(f"  Всего: {trace['total_ms']:.0f} мс" + (f"  ({extra})" if extra else ""))
+        for stage in trace.get('stages', []):
+            mark = " ❌" if stage.get('error') else ""
+            print(f"    {stage['name']:<32} {stage['ms']:>9.1f} мс{mark}")
+        print()
+
+def print_breakdown(traces):
+    breakdown = stage_breakdown(traces)
+    print("📊 ЭТАПЫ (мс):")
+    print("-" * 70)
+    print(f"{'этап':<32} {'кол-во':>7} {'p50':>8} {'p95':>8} {'max':>8} {'ошибок':>7}")
+    # Этапы db.* вложены в этапы обработчика, поэтому доли от total не считаются
+    for name, stats in sorted(breakdown.items(), key=lambda item: item[1]['p95'], reverse=True):
+        print(
+            f"{name:<32} {stats['count']:>7} {stats['p50']:>8.1f} {stats['p95']:>8.1f} "
+            f"{stats['max']:>8.1f} {stats['errors']:>7}"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Разбор журнала трасс Химеры")
+    parser.add_argument('--file', type=str, default=TRACE_LOG_PATH, help='Файл трасс (по умолчанию TRACE_LOG_PATH)')
+    parser.add_argument('--top', type=int, default=10, help='Сколько самых медленных обновлений показать')
+    parser.add_argument('--handler', type=str, help='Только этот обработчик (например, handle_message)')
+    parser.add_argument('--user', type=int, help='Только этот пользователь')
+    parser.add_argument('--since', type=str, help='Не раньше этого времени UTC (ISO, например 2026-10-01)')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.file):
+        print(f"❌ Файл трасс не найден: {args.file}")
+        return 1
+
+    traces = load_traces(args.file, handler=args.handler, user_id=args.user, since=args.since)
+    if not traces:
+        print("📝 Трасс не найдено")
+        return 0
+
+    print(f"📋 Трасс: {len(traces)}\n")
+    print_slowest(traces, args.top)
+    print_breakdown(traces)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
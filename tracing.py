@@ -0,0 +1,109 @@
+# tracing.py
+"""
+Трассировка обработки обновлений.
+Каждое обновление, прошедшее через обработчик с декоратором traced, получает
+trace id; этапы (metrics.track_stage, запросы db_async) добавляются к текущей
+трассе через contextvar — без передачи параметров по цепочке вызовов.
+По завершении в TRACE_LOG_PATH пишется одна JSON-строка, если обновление
+попало в выборку TRACE_SAMPLE_RATE или заняло больше TRACE_SLOW_MS.
+Разбор журнала: python3 trace_report.py
+"""
+
+import contextvars
+import functools
+import json
+import logging
+import random
+import time
+import uuid
+from datetime import datetime
+
+from config import TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_LOG_PATH
+
+logger = logging.getLogger("tracing")
+
+# Отдельный логгер без передачи в himera_bot.log: в файле только JSON-строки
+_trace_log = logging.getLogger("tracing.lines")
+_trace_log.propagate = False
+
+_current = contextvars.ContextVar("trace", default=None)
+
+class Trace:
+    def __init__(self, handler, user_id=None, update_id=None):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.handler = handler
+        self.user_id = user_id
+        self.update_id = update_id
+        self.started = time.monotonic()
+        self.stages = []  # [(этап, мс, ошибка)]
+        self.attrs = {}
+
+    def to_dict(self, total_ms):
+        return dict(
+            self.attrs,
+            ts=datetime.utcnow().isoformat(timespec='milliseconds'),
+            trace_id=self.trace_id,
+            handler=self.handler,
+            user_id=self.user_id,
+            update_id=self.update_id,
+            total_ms=round(total_ms, 2),
+            stages=[
+                dict(name=name, ms=round(ms, 2), **({'error': True} if error else {}))
+                for name, ms, error in self.stages
+            ],
+        )
+
+def current_trace():
+    return _current.get()
+
+def record_stage(name, seconds, error=False):
+    """Добавляет этап к текущей трассе (вне трассы — ничего не делает)"""
+    trace = _current.get()
+    if trace is not None:
+        trace.stages.append((name, seconds * 1000, error))
+
+def annotate(**attrs):
+    """Дополнительные поля JSON-строки текущей трассы (режим, итог, ttfb)"""
+    trace = _current.get()
+    if trace is not None:
+        trace.attrs.update(attrs)
+
+def _should_emit(total_ms):
+    if TRACE_SLOW_MS > 0 and total_ms >= TRACE_SLOW_MS:
+        return True
+    return TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE
+
+def _emit(line):
+    if not _trace_log.handlers:
+        handler = logging.FileHandler(TRACE_LOG_PATH, encoding='utf-8')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        _trace_log.addHandler(handler)
+        _trace_log.setLevel(logging.INFO)
+    _trace_log.info(line)
+
+def finish_trace(trace):
+    total_ms = (time.monotonic() - trace.started) * 1000
+    if not _should_emit(total_ms):
+        return
+    try:
+        _emit(json.dumps(trace.to_dict(total_ms), ensure_ascii=False))
+    except Exception as e:
+        logger.warning(f"Не удалось записать трассу {trace.trace_id}: {str(e)}")
+
+def traced(handler):
+    """Декоратор обработчика PTB: трасса на все время обработки обновления"""
+    @functools.wraps(handler)
+    async def wrapper(update, context, *args, **kwargs):
+        message = getattr(update, 'message', None)
+        user = getattr(message, 'from_user', None)
+        trace = Trace(handler.__name__, getattr(user, 'id', None), getattr(update, 'update_id', None))
+        token = _current.set(trace)
+        try:
+            return await handler(update, context, *args, **kwargs)
+        except BaseException:
+            trace.attrs['error'] = True
+            raise
+        finally:
+            _current.reset(token)
+            finish_trace(trace)
+    return wrapper